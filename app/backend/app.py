@@ -1,12 +1,14 @@
-import dataclasses
+import asyncio
+import functools
 import io
 import json
 import logging
 import mimetypes
 import os
 import time
+from datetime import timedelta
 from pathlib import Path
-from typing import Any, AsyncGenerator, Dict, Union, cast
+from typing import Any, AsyncGenerator, Dict, Optional, Union, cast
 
 from azure.cognitiveservices.speech import (
     ResultReason,
@@ -15,7 +17,9 @@ from azure.cognitiveservices.speech import (
     SpeechSynthesisResult,
     SpeechSynthesizer,
 )
-from azure.core.exceptions import ResourceNotFoundError
+from azure.core import MatchConditions
+from azure.core.exceptions import HttpResponseError, ResourceNotFoundError
+from azure.core.pipeline.transport import AioHttpTransport
 from azure.identity.aio import (
     AzureDeveloperCliCredential,
     ManagedIdentityCredential,
@@ -24,11 +28,11 @@ from azure.identity.aio import (
 from azure.monitor.opentelemetry import configure_azure_monitor
 from azure.search.documents.aio import SearchClient
 from azure.search.documents.indexes.aio import SearchIndexClient
-from azure.storage.blob.aio import ContainerClient
+from azure.storage.blob.aio import BlobServiceClient, ContainerClient
 from azure.storage.blob.aio import StorageStreamDownloader as BlobDownloader
 from azure.storage.filedatalake.aio import FileSystemClient
 from azure.storage.filedatalake.aio import StorageStreamDownloader as DatalakeDownloader
-from openai import AsyncAzureOpenAI, AsyncOpenAI
+from openai import AsyncAzureOpenAI, AsyncOpenAI, DefaultAsyncHttpxClient
 from opentelemetry.instrumentation.aiohttp_client import AioHttpClientInstrumentor
 from opentelemetry.instrumentation.asgi import OpenTelemetryMiddleware
 from opentelemetry.instrumentation.httpx import (
@@ -38,6 +42,7 @@ from opentelemetry.instrumentation.openai import OpenAIInstrumentor
 from quart import (
     Blueprint,
     Quart,
+    Response,
     abort,
     current_app,
     jsonify,
@@ -47,6 +52,7 @@ from quart import (
     send_from_directory,
 )
 from quart_cors import cors
+from werkzeug.datastructures import ContentRange
 
 from approaches.approach import Approach
 from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
@@ -55,16 +61,25 @@ from approaches.retrievethenread import RetrieveThenReadApproach
 from approaches.retrievethenreadvision import RetrieveThenReadVisionApproach
 from chat_history.cosmosdb import chat_history_cosmosdb_bp
 from config import (
+    CONFIG_ANSWER_CACHE,
+    CONFIG_ANSWER_CACHE_INDEX_CLIENT,
     CONFIG_ASK_APPROACH,
     CONFIG_ASK_VISION_APPROACH,
     CONFIG_AUTH_CLIENT,
+    CONFIG_BEHIND_PROXY,
     CONFIG_BLOB_CONTAINER_CLIENT,
     CONFIG_CHAT_APPROACH,
     CONFIG_CHAT_HISTORY_BROWSER_ENABLED,
     CONFIG_CHAT_HISTORY_COSMOS_ENABLED,
     CONFIG_CHAT_VISION_APPROACH,
+    CONFIG_CONTENT_CACHE,
     CONFIG_CREDENTIAL,
+    CONFIG_DEADLINE_POLICY,
+    CONFIG_EMBEDDING_CACHE,
+    CONFIG_FAIR_SHARE_SCHEDULER,
     CONFIG_GPT4V_DEPLOYED,
+    CONFIG_HTTP_CLIENTS,
+    CONFIG_IMAGE_DELIVERY,
     CONFIG_INGESTER,
     CONFIG_LANGUAGE_PICKER_ENABLED,
     CONFIG_OPENAI_CLIENT,
@@ -77,12 +92,33 @@ from config import (
     CONFIG_SPEECH_SERVICE_LOCATION,
     CONFIG_SPEECH_SERVICE_TOKEN,
     CONFIG_SPEECH_SERVICE_VOICE,
+    CONFIG_STREAM_COALESCE_BYTES,
+    CONFIG_STREAM_COALESCE_MS,
     CONFIG_USER_BLOB_CONTAINER_CLIENT,
     CONFIG_USER_UPLOAD_ENABLED,
     CONFIG_VECTOR_SEARCH_ENABLED,
 )
+from core.admission import AdmissionController, AdmissionRejectedError
+from core.answercache import SemanticAnswerCache, get_search_index_version
 from core.authentication import AuthenticationHelper
+from core.cancellation import cancellation_stats
+from core.contentcache import ContentFileCache
+from core.deadline import DeadlineExceededError, DeadlinePolicy, RequestDeadline
+from core.embeddingcache import QueryEmbeddingCache, SQLiteEmbeddingStore
+from core.fairshare import FairShareScheduler
+from core.httpclients import HTTPClientRegistry
+from core.imageshelper import ImageCache, ImageDelivery
+from core.messagebuilder import token_count_cache
+from core.metrics import register_stats_gauges
+from core.openaibackends import OpenAIBackendPool
+from core.promptusage import prompt_usage_stats
 from core.sessionhelper import create_session_id
+from core.streaming import (
+    JSONProvider,
+    coalesce_deltas,
+    dumps_ndjson_line,
+    start_stream,
+)
 from decorators import authenticated, authenticated_path
 from error import error_dict, error_response
 from prepdocs import (
@@ -99,6 +135,9 @@ bp = Blueprint("routes", __name__, static_folder="static")
 mimetypes.add_type("application/javascript", ".js")
 mimetypes.add_type("text/css", ".css")
 
+# Size of each ranged GET used to stream /content files from storage
+CONTENT_CHUNK_SIZE = 4 * 1024 * 1024
+
 
 @bp.route("/")
 async def index():
@@ -130,7 +169,8 @@ async def content_file(path: str, auth_claims: Dict[str, Any]):
     *** NOTE *** if you are using app services authentication, this route will return unauthorized to all users that are not logged in
     if AZURE_ENFORCE_ACCESS_CONTROL is not set or false, logged in users can access all files regardless of access control
     if AZURE_ENFORCE_ACCESS_CONTROL is set to true, logged in users can only access files they have access to
-    This is also slow and memory hungry.
+    Files are streamed chunk by chunk, single byte ranges are honored so PDF viewers can load pages lazily,
+    and ETag/Last-Modified are passed through so browsers can revalidate instead of downloading again.
     """
     # Remove page number from path, filename-1.txt -> filename.txt
     # This shouldn't typically be necessary as browsers don't send hash fragments to servers
@@ -138,10 +178,100 @@ async def content_file(path: str, auth_claims: Dict[str, Any]):
         path_parts = path.rsplit("#page=", 1)
         path = path_parts[0]
     current_app.logger.info("Opening file %s", path)
-    blob_container_client: ContainerClient = current_app.config[CONFIG_BLOB_CONTAINER_CLIENT]
+
+    content_cache: Optional[ContentFileCache] = current_app.config[CONFIG_CONTENT_CACHE]
+    if content_cache:
+        if cached_response := await send_cached_content_file(content_cache, path, auth_claims):
+            return cached_response
+        content_cache.record_miss()
+
+    download_options: Dict[str, Any] = {}
+    if_none_match = request.headers.get("If-None-Match")
+    if if_none_match and if_none_match != "*" and "," not in if_none_match:
+        download_options["etag"] = if_none_match
+        download_options["match_condition"] = MatchConditions.IfModified
+    elif request.if_modified_since:
+        download_options["if_modified_since"] = request.if_modified_since
+
+    # Only single ranges with a known start are forwarded to storage, anything else is served in full
+    offset, length = None, None
+    if_range_etag = None
+    byte_range = request.range
+    if byte_range and byte_range.units == "bytes" and len(byte_range.ranges) == 1 and byte_range.ranges[0][0] >= 0:
+        range_start, range_stop = byte_range.ranges[0]
+        if_range = request.if_range
+        if if_range.etag and "etag" in download_options:
+            # Storage takes a single ETag condition, which If-None-Match has precedence for,
+            # so the If-Range ETag is compared with the one of the download instead
+            if_range_etag = f'"{if_range.etag}"'
+        elif if_range.etag:
+            download_options["etag"] = f'"{if_range.etag}"'
+            download_options["match_condition"] = MatchConditions.IfNotModified
+        # An If-Range date can't be checked without an extra properties request, so the range is ignored
+        if not if_range.date:
+            offset = range_start
+            length = range_stop - range_start if range_stop is not None else None
+
     blob: Union[BlobDownloader, DatalakeDownloader]
     try:
-        blob = await blob_container_client.get_blob_client(path).download_blob()
+        blob = await download_content_file(path, auth_claims, offset, length, **download_options)
+    except HttpResponseError as error:
+        # Storage reports failed preconditions as plain HTTP errors, so they are told apart by status code
+        if error.status_code == 304:
+            response = await make_response("", 304)
+            if if_none_match:
+                response.headers["ETag"] = if_none_match
+            return response
+        if error.status_code == 416:
+            response = await make_response("", 416)
+            # Tells the client the size of the file, so it can request a range that is satisfiable
+            if (size := await get_content_file_size(path, auth_claims)) is not None:
+                response.content_range = ContentRange("bytes", None, None, size)
+            return response
+        if error.status_code == 412 and offset is not None:
+            # If-Range did not match, so the whole current file is sent instead of the requested range
+            offset, length = None, None
+            blob = await download_content_file(path, auth_claims)
+        else:
+            raise
+    if offset is not None and if_range_etag is not None and blob.properties.etag != if_range_etag:
+        # If-Range did not match, so the whole current file is sent instead of the requested range
+        offset, length = None, None
+        blob = await download_content_file(path, auth_claims)
+    if not blob.properties or not blob.properties.has_key("content_settings"):
+        abort(404)
+    mime_type = blob.properties["content_settings"]["content_type"]
+    if not mime_type or mime_type == "application/octet-stream":
+        mime_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+    if content_cache:
+        cache_key = content_cache_key(path, auth_claims, isinstance(blob, DatalakeDownloader))
+        content_cache.schedule_fill(
+            cache_key,
+            mime_type,
+            lambda: download_content_file(path, auth_claims),
+            size=blob.size if offset is None else content_file_total_size(blob),
+        )
+
+    response = await make_response(stream_content_chunks(blob), 200 if offset is None else 206)
+    response.timeout = None  # type: ignore
+    response.mimetype = mime_type
+    response.content_length = blob.size
+    response.accept_ranges = "bytes"
+    if offset is not None:
+        response.content_range = ContentRange("bytes", offset, offset + blob.size, content_file_total_size(blob))
+    if blob.properties.etag:
+        response.headers["ETag"] = blob.properties.etag
+    if blob.properties.last_modified:
+        response.last_modified = blob.properties.last_modified
+    return response
+
+
+async def download_content_file(
+    path: str, auth_claims: Dict[str, Any], offset: Optional[int] = None, length: Optional[int] = None, **kwargs
+) -> Union[BlobDownloader, DatalakeDownloader]:
+    blob_container_client: ContainerClient = current_app.config[CONFIG_BLOB_CONTAINER_CLIENT]
+    try:
+        return await blob_container_client.get_blob_client(path).download_blob(offset=offset, length=length, **kwargs)
     except ResourceNotFoundError:
         current_app.logger.info("Path not found in general Blob container: %s", path)
         if current_app.config[CONFIG_USER_UPLOAD_ENABLED]:
@@ -150,21 +280,104 @@ async def content_file(path: str, auth_claims: Dict[str, Any]):
                 user_blob_container_client = current_app.config[CONFIG_USER_BLOB_CONTAINER_CLIENT]
                 user_directory_client: FileSystemClient = user_blob_container_client.get_directory_client(user_oid)
                 file_client = user_directory_client.get_file_client(path)
-                blob = await file_client.download_file()
+                return await file_client.download_file(offset=offset, length=length, **kwargs)
             except ResourceNotFoundError:
                 current_app.logger.exception("Path not found in DataLake: %s", path)
                 abort(404)
         else:
             abort(404)
-    if not blob.properties or not blob.properties.has_key("content_settings"):
-        abort(404)
-    mime_type = blob.properties["content_settings"]["content_type"]
-    if mime_type == "application/octet-stream":
-        mime_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
-    blob_file = io.BytesIO()
-    await blob.readinto(blob_file)
-    blob_file.seek(0)
-    return await send_file(blob_file, mimetype=mime_type, as_attachment=False, attachment_filename=path)
+
+
+def content_cache_key(path: str, auth_claims: Dict[str, Any], from_user_storage: bool) -> str:
+    # User uploads live in per-user directories, so their cache entries are scoped to the user
+    return f"user/{auth_claims['oid']}/{path}" if from_user_storage else f"blob/{path}"
+
+
+async def send_cached_content_file(
+    content_cache: ContentFileCache, path: str, auth_claims: Dict[str, Any]
+) -> Optional[Response]:
+    for from_user_storage in (False, True):
+        if from_user_storage and not (current_app.config[CONFIG_USER_UPLOAD_ENABLED] and auth_claims.get("oid")):
+            break
+        key = content_cache_key(path, auth_claims, from_user_storage)
+        entry = content_cache.lookup(key)
+        if entry is None:
+            continue
+        if content_cache.needs_revalidation(entry):
+            try:
+                properties = await get_content_file_properties(path, auth_claims, from_user_storage)
+                etag = properties.etag
+            except ResourceNotFoundError:
+                etag = None
+            if etag != entry.etag:
+                content_cache.evict(key)
+                return None
+            content_cache.mark_validated(entry)
+        response = await send_file(
+            entry.file_path, mimetype=entry.mime_type, add_etags=False, last_modified=entry.last_modified
+        )
+        # send_file marks responses as public, but these files may be access controlled
+        del response.headers["Cache-Control"]
+        response.headers["ETag"] = entry.etag
+        await response.make_conditional(request, accept_ranges=True, complete_length=entry.size)
+        content_cache.record_hit(response.content_length or 0)
+        return response
+    return None
+
+
+async def get_content_file_properties(path: str, auth_claims: Dict[str, Any], from_user_storage: bool):
+    if from_user_storage:
+        user_blob_container_client: FileSystemClient = current_app.config[CONFIG_USER_BLOB_CONTAINER_CLIENT]
+        user_directory_client = user_blob_container_client.get_directory_client(auth_claims["oid"])
+        return await user_directory_client.get_file_client(path).get_file_properties()
+    blob_container_client: ContainerClient = current_app.config[CONFIG_BLOB_CONTAINER_CLIENT]
+    return await blob_container_client.get_blob_client(path).get_blob_properties()
+
+
+async def get_content_file_size(path: str, auth_claims: Dict[str, Any]) -> Optional[int]:
+    for from_user_storage in (False, True):
+        if from_user_storage and not (current_app.config[CONFIG_USER_UPLOAD_ENABLED] and auth_claims.get("oid")):
+            break
+        try:
+            properties = await get_content_file_properties(path, auth_claims, from_user_storage)
+        except ResourceNotFoundError:
+            continue
+        return properties.size
+    return None
+
+
+async def stream_content_chunks(blob: Union[BlobDownloader, DatalakeDownloader]) -> AsyncGenerator[bytes, None]:
+    # The SDK chunk iterator also defines __iter__, which would make Quart iterate it synchronously
+    async for chunk in blob.chunks():
+        yield chunk
+
+
+def content_file_total_size(blob: Union[BlobDownloader, DatalakeDownloader]) -> Optional[int]:
+    # Blob downloads report "bytes start-end/total", DataLake properties do not carry the range
+    content_range = getattr(blob.properties, "content_range", None)
+    if content_range and "/" in content_range:
+        total = content_range.rsplit("/", 1)[1]
+        if total.isdigit():
+            return int(total)
+    return None
+
+
+def get_fair_share_identity(auth_claims: dict[str, Any]) -> str:
+    if oid := auth_claims.get("oid"):
+        return oid
+    # Without authentication, requests are told apart by client address. Behind the App Service or Container Apps
+    # front end, that is the last address of X-Forwarded-For: the ones before it are sent by the client and can be forged
+    forwarded_for = request.headers.get("X-Forwarded-For")
+    if forwarded_for and current_app.config.get(CONFIG_BEHIND_PROXY):
+        client = forwarded_for.split(",")[-1].strip()
+        # App Service adds the port to IPv4 addresses
+        return client.rsplit(":", 1)[0] if client.count(":") == 1 else client
+    return request.remote_addr or ""
+
+
+def fair_share_slot(auth_claims: dict[str, Any], route: str):
+    scheduler: FairShareScheduler = current_app.config[CONFIG_FAIR_SHARE_SCHEDULER]
+    return scheduler.slot(get_fair_share_identity(auth_claims), scheduler.get_weight(auth_claims, route))
 
 
 @bp.route("/ask", methods=["POST"])
@@ -182,28 +395,42 @@ async def ask(auth_claims: Dict[str, Any]):
             approach = cast(Approach, current_app.config[CONFIG_ASK_VISION_APPROACH])
         else:
             approach = cast(Approach, current_app.config[CONFIG_ASK_APPROACH])
-        r = await approach.run(
-            request_json["messages"], context=context, session_state=request_json.get("session_state")
-        )
+        async with fair_share_slot(auth_claims, "/ask"):
+            # The deadline starts once the request has its turn, so time spent queueing doesn't count
+            context["deadline"] = current_app.config[CONFIG_DEADLINE_POLICY].start("/ask")
+            r = await approach.run(
+                request_json["messages"], context=context, session_state=request_json.get("session_state")
+            )
         return jsonify(r)
+    except asyncio.CancelledError:
+        # Quart cancels the request when the client disconnects, which cancels the OpenAI and search calls in flight
+        cancellation_stats.record_request()
+        raise
     except Exception as error:
         return error_response(error, "/ask")
 
 
-class JSONEncoder(json.JSONEncoder):
-    def default(self, o):
-        if dataclasses.is_dataclass(o) and not isinstance(o, type):
-            return dataclasses.asdict(o)
-        return super().default(o)
+async def start_deadline(
+    events: AsyncGenerator[dict[str, Any], None], deadline: RequestDeadline
+) -> AsyncGenerator[dict[str, Any], None]:
+    deadline.start()
+    try:
+        async for event in events:
+            yield event
+    finally:
+        await events.aclose()
 
 
-async def format_as_ndjson(r: AsyncGenerator[dict, None]) -> AsyncGenerator[str, None]:
+async def format_as_ndjson(r: AsyncGenerator[dict, None]) -> AsyncGenerator[bytes, None]:
     try:
         async for event in r:
-            yield json.dumps(event, ensure_ascii=False, cls=JSONEncoder) + "\n"
+            yield dumps_ndjson_line(event)
     except Exception as error:
         logging.exception("Exception while generating response stream: %s", error)
-        yield json.dumps(error_dict(error))
+        yield json.dumps(error_dict(error)).encode("utf-8")
+    finally:
+        # When the client disconnects, the whole chain of streams is closed right away, down to the OpenAI stream
+        await r.aclose()
 
 
 @bp.route("/chat", methods=["POST"])
@@ -230,12 +457,17 @@ async def chat(auth_claims: Dict[str, Any]):
                 current_app.config[CONFIG_CHAT_HISTORY_COSMOS_ENABLED],
                 current_app.config[CONFIG_CHAT_HISTORY_BROWSER_ENABLED],
             )
-        result = await approach.run(
-            request_json["messages"],
-            context=context,
-            session_state=session_state,
-        )
+        async with fair_share_slot(auth_claims, "/chat"):
+            context["deadline"] = current_app.config[CONFIG_DEADLINE_POLICY].start("/chat")
+            result = await approach.run(
+                request_json["messages"],
+                context=context,
+                session_state=session_state,
+            )
         return jsonify(result)
+    except asyncio.CancelledError:
+        cancellation_stats.record_request()
+        raise
     except Exception as error:
         return error_response(error, "/chat")
 
@@ -248,6 +480,7 @@ async def chat_stream(auth_claims: Dict[str, Any]):
     request_json = await request.get_json()
     context = request_json.get("context", {})
     context["auth_claims"] = auth_claims
+    context["deadline"] = current_app.config[CONFIG_DEADLINE_POLICY].start("/chat/stream")
     try:
         use_gpt4v = context.get("overrides", {}).get("use_gpt4v", False)
         approach: Approach
@@ -269,10 +502,30 @@ async def chat_stream(auth_claims: Dict[str, Any]):
             context=context,
             session_state=session_state,
         )
+        # The slot is taken when the stream starts and held until the whole answer has been sent,
+        # and the deadline only starts once the slot is taken
+        scheduler: FairShareScheduler = current_app.config[CONFIG_FAIR_SHARE_SCHEDULER]
+        result = scheduler.schedule(
+            start_deadline(result, context["deadline"]),
+            get_fair_share_identity(auth_claims),
+            scheduler.get_weight(auth_claims, "/chat/stream"),
+        )
+        # Runs the approach up to its first event, so that a request rejected for lack of OpenAI budget,
+        # that waited too long for a slot, or that ran out of time before the answer, gets a 429/503/504
+        result = await start_stream(result, raise_early=(AdmissionRejectedError, DeadlineExceededError))
+        if current_app.config[CONFIG_STREAM_COALESCE_BYTES] > 0:
+            result = coalesce_deltas(
+                result,
+                max_bytes=current_app.config[CONFIG_STREAM_COALESCE_BYTES],
+                max_delay=current_app.config[CONFIG_STREAM_COALESCE_MS] / 1000,
+            )
         response = await make_response(format_as_ndjson(result))
         response.timeout = None  # type: ignore
         response.mimetype = "application/json-lines"
         return response
+    except asyncio.CancelledError:
+        cancellation_stats.record_request()
+        raise
     except Exception as error:
         return error_response(error, "/chat")
 
@@ -371,7 +624,14 @@ async def upload(auth_claims: dict[str, Any]):
     await file_client.upload_data(file_io, overwrite=True, metadata={"UploadedBy": user_oid})
     file_io.seek(0)
     ingester: UploadUserFileStrategy = current_app.config[CONFIG_INGESTER]
-    await ingester.add_file(File(content=file_io, acls={"oids": [user_oid]}, url=file_client.url))
+    try:
+        # Ingestion embeds the file with the same OpenAI quota, so it waits its turn behind the chats
+        async with fair_share_slot(auth_claims, "/upload"):
+            await ingester.add_file(File(content=file_io, acls={"oids": [user_oid]}, url=file_client.url))
+    except AdmissionRejectedError as error:
+        return error_response(error, "/upload")
+    if current_app.config.get(CONFIG_ANSWER_CACHE):
+        current_app.config[CONFIG_ANSWER_CACHE].invalidate()
     return jsonify({"message": "File uploaded successfully"}), 200
 
 
@@ -387,6 +647,8 @@ async def delete_uploaded(auth_claims: dict[str, Any]):
     await file_client.delete_file()
     ingester = current_app.config[CONFIG_INGESTER]
     await ingester.remove_file(filename, user_oid)
+    if current_app.config.get(CONFIG_ANSWER_CACHE):
+        current_app.config[CONFIG_ANSWER_CACHE].invalidate()
     return jsonify({"message": f"File {filename} deleted successfully"}), 200
 
 
@@ -406,6 +668,11 @@ async def list_uploaded(auth_claims: dict[str, Any]):
     return jsonify(files), 200
 
 
+def identity_transport(http_clients: HTTPClientRegistry) -> AioHttpTransport:
+    # Lets the managed identity credential fetch tokens over the pooled connections instead of its own session
+    return AioHttpTransport(session=http_clients.session("identity"), session_owner=False)
+
+
 @bp.before_app_serving
 async def setup_clients():
     # Replace these with your own values, either in environment variables or directly here
@@ -429,6 +696,8 @@ async def setup_clients():
     )
     AZURE_OPENAI_EMB_DEPLOYMENT = os.getenv("AZURE_OPENAI_EMB_DEPLOYMENT") if OPENAI_HOST.startswith("azure") else None
     AZURE_OPENAI_CUSTOM_URL = os.getenv("AZURE_OPENAI_CUSTOM_URL")
+    # JSON list of endpoints to balance the calls across, see core/openaibackends.py
+    AZURE_OPENAI_BACKENDS = os.getenv("AZURE_OPENAI_BACKENDS")
     # https://learn.microsoft.com/azure/ai-services/openai/api-version-deprecation#latest-ga-api-release
     AZURE_OPENAI_API_VERSION = os.getenv("AZURE_OPENAI_API_VERSION") or "2024-06-01"
     AZURE_VISION_ENDPOINT = os.getenv("AZURE_VISION_ENDPOINT", "")
@@ -465,10 +734,64 @@ async def setup_clients():
     USE_SPEECH_OUTPUT_AZURE = os.getenv("USE_SPEECH_OUTPUT_AZURE", "").lower() == "true"
     USE_CHAT_HISTORY_BROWSER = os.getenv("USE_CHAT_HISTORY_BROWSER", "").lower() == "true"
     USE_CHAT_HISTORY_COSMOS = os.getenv("USE_CHAT_HISTORY_COSMOS", "").lower() == "true"
+    USE_SPECULATIVE_QUERY_EMBEDDING = os.getenv("USE_SPECULATIVE_QUERY_EMBEDDING", "").lower() == "true"
+    OPENAI_STREAM_INCLUDE_USAGE = os.getenv("OPENAI_STREAM_INCLUDE_USAGE", "").lower() == "true"
+    QUERY_EMBEDDING_CACHE_SIZE = int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE", 2000))
+    QUERY_EMBEDDING_CACHE_SQLITE_PATH = os.getenv("QUERY_EMBEDDING_CACHE_SQLITE_PATH")
+    USE_ANSWER_CACHE = os.getenv("USE_ANSWER_CACHE", "").lower() == "true"
+    ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", 500))
+    ANSWER_CACHE_TTL_SECONDS = int(os.getenv("ANSWER_CACHE_TTL_SECONDS", 3600))
+    ANSWER_CACHE_SIMILARITY_THRESHOLD = float(os.getenv("ANSWER_CACHE_SIMILARITY_THRESHOLD", 0.97))
+    CONTENT_CACHE_DIR = os.getenv("CONTENT_CACHE_DIR")
+    CONTENT_CACHE_MAX_MB = int(os.getenv("CONTENT_CACHE_MAX_MB", 1024))
+    CONTENT_CACHE_REVALIDATE_SECONDS = int(os.getenv("CONTENT_CACHE_REVALIDATE_SECONDS", 60))
+    QUERY_VECTOR_TIMEOUTS = {
+        "embedding": float(os.getenv("QUERY_EMBEDDING_TIMEOUT_SECONDS", 10)),
+        "imageEmbedding": float(os.getenv("QUERY_IMAGE_EMBEDDING_TIMEOUT_SECONDS", 10)),
+    }
+    HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", 100))
+    HTTP_POOL_LIMIT_PER_HOST = int(os.getenv("HTTP_POOL_LIMIT_PER_HOST", 20))
+    HTTP_POOL_KEEPALIVE_SECONDS = int(os.getenv("HTTP_POOL_KEEPALIVE_SECONDS", 30))
+    IMAGE_CACHE_MAX_MB = int(os.getenv("IMAGE_CACHE_MAX_MB", 64))
+    IMAGE_CACHE_REVALIDATE_SECONDS = int(os.getenv("IMAGE_CACHE_REVALIDATE_SECONDS", 60))
+    IMAGE_FETCH_CONCURRENCY = int(os.getenv("IMAGE_FETCH_CONCURRENCY", 4))
+    GPT4V_IMAGE_DELIVERY = os.getenv("GPT4V_IMAGE_DELIVERY", "base64").lower()
+    GPT4V_IMAGE_DETAIL = os.getenv("GPT4V_IMAGE_DETAIL", "auto").lower()
+    GPT4V_IMAGE_MAX_PIXELS = int(os.getenv("GPT4V_IMAGE_MAX_PIXELS", 768 * 768))
+    GPT4V_IMAGE_JPEG_QUALITY = int(os.getenv("GPT4V_IMAGE_JPEG_QUALITY", 80))
+    GPT4V_IMAGE_SAS_EXPIRY_MINUTES = int(os.getenv("GPT4V_IMAGE_SAS_EXPIRY_MINUTES", 15))
+    STREAM_COALESCE_BYTES = int(os.getenv("STREAM_COALESCE_BYTES", 0))
+    STREAM_COALESCE_MS = int(os.getenv("STREAM_COALESCE_MS", 50))
+    OPENAI_ADMISSION_TOKENS_PER_MINUTE = int(os.getenv("OPENAI_ADMISSION_TOKENS_PER_MINUTE", 0))
+    OPENAI_ADMISSION_REQUESTS_PER_MINUTE = int(os.getenv("OPENAI_ADMISSION_REQUESTS_PER_MINUTE", 0))
+    OPENAI_ADMISSION_MAX_QUEUE = int(os.getenv("OPENAI_ADMISSION_MAX_QUEUE", 100))
+    OPENAI_ADMISSION_MAX_WAIT_SECONDS = float(os.getenv("OPENAI_ADMISSION_MAX_WAIT_SECONDS", 30))
+    FAIR_SHARE_MAX_CONCURRENCY = int(os.getenv("FAIR_SHARE_MAX_CONCURRENCY", 0))
+    FAIR_SHARE_MAX_WAIT_SECONDS = float(os.getenv("FAIR_SHARE_MAX_WAIT_SECONDS", 60))
+    FAIR_SHARE_GROUP_WEIGHTS = json.loads(os.getenv("FAIR_SHARE_GROUP_WEIGHTS") or "{}")
+    FAIR_SHARE_ROUTE_WEIGHTS = json.loads(os.getenv("FAIR_SHARE_ROUTE_WEIGHTS") or '{"/upload": 0.25}')
+    REQUEST_DEADLINE_SECONDS = float(os.getenv("REQUEST_DEADLINE_SECONDS", 0))
+    REQUEST_DEADLINE_ROUTE_SECONDS = json.loads(os.getenv("REQUEST_DEADLINE_ROUTE_SECONDS") or "{}")
+    REQUEST_DEADLINE_DEGRADE_BELOW_SECONDS = json.loads(
+        os.getenv("REQUEST_DEADLINE_DEGRADE_BELOW_SECONDS")
+        or '{"query_rewrite": 15, "semantic_ranker": 10, "vector_search": 8}'
+    )
 
     # WEBSITE_HOSTNAME is always set by App Service, RUNNING_IN_PRODUCTION is set in main.bicep
     RUNNING_ON_AZURE = os.getenv("WEBSITE_HOSTNAME") is not None or os.getenv("RUNNING_IN_PRODUCTION") is not None
 
+    # Shared connection pool for the services that are called with aiohttp rather than through an Azure SDK client
+    http_clients = HTTPClientRegistry(
+        limit=HTTP_POOL_LIMIT, limit_per_host=HTTP_POOL_LIMIT_PER_HOST, keepalive_timeout=HTTP_POOL_KEEPALIVE_SECONDS
+    )
+    register_stats_gauges("http.pool", http_clients.stats)
+    register_stats_gauges("prompt.token_cache", token_count_cache.stats)
+    register_stats_gauges("openai.prompt_usage", prompt_usage_stats.stats)
+    register_stats_gauges("requests.cancelled", cancellation_stats.stats)
+    current_app.config[CONFIG_HTTP_CLIENTS] = http_clients
+    current_app.config[CONFIG_STREAM_COALESCE_BYTES] = STREAM_COALESCE_BYTES
+    current_app.config[CONFIG_STREAM_COALESCE_MS] = STREAM_COALESCE_MS
+
     # Use the current user identity for keyless authentication to Azure services.
     # This assumes you use 'azd auth login' locally, and managed identity when deployed on Azure.
     # The managed identity is setup in the infra/ folder.
@@ -481,10 +804,12 @@ async def setup_clients():
             current_app.logger.info(
                 "Setting up Azure credential using ManagedIdentityCredential with client_id %s", AZURE_CLIENT_ID
             )
-            azure_credential = ManagedIdentityCredential(client_id=AZURE_CLIENT_ID)
+            azure_credential = ManagedIdentityCredential(
+                client_id=AZURE_CLIENT_ID, transport=identity_transport(http_clients)
+            )
         else:
             current_app.logger.info("Setting up Azure credential using ManagedIdentityCredential")
-            azure_credential = ManagedIdentityCredential()
+            azure_credential = ManagedIdentityCredential(transport=identity_transport(http_clients))
     elif AZURE_TENANT_ID:
         current_app.logger.info(
             "Setting up Azure credential using AzureDeveloperCliCredential with tenant_id %s", AZURE_TENANT_ID
@@ -505,9 +830,25 @@ async def setup_clients():
     )
 
     blob_container_client = ContainerClient(
-        f"https://{AZURE_STORAGE_ACCOUNT}.blob.core.windows.net", AZURE_STORAGE_CONTAINER, credential=azure_credential
+        f"https://{AZURE_STORAGE_ACCOUNT}.blob.core.windows.net",
+        AZURE_STORAGE_CONTAINER,
+        credential=azure_credential,
+        # Keep the first ranged GET as small as later chunks so /content streams instead of buffering up to 32 MiB
+        max_single_get_size=CONTENT_CHUNK_SIZE,
+        max_chunk_get_size=CONTENT_CHUNK_SIZE,
     )
 
+    content_cache = None
+    if CONTENT_CACHE_DIR:
+        current_app.logger.info("CONTENT_CACHE_DIR is set, caching content files on disk in %s", CONTENT_CACHE_DIR)
+        content_cache = ContentFileCache(
+            CONTENT_CACHE_DIR,
+            max_bytes=CONTENT_CACHE_MAX_MB * 1024 * 1024,
+            revalidate_after=CONTENT_CACHE_REVALIDATE_SECONDS,
+        )
+        register_stats_gauges("content.cache", content_cache.stats)
+    current_app.config[CONFIG_CONTENT_CACHE] = content_cache
+
     # Set up authentication helper
     search_index = None
     if AZURE_USE_AUTHENTICATION:
@@ -529,6 +870,10 @@ async def setup_clients():
         enable_global_documents=AZURE_ENABLE_GLOBAL_DOCUMENT_ACCESS,
         enable_unauthenticated_access=AZURE_ENABLE_UNAUTHENTICATED_ACCESS,
     )
+    register_stats_gauges("auth.jwks", auth_helper.key_store.stats)
+    register_stats_gauges("auth.claims_cache", auth_helper.auth_claims_cache.stats)
+    register_stats_gauges("auth.obo", auth_helper.obo_stats)
+    register_stats_gauges("auth.path_cache", auth_helper.path_auth_cache.stats)
 
     if USE_USER_UPLOAD:
         current_app.logger.info("USE_USER_UPLOAD is true, setting up user upload feature")
@@ -540,6 +885,8 @@ async def setup_clients():
             f"https://{AZURE_USERSTORAGE_ACCOUNT}.dfs.core.windows.net",
             AZURE_USERSTORAGE_CONTAINER,
             credential=azure_credential,
+            max_single_get_size=CONTENT_CHUNK_SIZE,
+            max_chunk_get_size=CONTENT_CHUNK_SIZE,
         )
         current_app.config[CONFIG_USER_BLOB_CONTAINER_CLIENT] = user_blob_container_client
 
@@ -568,10 +915,78 @@ async def setup_clients():
             disable_vectors=os.getenv("USE_VECTORS", "").lower() == "false",
         )
         ingester = UploadUserFileStrategy(
-            search_info=search_info, embeddings=text_embeddings_service, file_processors=file_processors
+            search_info=search_info,
+            embeddings=text_embeddings_service,
+            file_processors=file_processors,
+            on_acl_change=auth_helper.invalidate_path_auth,
         )
         current_app.config[CONFIG_INGESTER] = ingester
 
+    embedding_cache = None
+    if QUERY_EMBEDDING_CACHE_SIZE > 0:
+        shared_embedding_store = None
+        if QUERY_EMBEDDING_CACHE_SQLITE_PATH:
+            current_app.logger.info(
+                "QUERY_EMBEDDING_CACHE_SQLITE_PATH is set, sharing query embeddings through %s",
+                QUERY_EMBEDDING_CACHE_SQLITE_PATH,
+            )
+            shared_embedding_store = SQLiteEmbeddingStore(QUERY_EMBEDDING_CACHE_SQLITE_PATH)
+        embedding_cache = QueryEmbeddingCache(maxsize=QUERY_EMBEDDING_CACHE_SIZE, shared_store=shared_embedding_store)
+        register_stats_gauges("embedding.cache", embedding_cache.stats)
+    current_app.config[CONFIG_EMBEDDING_CACHE] = embedding_cache
+
+    answer_cache = None
+    answer_cache_index_client = None
+    if USE_ANSWER_CACHE:
+        # Similar questions are found through their embeddings, so the cache needs the embedding deployment
+        if os.getenv("USE_VECTORS", "").lower() == "false":
+            raise ValueError("USE_VECTORS must not be false when USE_ANSWER_CACHE is true")
+        current_app.logger.info("USE_ANSWER_CACHE is true, reusing answers to similar questions")
+        # The index statistics tell when documents were ingested by prepdocs, which doesn't go through the app
+        answer_cache_index_client = SearchIndexClient(
+            endpoint=f"https://{AZURE_SEARCH_SERVICE}.search.windows.net",
+            credential=azure_credential,
+        )
+        answer_cache = SemanticAnswerCache(
+            maxsize=ANSWER_CACHE_SIZE,
+            ttl=ANSWER_CACHE_TTL_SECONDS,
+            similarity_threshold=ANSWER_CACHE_SIMILARITY_THRESHOLD,
+            get_index_version=functools.partial(
+                get_search_index_version, answer_cache_index_client, AZURE_SEARCH_INDEX
+            ),
+        )
+        register_stats_gauges("answer.cache", answer_cache.stats)
+    current_app.config[CONFIG_ANSWER_CACHE] = answer_cache
+    current_app.config[CONFIG_ANSWER_CACHE_INDEX_CLIENT] = answer_cache_index_client
+
+    admission_controller = None
+    if OPENAI_ADMISSION_TOKENS_PER_MINUTE > 0 or OPENAI_ADMISSION_REQUESTS_PER_MINUTE > 0:
+        current_app.logger.info("OPENAI_ADMISSION_* is set, metering chat completions against the OpenAI budget")
+        admission_controller = AdmissionController(
+            tokens_per_minute=OPENAI_ADMISSION_TOKENS_PER_MINUTE,
+            requests_per_minute=OPENAI_ADMISSION_REQUESTS_PER_MINUTE,
+            max_queue=OPENAI_ADMISSION_MAX_QUEUE,
+            max_wait=OPENAI_ADMISSION_MAX_WAIT_SECONDS,
+        )
+        register_stats_gauges("openai.admission", admission_controller.stats)
+
+    fair_share_scheduler = FairShareScheduler(
+        max_concurrency=FAIR_SHARE_MAX_CONCURRENCY,
+        max_wait=FAIR_SHARE_MAX_WAIT_SECONDS,
+        group_weights=FAIR_SHARE_GROUP_WEIGHTS,
+        route_weights=FAIR_SHARE_ROUTE_WEIGHTS,
+    )
+    if FAIR_SHARE_MAX_CONCURRENCY > 0:
+        current_app.logger.info("FAIR_SHARE_MAX_CONCURRENCY is set, queuing requests fairly between users")
+        register_stats_gauges("fair_share", fair_share_scheduler.stats)
+    current_app.config[CONFIG_FAIR_SHARE_SCHEDULER] = fair_share_scheduler
+    current_app.config[CONFIG_BEHIND_PROXY] = RUNNING_ON_AZURE
+    current_app.config[CONFIG_DEADLINE_POLICY] = DeadlinePolicy(
+        seconds=REQUEST_DEADLINE_SECONDS,
+        route_seconds=REQUEST_DEADLINE_ROUTE_SECONDS,
+        degrade_below=REQUEST_DEADLINE_DEGRADE_BELOW_SECONDS,
+    )
+
     # Used by the OpenAI SDK
     openai_client: AsyncOpenAI
 
@@ -588,7 +1003,13 @@ async def setup_clients():
         current_app.config[CONFIG_SPEECH_SERVICE_TOKEN] = None
 
     if OPENAI_HOST.startswith("azure"):
-        if OPENAI_HOST == "azure_custom":
+        openai_backends: Optional[OpenAIBackendPool] = None
+        if AZURE_OPENAI_BACKENDS:
+            current_app.logger.info("AZURE_OPENAI_BACKENDS is set, balancing Azure OpenAI calls across its endpoints")
+            openai_backends = OpenAIBackendPool.from_config(json.loads(AZURE_OPENAI_BACKENDS))
+            register_stats_gauges("openai.backends", openai_backends.stats)
+            endpoint = openai_backends.endpoint
+        elif OPENAI_HOST == "azure_custom":
             current_app.logger.info("OPENAI_HOST is azure_custom, setting up Azure OpenAI custom client")
             if not AZURE_OPENAI_CUSTOM_URL:
                 raise ValueError("AZURE_OPENAI_CUSTOM_URL must be set when OPENAI_HOST is azure_custom")
@@ -601,7 +1022,10 @@ async def setup_clients():
         if api_key := os.getenv("AZURE_OPENAI_API_KEY_OVERRIDE"):
             current_app.logger.info("AZURE_OPENAI_API_KEY_OVERRIDE found, using as api_key for Azure OpenAI client")
             openai_client = AsyncAzureOpenAI(
-                api_version=AZURE_OPENAI_API_VERSION, azure_endpoint=endpoint, api_key=api_key
+                api_version=AZURE_OPENAI_API_VERSION,
+                azure_endpoint=endpoint,
+                api_key=api_key,
+                http_client=DefaultAsyncHttpxClient(transport=openai_backends) if openai_backends else None,
             )
         else:
             current_app.logger.info("Using Azure credential (passwordless authentication) for Azure OpenAI client")
@@ -610,6 +1034,7 @@ async def setup_clients():
                 api_version=AZURE_OPENAI_API_VERSION,
                 azure_endpoint=endpoint,
                 azure_ad_token_provider=token_provider,
+                http_client=DefaultAsyncHttpxClient(transport=openai_backends) if openai_backends else None,
             )
     elif OPENAI_HOST == "local":
         current_app.logger.info("OPENAI_HOST is local, setting up local OpenAI client for OPENAI_BASE_URL with no key")
@@ -657,6 +1082,9 @@ async def setup_clients():
         content_field=KB_FIELDS_CONTENT,
         query_language=AZURE_SEARCH_QUERY_LANGUAGE,
         query_speller=AZURE_SEARCH_QUERY_SPELLER,
+        embedding_cache=embedding_cache,
+        admission_controller=admission_controller,
+        answer_cache=answer_cache,
     )
 
     current_app.config[CONFIG_CHAT_APPROACH] = ChatReadRetrieveReadApproach(
@@ -672,6 +1100,11 @@ async def setup_clients():
         content_field=KB_FIELDS_CONTENT,
         query_language=AZURE_SEARCH_QUERY_LANGUAGE,
         query_speller=AZURE_SEARCH_QUERY_SPELLER,
+        speculative_query_embedding=USE_SPECULATIVE_QUERY_EMBEDDING,
+        embedding_cache=embedding_cache,
+        admission_controller=admission_controller,
+        answer_cache=answer_cache,
+        include_stream_usage=OPENAI_STREAM_INCLUDE_USAGE,
     )
 
     if USE_GPT4V:
@@ -680,6 +1113,29 @@ async def setup_clients():
             raise ValueError("AZURE_OPENAI_GPT4V_MODEL must be set when USE_GPT4V is true")
         token_provider = get_bearer_token_provider(azure_credential, "https://cognitiveservices.azure.com/.default")
 
+        image_cache = None
+        if IMAGE_CACHE_MAX_MB > 0:
+            image_cache = ImageCache(
+                max_bytes=IMAGE_CACHE_MAX_MB * 1024 * 1024, revalidate_after=IMAGE_CACHE_REVALIDATE_SECONDS
+            )
+            register_stats_gauges("image.cache", image_cache.stats)
+
+        image_delivery = ImageDelivery(
+            mode=GPT4V_IMAGE_DELIVERY,
+            detail=GPT4V_IMAGE_DETAIL,
+            max_pixels=GPT4V_IMAGE_MAX_PIXELS,
+            jpeg_quality=GPT4V_IMAGE_JPEG_QUALITY,
+            # SAS URLs are signed with a user delegation key, which needs the account-level client
+            blob_service_client=(
+                BlobServiceClient(f"https://{AZURE_STORAGE_ACCOUNT}.blob.core.windows.net", credential=azure_credential)
+                if GPT4V_IMAGE_DELIVERY == "sas"
+                else None
+            ),
+            sas_expiry=timedelta(minutes=GPT4V_IMAGE_SAS_EXPIRY_MINUTES),
+        )
+        register_stats_gauges("image.delivery", image_delivery.stats)
+        current_app.config[CONFIG_IMAGE_DELIVERY] = image_delivery
+
         current_app.config[CONFIG_ASK_VISION_APPROACH] = RetrieveThenReadVisionApproach(
             search_client=search_client,
             openai_client=openai_client,
@@ -696,6 +1152,13 @@ async def setup_clients():
             content_field=KB_FIELDS_CONTENT,
             query_language=AZURE_SEARCH_QUERY_LANGUAGE,
             query_speller=AZURE_SEARCH_QUERY_SPELLER,
+            embedding_cache=embedding_cache,
+            admission_controller=admission_controller,
+            http_session=http_clients.session("vision"),
+            vector_field_timeouts=QUERY_VECTOR_TIMEOUTS,
+            image_cache=image_cache,
+            image_fetch_concurrency=IMAGE_FETCH_CONCURRENCY,
+            image_delivery=image_delivery,
         )
 
         current_app.config[CONFIG_CHAT_VISION_APPROACH] = ChatReadRetrieveReadVisionApproach(
@@ -716,11 +1179,32 @@ async def setup_clients():
             content_field=KB_FIELDS_CONTENT,
             query_language=AZURE_SEARCH_QUERY_LANGUAGE,
             query_speller=AZURE_SEARCH_QUERY_SPELLER,
+            embedding_cache=embedding_cache,
+            admission_controller=admission_controller,
+            http_session=http_clients.session("vision"),
+            vector_field_timeouts=QUERY_VECTOR_TIMEOUTS,
+            image_cache=image_cache,
+            image_fetch_concurrency=IMAGE_FETCH_CONCURRENCY,
+            image_delivery=image_delivery,
+            include_stream_usage=OPENAI_STREAM_INCLUDE_USAGE,
         )
 
 
 @bp.after_app_serving
 async def close_clients():
+    current_app.config[CONFIG_AUTH_CLIENT].close()
+    if current_app.config.get(CONFIG_CONTENT_CACHE):
+        current_app.config[CONFIG_CONTENT_CACHE].close()
+    if current_app.config.get(CONFIG_EMBEDDING_CACHE):
+        current_app.config[CONFIG_EMBEDDING_CACHE].close()
+    if current_app.config.get(CONFIG_ANSWER_CACHE):
+        current_app.config[CONFIG_ANSWER_CACHE].close()
+    if current_app.config.get(CONFIG_ANSWER_CACHE_INDEX_CLIENT):
+        await current_app.config[CONFIG_ANSWER_CACHE_INDEX_CLIENT].close()
+    if current_app.config.get(CONFIG_HTTP_CLIENTS):
+        await current_app.config[CONFIG_HTTP_CLIENTS].close()
+    if current_app.config.get(CONFIG_IMAGE_DELIVERY):
+        await current_app.config[CONFIG_IMAGE_DELIVERY].close()
     await current_app.config[CONFIG_SEARCH_CLIENT].close()
     await current_app.config[CONFIG_BLOB_CONTAINER_CLIENT].close()
     if current_app.config.get(CONFIG_USER_BLOB_CONTAINER_CLIENT):
@@ -729,6 +1213,7 @@ async def close_clients():
 
 def create_app():
     app = Quart(__name__)
+    app.json = JSONProvider(app)
     app.register_blueprint(bp)
     app.register_blueprint(chat_history_cosmosdb_bp)
 
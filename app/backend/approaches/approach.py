@@ -1,5 +1,9 @@
+import asyncio
+import logging
 import os
+import time
 from abc import ABC
+from contextlib import AsyncExitStack
 from dataclasses import dataclass
 from typing import (
     Any,
@@ -22,26 +26,69 @@ from azure.search.documents.models import (
     VectorQuery,
 )
 from openai import AsyncOpenAI
-from openai.types.chat import ChatCompletionMessageParam
+from openai.types.chat import ChatCompletionMessageParam, ChatCompletionToolParam
 
+from core.admission import AdmissionController
+from core.answercache import AnswerCacheMatch, SemanticAnswerCache
 from core.authentication import AuthenticationHelper
+from core.deadline import RequestDeadline
+from core.embeddingcache import QueryEmbeddingCache
+from core.messagebuilder import count_prompt_tokens
 from text import nonewlines
 
 
-@dataclass
 class Document:
-    id: Optional[str]
-    content: Optional[str]
-    embedding: Optional[List[float]]
-    image_embedding: Optional[List[float]]
-    category: Optional[str]
-    sourcepage: Optional[str]
-    sourcefile: Optional[str]
-    oids: Optional[List[str]]
-    groups: Optional[List[str]]
-    captions: List[QueryCaptionResult]
-    score: Optional[float] = None
-    reranker_score: Optional[float] = None
+    """
+    A search result. Uses __slots__ rather than a dataclass, which keeps each of the top results small
+    on Python 3.9 (dataclass slots need 3.10), and is only converted to its JSON form by serialize_for_results
+    when a response that includes it is sent, see core.streaming.serialize_default.
+    """
+
+    __slots__ = (
+        "id",
+        "content",
+        "embedding",
+        "image_embedding",
+        "category",
+        "sourcepage",
+        "sourcefile",
+        "oids",
+        "groups",
+        "captions",
+        "score",
+        "reranker_score",
+    )
+
+    def __init__(
+        self,
+        id: Optional[str],
+        content: Optional[str],
+        embedding: Optional[List[float]],
+        image_embedding: Optional[List[float]],
+        category: Optional[str],
+        sourcepage: Optional[str],
+        sourcefile: Optional[str],
+        oids: Optional[List[str]],
+        groups: Optional[List[str]],
+        captions: List[QueryCaptionResult],
+        score: Optional[float] = None,
+        reranker_score: Optional[float] = None,
+    ):
+        self.id = id
+        self.content = content
+        self.embedding = embedding
+        self.image_embedding = image_embedding
+        self.category = category
+        self.sourcepage = sourcepage
+        self.sourcefile = sourcefile
+        self.oids = oids
+        self.groups = groups
+        self.captions = captions
+        self.score = score
+        self.reranker_score = reranker_score
+
+    def __repr__(self) -> str:
+        return f"Document(id={self.id!r}, sourcepage={self.sourcepage!r}, score={self.score!r})"
 
     def serialize_for_results(self) -> dict[str, Any]:
         return {
@@ -96,6 +143,46 @@ class Approach(ABC):
     # Useful for using local small language models, for example
     ALLOW_NON_GPT_MODELS = True
 
+    # Set by approaches that are given a cache, so repeated queries don't call the embeddings API again
+    embedding_cache: Optional[QueryEmbeddingCache] = None
+
+    # Set by approaches that reuse answers to questions similar to ones they already answered
+    answer_cache: Optional[SemanticAnswerCache] = None
+
+    # Seconds allowed for the query embedding of each vector field, after which the search goes on without that field
+    vector_field_timeouts: dict[str, float] = {"embedding": 10, "imageEmbedding": 10}
+
+    # Set by approaches that are given the app's pooled HTTP session, otherwise each call opens its own connection
+    http_session: Optional[aiohttp.ClientSession] = None
+
+    # Set by approaches that meter their chat completions against the app's OpenAI budget
+    admission_controller: Optional[AdmissionController] = None
+
+    # Overrides that change the answer, besides the filter overrides that are covered by the filter itself
+    answer_cache_override_keys: List[str] = [
+        "retrieval_mode",
+        "semantic_ranker",
+        "semantic_captions",
+        "top",
+        "minimum_search_score",
+        "minimum_reranker_score",
+        "temperature",
+        "seed",
+        "prompt_template",
+        "suggest_followup_questions",
+    ]
+
+    # Thought steps that show the question or the prompts of the user who asked it, left out of shared answers
+    per_user_thoughts: set[str] = {
+        "Prompt to generate search query",
+        "Search using generated search query",
+        "Search using user query",
+        "Prompt to generate answer",
+    }
+
+    # Fields returned for each search result, the vector fields are only returned when asked for
+    search_select_fields: List[str] = ["id", "content", "category", "sourcepage", "sourcefile"]
+
     def __init__(
         self,
         search_client: SearchClient,
@@ -135,6 +222,110 @@ class Approach(ABC):
             filters.append(security_filter)
         return None if len(filters) == 0 else " and ".join(filters)
 
+    def get_answer_cache_scope(self, overrides: dict[str, Any], auth_claims: dict[str, Any]) -> Optional[str]:
+        # Answers are looked up by the embedding of the question, which text search alone would not need
+        if self.answer_cache is None or overrides.get("retrieval_mode") == "text":
+            return None
+        # Users whose searches have the same security filter see the same documents, so they can share answers
+        return self.answer_cache.scope(
+            type(self).__name__,
+            self.build_filter(overrides, auth_claims),
+            {key: overrides[key] for key in self.answer_cache_override_keys if key in overrides},
+        )
+
+    def degrade_search(
+        self,
+        deadline: RequestDeadline,
+        use_text_search: bool,
+        use_vector_search: bool,
+        use_semantic_ranker: bool,
+        use_semantic_captions: bool,
+        minimum_reranker_score: float,
+    ) -> tuple[bool, bool, bool, float]:
+        """
+        Drops the vector search (as long as text search is left) and then the semantic ranker, with its captions
+        and minimum reranker score, when there is too little time left before the request deadline for them.
+        """
+        if use_vector_search and use_text_search and deadline.degrade("vector_search"):
+            use_vector_search = False
+        if use_semantic_ranker and deadline.degrade("semantic_ranker"):
+            return use_vector_search, False, False, 0.0
+        return use_vector_search, use_semantic_ranker, use_semantic_captions, minimum_reranker_score
+
+    def get_deadline_thoughts(self, deadline: RequestDeadline) -> list[ThoughtStep]:
+        if not deadline.degradations:
+            return []
+        return [
+            ThoughtStep(
+                "Steps skipped to answer within the request deadline",
+                deadline.degradations,
+                {"deadline_seconds": deadline.seconds},
+            )
+        ]
+
+    async def admit_chat_completion(
+        self,
+        model: str,
+        messages: list[ChatCompletionMessageParam],
+        max_tokens: int,
+        tools: Optional[list[ChatCompletionToolParam]] = None,
+        deadline: Optional[RequestDeadline] = None,
+    ):
+        """
+        Waits for the admission controller, if any, to have budget for a chat completion of these messages.
+        The wait doesn't count against the deadline of the request.
+        """
+        if self.admission_controller is None:
+            return
+        prompt_tokens = count_prompt_tokens(model, messages, tools=tools, fallback_to_default=self.ALLOW_NON_GPT_MODELS)
+        async with (deadline or RequestDeadline()).paused():
+            await self.admission_controller.admit(prompt_tokens + max_tokens)
+
+    async def lookup_cached_answer(
+        self, question: str, scope: str, deadline: RequestDeadline
+    ) -> tuple[VectorizedQuery, Optional[AnswerCacheMatch]]:
+        """
+        Looks up an answer to a question similar to this one.
+        Returns the embedding of the question too, which the search reuses when no answer was found.
+        """
+        answer_cache = cast(SemanticAnswerCache, self.answer_cache)
+        answer_cache.schedule_index_check()
+        question_embedding = await deadline.run("embedding", self.compute_text_embedding(question))
+        return question_embedding, answer_cache.lookup(scope, question_embedding.vector)
+
+    def get_answer_cache_context(self, extra_info: dict[str, Any]) -> dict[str, Any]:
+        """
+        Returns the context to store with an answer, without the follow-up questions, which are stored on their own,
+        and without the question and prompts of the user who asked it, as the answer is shared with other users.
+        """
+        context = {key: value for key, value in extra_info.items() if key != "followup_questions"}
+        context["thoughts"] = [
+            ThoughtStep(thought.title, None, thought.props) if thought.title in self.per_user_thoughts else thought
+            for thought in extra_info.get("thoughts", [])
+        ]
+        return context
+
+    def get_cached_answer_context(self, match: AnswerCacheMatch) -> dict[str, Any]:
+        cache_step = ThoughtStep(
+            "Answer reused from a similar question",
+            None,
+            {
+                "similarity": round(match.similarity, 4),
+                "age_seconds": round(time.time() - match.answer.created_at),
+            },
+        )
+        return {**match.answer.context, "thoughts": [cache_step, *match.answer.context.get("thoughts", [])]}
+
+    def get_search_select(self, search_vectors: List[VectorQuery], include_vectors: bool) -> List[str]:
+        select = list(self.search_select_fields)
+        if self.auth_helper and self.auth_helper.has_auth_fields:
+            select += ["oids", "groups"]
+        if include_vectors:
+            # Only the fields that were searched are known to exist in the index
+            for vector in search_vectors:
+                select += [field for field in (vector.fields or "").split(",") if field and field not in select]
+        return select
+
     async def search(
         self,
         top: int,
@@ -147,14 +338,18 @@ class Approach(ABC):
         use_semantic_captions: bool,
         minimum_search_score: Optional[float],
         minimum_reranker_score: Optional[float],
+        include_vectors: bool = False,
     ) -> List[Document]:
         search_text = query_text if use_text_search else ""
         search_vectors = vectors if use_vector_search else []
+        # Without a select, every result carries its full embeddings, which are tens of KB of JSON per hit
+        select = self.get_search_select(search_vectors, include_vectors)
         if use_semantic_ranker:
             results = await self.search_client.search(
                 search_text=search_text,
                 filter=filter,
                 top=top,
+                select=select,
                 query_caption="extractive|highlight-false" if use_semantic_captions else None,
                 vector_queries=search_vectors,
                 query_type=QueryType.SEMANTIC,
@@ -168,13 +363,21 @@ class Approach(ABC):
                 search_text=search_text,
                 filter=filter,
                 top=top,
+                select=select,
                 vector_queries=search_vectors,
             )
 
-        documents = []
+        minimum_search_score = minimum_search_score or 0
+        minimum_reranker_score = minimum_reranker_score or 0
+        qualified_documents = []
         async for page in results.by_page():
             async for document in page:
-                documents.append(
+                score = document.get("@search.score")
+                reranker_score = document.get("@search.reranker_score")
+                # Filters in the same pass, so results below the minimum scores are never turned into Documents
+                if (score or 0) < minimum_search_score or (reranker_score or 0) < minimum_reranker_score:
+                    continue
+                qualified_documents.append(
                     Document(
                         id=document.get("id"),
                         content=document.get("content"),
@@ -186,20 +389,11 @@ class Approach(ABC):
                         oids=document.get("oids"),
                         groups=document.get("groups"),
                         captions=cast(List[QueryCaptionResult], document.get("@search.captions")),
-                        score=document.get("@search.score"),
-                        reranker_score=document.get("@search.reranker_score"),
+                        score=score,
+                        reranker_score=reranker_score,
                     )
                 )
 
-            qualified_documents = [
-                doc
-                for doc in documents
-                if (
-                    (doc.score or 0) >= (minimum_search_score or 0)
-                    and (doc.reranker_score or 0) >= (minimum_reranker_score or 0)
-                )
-            ]
-
         return qualified_documents
 
     def get_sources_content(
@@ -243,6 +437,10 @@ class Approach(ABC):
         dimensions_args: ExtraArgs = (
             {"dimensions": self.embedding_dimensions} if SUPPORTED_DIMENSIONS_MODEL[self.embedding_model] else {}
         )
+        if self.embedding_cache:
+            cached_vector = await self.embedding_cache.get(self.embedding_model, dimensions_args.get("dimensions"), q)
+            if cached_vector is not None:
+                return VectorizedQuery(vector=cached_vector, k_nearest_neighbors=50, fields="embedding")
         embedding = await self.openai_client.embeddings.create(
             # Azure OpenAI takes the deployment name as the model name
             model=self.embedding_deployment if self.embedding_deployment else self.embedding_model,
@@ -250,6 +448,8 @@ class Approach(ABC):
             **dimensions_args,
         )
         query_vector = embedding.data[0].embedding
+        if self.embedding_cache:
+            await self.embedding_cache.set(self.embedding_model, dimensions_args.get("dimensions"), q, query_vector)
         return VectorizedQuery(vector=query_vector, k_nearest_neighbors=50, fields="embedding")
 
     async def compute_image_embedding(self, q: str):
@@ -260,7 +460,10 @@ class Approach(ABC):
 
         headers["Authorization"] = "Bearer " + await self.vision_token_provider()
 
-        async with aiohttp.ClientSession() as session:
+        async with AsyncExitStack() as stack:
+            session = (
+                self.http_session if self.http_session else await stack.enter_async_context(aiohttp.ClientSession())
+            )
             async with session.post(
                 url=endpoint, params=params, headers=headers, json=data, raise_for_status=True
             ) as response:
@@ -268,6 +471,33 @@ class Approach(ABC):
                 image_query_vector = json["vector"]
         return VectorizedQuery(vector=image_query_vector, k_nearest_neighbors=50, fields="imageEmbedding")
 
+    async def compute_multi_vectors(
+        self, q: str, vector_fields: list[str], use_text_search: bool
+    ) -> tuple[list[VectorQuery], dict[str, dict[str, Any]]]:
+        """
+        Computes the query embedding of every vector field concurrently, each within its own timeout.
+        Fields whose embedding fails are left out of the search, unless no vector and no text search would be left.
+        Returns the vectors and the duration and status of each field.
+        """
+
+        async def compute_field(field: str) -> tuple[Optional[VectorQuery], dict[str, Any], Optional[Exception]]:
+            start = time.perf_counter()
+            compute_embedding = self.compute_text_embedding if field == "embedding" else self.compute_image_embedding
+            try:
+                vector = await asyncio.wait_for(compute_embedding(q), timeout=self.vector_field_timeouts.get(field))
+            except Exception as error:
+                logging.warning("Failed to compute the %s query vector, searching without it: %r", field, error)
+                status = "timeout" if isinstance(error, asyncio.TimeoutError) else "failed"
+                return None, {"status": status, "duration_ms": round((time.perf_counter() - start) * 1000)}, error
+            return vector, {"status": "ok", "duration_ms": round((time.perf_counter() - start) * 1000)}, None
+
+        results = await asyncio.gather(*(compute_field(field) for field in vector_fields))
+        vectors = [vector for vector, _, _ in results if vector is not None]
+        errors = [error for _, _, error in results if error is not None]
+        if errors and not vectors and not use_text_search:
+            raise errors[0]
+        return vectors, {field: timing for field, (_, timing, _) in zip(vector_fields, results)}
+
     async def run(
         self,
         messages: list[ChatCompletionMessageParam],
@@ -1,11 +1,80 @@
+import asyncio
 import json
-import re
+import logging
 from abc import ABC, abstractmethod
-from typing import Any, AsyncGenerator, Optional
+from typing import Any, AsyncGenerator, Optional, cast
 
 from openai.types.chat import ChatCompletion, ChatCompletionMessageParam
 
 from approaches.approach import Approach
+from core.cancellation import cancellation_stats
+from core.deadline import DeadlineExceededError, RequestDeadline
+from core.messagebuilder import count_text_tokens
+from core.promptusage import prompt_usage_stats
+
+
+class FollowupQuestionParser:
+    """
+    Splits a chat answer into the answer text and the <<follow-up questions>> that the model appends to it,
+    one chunk at a time, so that delimiters split across streamed chunks are still recognized.
+    Each chunk is scanned once, so the work per chunk is proportional to its length.
+    A question that contains a single ">" is dropped, as it would not match <<([^>>]+)>> either.
+    """
+
+    def __init__(self):
+        self.questions: list[str] = []
+        self.started = False
+        self._in_question = False
+        self._question_parts: list[str] = []
+        # A trailing "<" or ">" that may be the first half of a delimiter in the next chunk
+        self._pending = ""
+
+    def feed(self, chunk: str) -> tuple[str, list[str]]:
+        """Returns the answer text that is safe to emit and the questions completed by this chunk."""
+        text = self._pending + chunk
+        self._pending = ""
+        answer = ""
+        completed: list[str] = []
+        pos = 0
+        while pos < len(text):
+            if not self._in_question:
+                start = text.find("<<", pos)
+                if start == -1:
+                    end = len(text) - 1 if text.endswith("<") else len(text)
+                    if not self.started:
+                        answer += text[pos:end]
+                    self._pending = text[end:]
+                    break
+                if not self.started:
+                    answer += text[pos:start]
+                    self.started = True
+                self._in_question = True
+                pos = start + 2
+            else:
+                end = text.find(">", pos)
+                if end == -1:
+                    self._question_parts.append(text[pos:])
+                    break
+                self._question_parts.append(text[pos:end])
+                if end + 1 == len(text):
+                    self._pending = ">"
+                    break
+                self._in_question = False
+                question = "".join(self._question_parts)
+                self._question_parts.clear()
+                if text[end + 1] == ">":
+                    if question:
+                        self.questions.append(question)
+                        completed.append(question)
+                    pos = end + 2
+                else:
+                    pos = end + 1
+        return answer, completed
+
+    def close(self) -> str:
+        """Returns the answer text held back at the end of the stream."""
+        pending, self._pending = self._pending, ""
+        return "" if self.started else pending
 
 
 class ChatApproach(Approach, ABC):
@@ -20,6 +89,15 @@ class ChatApproach(Approach, ABC):
     follow_up_questions_prompt_content = """Jako Asystent pracownika firmy Sklepy Komfort, pomóż pracownikowi w sposób profesjonalny i spokojny. W przypadku identyfikacji pytania w innym języku niż polski, przetłumacz na polski.
     """
 
+    # System prompts rendered once per follow-up questions variant, see render_system_prompts
+    system_prompts: dict[str, str] = {}
+
+    # max_tokens of the answer, the part of it left ungenerated when a stream is cancelled is counted as saved
+    response_token_limit = 1024
+
+    # The model that generates the answers, whose tokenizer counts the tokens of a cancelled answer
+    answer_model: str
+
     query_prompt_template = """Jako Asystent pracownika firmy Sklepy Komfort, pomóż pracownikowi w sposób profesjonalny i spokojny. W przypadku identyfikacji pytania w innym języku niż polski, przetłumacz na polski.
     """
 
@@ -29,11 +107,27 @@ class ChatApproach(Approach, ABC):
         pass
 
     @abstractmethod
-    async def run_until_final_call(self, messages, overrides, auth_claims, should_stream) -> tuple:
+    async def run_until_final_call(
+        self, messages, overrides, auth_claims, should_stream, deadline=None, question_embedding=None
+    ) -> tuple:
         pass
 
+    def render_system_prompts(self):
+        """
+        Renders the default system prompt with and without the follow-up questions instructions ahead of time,
+        so that every request starts with a byte-identical prefix that the provider-side prompt cache can reuse.
+        """
+        self.system_prompts = {
+            follow_up_questions_prompt: self.system_message_chat_conversation.format(
+                injected_prompt="", follow_up_questions_prompt=follow_up_questions_prompt
+            )
+            for follow_up_questions_prompt in ("", self.follow_up_questions_prompt_content)
+        }
+
     def get_system_prompt(self, override_prompt: Optional[str], follow_up_questions_prompt: str) -> str:
         if override_prompt is None:
+            if system_prompt := self.system_prompts.get(follow_up_questions_prompt):
+                return system_prompt
             return self.system_message_chat_conversation.format(
                 injected_prompt="", follow_up_questions_prompt=follow_up_questions_prompt
             )
@@ -62,10 +156,20 @@ class ChatApproach(Approach, ABC):
                 return query_text
         return user_query
 
+    def get_chat_answer_cache_scope(
+        self, messages: list[ChatCompletionMessageParam], overrides: dict[str, Any], auth_claims: dict[str, Any]
+    ) -> Optional[str]:
+        # Answers to later turns depend on the conversation history, so only first turns are cached
+        if len(messages) != 1 or not isinstance(messages[0]["content"], str):
+            return None
+        return self.get_answer_cache_scope(overrides, auth_claims)
+
     def extract_followup_questions(self, content: Optional[str]):
         if content is None:
             return content, []
-        return content.split("<<")[0], re.findall(r"<<([^>>]+)>>", content)
+        parser = FollowupQuestionParser()
+        answer, _ = parser.feed(content)
+        return answer + parser.close(), parser.questions
 
     async def run_without_streaming(
         self,
@@ -73,16 +177,55 @@ class ChatApproach(Approach, ABC):
         overrides: dict[str, Any],
         auth_claims: dict[str, Any],
         session_state: Any = None,
+        deadline: Optional[RequestDeadline] = None,
     ) -> dict[str, Any]:
+        deadline = deadline or RequestDeadline()
+        answer_cache_scope = self.get_chat_answer_cache_scope(messages, overrides, auth_claims)
+        question_embedding = None
+        if answer_cache_scope:
+            question = cast(str, messages[0]["content"])
+            question_embedding, match = await self.lookup_cached_answer(question, answer_cache_scope, deadline)
+            if match:
+                context = self.get_cached_answer_context(match)
+                if match.answer.followup_questions is not None:
+                    context["followup_questions"] = match.answer.followup_questions
+                return {
+                    "message": {"content": match.answer.content, "role": "assistant"},
+                    "context": context,
+                    "session_state": session_state,
+                }
+
         extra_info, chat_coroutine = await self.run_until_final_call(
-            messages, overrides, auth_claims, should_stream=False
+            messages,
+            overrides,
+            auth_claims,
+            should_stream=False,
+            deadline=deadline,
+            question_embedding=question_embedding,
         )
         chat_completion_response: ChatCompletion = await chat_coroutine
+        prompt_usage_stats.record(chat_completion_response.usage)
         content = chat_completion_response.choices[0].message.content
         role = chat_completion_response.choices[0].message.role
         if overrides.get("suggest_followup_questions"):
             content, followup_questions = self.extract_followup_questions(content)
             extra_info["followup_questions"] = followup_questions
+        # An answer from a search that was cut short to meet the deadline isn't reused for other questions
+        if (
+            self.answer_cache
+            and answer_cache_scope
+            and question_embedding
+            and content
+            and not deadline.degradations
+        ):
+            self.answer_cache.store(
+                answer_cache_scope,
+                question,
+                question_embedding.vector,
+                content,
+                self.get_answer_cache_context(extra_info),
+                extra_info.get("followup_questions"),
+            )
         chat_app_response = {
             "message": {"content": content, "role": role},
             "context": extra_info,
@@ -90,47 +233,134 @@ class ChatApproach(Approach, ABC):
         }
         return chat_app_response
 
+    def record_cancelled_stream(self, streamed_content: str):
+        try:
+            streamed_tokens = count_text_tokens(self.answer_model, streamed_content, self.ALLOW_NON_GPT_MODELS)
+        except Exception:
+            logging.warning("Could not count the tokens of a cancelled answer", exc_info=True)
+            return
+        cancellation_stats.record_stream(streamed_tokens, self.response_token_limit)
+
     async def run_with_streaming(
         self,
         messages: list[ChatCompletionMessageParam],
         overrides: dict[str, Any],
         auth_claims: dict[str, Any],
         session_state: Any = None,
+        deadline: Optional[RequestDeadline] = None,
     ) -> AsyncGenerator[dict, None]:
+        deadline = deadline or RequestDeadline()
+        answer_cache_scope = self.get_chat_answer_cache_scope(messages, overrides, auth_claims)
+        question_embedding = None
+        if answer_cache_scope:
+            question = cast(str, messages[0]["content"])
+            question_embedding, match = await self.lookup_cached_answer(question, answer_cache_scope, deadline)
+            if match:
+                # Replays the answer in the same frames as a live stream, with the whole content in one delta
+                yield {
+                    "delta": {"role": "assistant"},
+                    "context": self.get_cached_answer_context(match),
+                    "session_state": session_state,
+                }
+                yield {"delta": {"content": match.answer.content, "role": "assistant"}}
+                if match.answer.followup_questions:
+                    yield {
+                        "delta": {"role": "assistant"},
+                        "context": {"followup_questions": match.answer.followup_questions},
+                    }
+                return
+
         extra_info, chat_coroutine = await self.run_until_final_call(
-            messages, overrides, auth_claims, should_stream=True
+            messages,
+            overrides,
+            auth_claims,
+            should_stream=True,
+            deadline=deadline,
+            question_embedding=question_embedding,
         )
         yield {"delta": {"role": "assistant"}, "context": extra_info, "session_state": session_state}
 
-        followup_questions_started = False
-        followup_content = ""
-        async for event_chunk in await chat_coroutine:
-            # "2023-07-01-preview" API version has a bug where first response has empty choices
-            event = event_chunk.model_dump()  # Convert pydantic model to dict
-            if event["choices"]:
-                completion = {
-                    "delta": {
-                        "content": event["choices"][0]["delta"].get("content"),
-                        "role": event["choices"][0]["delta"]["role"],
-                    }
-                }
-                # if event contains << and not >>, it is start of follow-up question, truncate
-                content = completion["delta"].get("content")
-                content = content or ""  # content may either not exist in delta, or explicitly be None
-                if overrides.get("suggest_followup_questions") and "<<" in content:
-                    followup_questions_started = True
-                    earlier_content = content[: content.index("<<")]
-                    if earlier_content:
-                        completion["delta"]["content"] = earlier_content
+        followup_parser = FollowupQuestionParser() if overrides.get("suggest_followup_questions") else None
+        answer_parts: list[str] = []
+        chat_stream = await chat_coroutine
+        # A chunk can hold several tokens, so the content is kept to be tokenized if the stream is cancelled
+        streamed_content: list[str] = []
+        try:
+            # The deadline bounds the wait for the first chunk, so a stream that never starts fails instead of hanging,
+            # and is then checked between chunks, as a timeout for each chunk would cost a task and a timer per token
+            waiting_for_first_chunk = True
+            while True:
+                try:
+                    if waiting_for_first_chunk:
+                        event_chunk = await deadline.run("answer", chat_stream.__anext__())
+                        waiting_for_first_chunk = False
+                    else:
+                        event_chunk = await chat_stream.__anext__()
+                except StopAsyncIteration:
+                    break
+                if deadline.remaining() <= 0:
+                    raise DeadlineExceededError("answer")
+                # With include_usage, the last chunk has the usage of the whole completion and no choices
+                if usage := getattr(event_chunk, "usage", None):
+                    prompt_usage_stats.record(usage)
+                # "2023-07-01-preview" API version has a bug where first response has empty choices
+                if event_chunk.choices:
+                    # Reads the delta attributes directly, a full model_dump of every chunk is too slow per token
+                    delta = event_chunk.choices[0].delta
+                    completion = {"delta": {"content": delta.content, "role": delta.role}}
+                    content = delta.content or ""  # content may either not exist in delta, or explicitly be None
+                    streamed_content.append(content)
+                    if followup_parser is None:
+                        answer_parts.append(content)
                         yield completion
-                    followup_content += content[content.index("<<") :]
-                elif followup_questions_started:
-                    followup_content += content
-                else:
-                    yield completion
-        if followup_content:
-            _, followup_questions = self.extract_followup_questions(followup_content)
-            yield {"delta": {"role": "assistant"}, "context": {"followup_questions": followup_questions}}
+                        continue
+                    if not content:
+                        if not followup_parser.started:
+                            yield completion
+                        continue
+                    # Only the text before the first << is part of the answer, questions are sent as soon as they end
+                    answer, completed_questions = followup_parser.feed(content)
+                    if answer:
+                        completion["delta"]["content"] = answer
+                        answer_parts.append(answer)
+                        yield completion
+                    if completed_questions:
+                        yield {
+                            "delta": {"role": "assistant"},
+                            "context": {"followup_questions": list(followup_parser.questions)},
+                        }
+        except (asyncio.CancelledError, GeneratorExit):
+            # The client went away, so the rest of the answer would be generated (and billed) for nobody
+            self.record_cancelled_stream("".join(streamed_content))
+            raise
+        finally:
+            # Closes the connection to OpenAI, which stops the generation, instead of leaving it to the garbage collector
+            await chat_stream.close()
+
+        followup_questions = None
+        if followup_parser is not None:
+            if remaining_answer := followup_parser.close():
+                answer_parts.append(remaining_answer)
+                yield {"delta": {"content": remaining_answer, "role": "assistant"}}
+            if followup_parser.started and not followup_parser.questions:
+                yield {"delta": {"role": "assistant"}, "context": {"followup_questions": []}}
+            followup_questions = followup_parser.questions
+        answer_content = "".join(answer_parts)
+        if (
+            self.answer_cache
+            and answer_cache_scope
+            and question_embedding
+            and answer_content
+            and not deadline.degradations
+        ):
+            self.answer_cache.store(
+                answer_cache_scope,
+                question,
+                question_embedding.vector,
+                answer_content,
+                self.get_answer_cache_context(extra_info),
+                followup_questions,
+            )
 
     async def run(
         self,
@@ -140,7 +370,9 @@ class ChatApproach(Approach, ABC):
     ) -> dict[str, Any]:
         overrides = context.get("overrides", {})
         auth_claims = context.get("auth_claims", {})
-        return await self.run_without_streaming(messages, overrides, auth_claims, session_state)
+        return await self.run_without_streaming(
+            messages, overrides, auth_claims, session_state, deadline=context.get("deadline")
+        )
 
     async def run_stream(
         self,
@@ -150,4 +382,6 @@ class ChatApproach(Approach, ABC):
     ) -> AsyncGenerator[dict[str, Any], None]:
         overrides = context.get("overrides", {})
         auth_claims = context.get("auth_claims", {})
-        return self.run_with_streaming(messages, overrides, auth_claims, session_state)
+        return self.run_with_streaming(
+            messages, overrides, auth_claims, session_state, deadline=context.get("deadline")
+        )
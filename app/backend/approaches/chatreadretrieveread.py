@@ -1,19 +1,27 @@
+import asyncio
+import time
 from typing import Any, Coroutine, List, Literal, Optional, Union, overload
 
 from azure.search.documents.aio import SearchClient
 from azure.search.documents.models import VectorQuery
-from openai import AsyncOpenAI, AsyncStream
+from openai import NOT_GIVEN, AsyncOpenAI, AsyncStream
 from openai.types.chat import (
     ChatCompletion,
     ChatCompletionChunk,
     ChatCompletionMessageParam,
     ChatCompletionToolParam,
 )
-from openai_messages_token_helper import build_messages, get_token_limit
+from openai_messages_token_helper import get_token_limit
 
 from approaches.approach import ThoughtStep
 from approaches.chatapproach import ChatApproach
+from core.admission import AdmissionController
+from core.answercache import SemanticAnswerCache
 from core.authentication import AuthenticationHelper
+from core.deadline import RequestDeadline
+from core.embeddingcache import QueryEmbeddingCache
+from core.messagebuilder import build_messages, precount_messages
+from core.promptusage import prompt_usage_stats
 
 
 class ChatReadRetrieveReadApproach(ChatApproach):
@@ -23,6 +31,26 @@ class ChatReadRetrieveReadApproach(ChatApproach):
     original user question, and search results to OpenAI to generate a response.
     """
 
+    query_tools: List[ChatCompletionToolParam] = [
+        {
+            "type": "function",
+            "function": {
+                "name": "search_sources",
+                "description": "Retrieve sources from the Azure AI Search index",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "search_query": {
+                            "type": "string",
+                            "description": "Query string to retrieve documents from azure search eg: 'Health care plan'",
+                        }
+                    },
+                    "required": ["search_query"],
+                },
+            },
+        }
+    ]
+
     def __init__(
         self,
         *,
@@ -38,11 +66,17 @@ class ChatReadRetrieveReadApproach(ChatApproach):
         content_field: str,
         query_language: str,
         query_speller: str,
+        speculative_query_embedding: bool = False,
+        embedding_cache: Optional[QueryEmbeddingCache] = None,
+        answer_cache: Optional[SemanticAnswerCache] = None,
+        include_stream_usage: bool = False,
+        admission_controller: Optional[AdmissionController] = None,
     ):
         self.search_client = search_client
         self.openai_client = openai_client
         self.auth_helper = auth_helper
         self.chatgpt_model = chatgpt_model
+        self.answer_model = chatgpt_model
         self.chatgpt_deployment = chatgpt_deployment
         self.embedding_deployment = embedding_deployment
         self.embedding_model = embedding_model
@@ -51,7 +85,24 @@ class ChatReadRetrieveReadApproach(ChatApproach):
         self.content_field = content_field
         self.query_language = query_language
         self.query_speller = query_speller
+        self.embedding_cache = embedding_cache
+        self.admission_controller = admission_controller
+        self.answer_cache = answer_cache
+        self.include_stream_usage = include_stream_usage
+        # Embed first-turn questions while the query rewrite is in flight, since the rewrite often keeps them as is
+        self.speculative_query_embedding = speculative_query_embedding
         self.chatgpt_token_limit = get_token_limit(chatgpt_model, default_to_minimum=self.ALLOW_NON_GPT_MODELS)
+        # The prompts below are the same on every turn, so they are tokenized once here instead of per request
+        precount_messages(
+            chatgpt_model,
+            self.query_prompt_template,
+            tools=self.query_tools,
+            few_shots=self.query_prompt_few_shots,
+            fallback_to_default=self.ALLOW_NON_GPT_MODELS,
+        )
+        self.render_system_prompts()
+        for system_prompt in self.system_prompts.values():
+            precount_messages(chatgpt_model, system_prompt, fallback_to_default=self.ALLOW_NON_GPT_MODELS)
 
     @property
     def system_message_chat_conversation(self):
@@ -136,6 +187,8 @@ class ChatReadRetrieveReadApproach(ChatApproach):
         overrides: dict[str, Any],
         auth_claims: dict[str, Any],
         should_stream: Literal[False],
+        deadline: Optional[RequestDeadline] = None,
+        question_embedding: Optional[VectorQuery] = None,
     ) -> tuple[dict[str, Any], Coroutine[Any, Any, ChatCompletion]]: ...
 
     @overload
@@ -145,6 +198,8 @@ class ChatReadRetrieveReadApproach(ChatApproach):
         overrides: dict[str, Any],
         auth_claims: dict[str, Any],
         should_stream: Literal[True],
+        deadline: Optional[RequestDeadline] = None,
+        question_embedding: Optional[VectorQuery] = None,
     ) -> tuple[dict[str, Any], Coroutine[Any, Any, AsyncStream[ChatCompletionChunk]]]: ...
 
     async def run_until_final_call(
@@ -153,7 +208,10 @@ class ChatReadRetrieveReadApproach(ChatApproach):
         overrides: dict[str, Any],
         auth_claims: dict[str, Any],
         should_stream: bool = False,
+        deadline: Optional[RequestDeadline] = None,
+        question_embedding: Optional[VectorQuery] = None,
     ) -> tuple[dict[str, Any], Coroutine[Any, Any, Union[ChatCompletion, AsyncStream[ChatCompletionChunk]]]]:
+        deadline = deadline or RequestDeadline()
         seed = overrides.get("seed", None)
         use_text_search = overrides.get("retrieval_mode") in ["text", "hybrid", None]
         use_vector_search = overrides.get("retrieval_mode") in ["vectors", "hybrid", None]
@@ -169,32 +227,12 @@ class ChatReadRetrieveReadApproach(ChatApproach):
             raise ValueError("The most recent message content must be a string.")
         user_query_request = "Generate search query for: " + original_user_query
 
-        tools: List[ChatCompletionToolParam] = [
-            {
-                "type": "function",
-                "function": {
-                    "name": "search_sources",
-                    "description": "Retrieve sources from the Azure AI Search index",
-                    "parameters": {
-                        "type": "object",
-                        "properties": {
-                            "search_query": {
-                                "type": "string",
-                                "description": "Query string to retrieve documents from azure search eg: 'Health care plan'",
-                            }
-                        },
-                        "required": ["search_query"],
-                    },
-                },
-            }
-        ]
-
         # STEP 1: Generate an optimized keyword search query based on the chat history and the last question
         query_response_token_limit = 100
         query_messages = build_messages(
             model=self.chatgpt_model,
             system_prompt=self.query_prompt_template,
-            tools=tools,
+            tools=self.query_tools,
             few_shots=self.query_prompt_few_shots,
             past_messages=messages[:-1],
             new_user_content=user_query_request,
@@ -202,39 +240,106 @@ class ChatReadRetrieveReadApproach(ChatApproach):
             fallback_to_default=self.ALLOW_NON_GPT_MODELS,
         )
 
-        chat_completion: ChatCompletion = await self.openai_client.chat.completions.create(
-            messages=query_messages,  # type: ignore
-            # Azure OpenAI takes the deployment name as the model name
-            model=self.chatgpt_deployment if self.chatgpt_deployment else self.chatgpt_model,
-            temperature=0.0,  # Minimize creativity for search query generation
-            max_tokens=query_response_token_limit,  # Setting too low risks malformed JSON, setting too high may affect performance
-            n=1,
-            tools=tools,
-            seed=seed,
-        )
+        # With little time left, the question is searched as is
+        skip_query_rewrite = deadline.degrade("query_rewrite")
+
+        # Follow-up questions are usually rewritten to resolve references to the history, so only first turns speculate
+        speculative_embedding: Optional[asyncio.Task[VectorQuery]] = None
+        if (
+            self.speculative_query_embedding
+            and question_embedding is None
+            and use_vector_search
+            and len(messages) == 1
+            and not skip_query_rewrite
+        ):
+            speculative_embedding = asyncio.create_task(self.compute_text_embedding(original_user_query))
+            # Retrieve the exception of a discarded embedding so it isn't reported as never retrieved
+            speculative_embedding.add_done_callback(lambda task: task.cancelled() or task.exception())
+
+        query_rewrite_duration = 0.0
+        if skip_query_rewrite:
+            query_text = original_user_query
+        else:
+            try:
+                await self.admit_chat_completion(
+                    self.chatgpt_model,
+                    query_messages,
+                    query_response_token_limit,
+                    tools=self.query_tools,
+                    deadline=deadline,
+                )
+                step_start = time.perf_counter()
+                chat_completion: ChatCompletion = await deadline.run(
+                    "query rewrite",
+                    self.openai_client.chat.completions.create(
+                        messages=query_messages,  # type: ignore
+                        # Azure OpenAI takes the deployment name as the model name
+                        model=self.chatgpt_deployment if self.chatgpt_deployment else self.chatgpt_model,
+                        temperature=0.0,  # Minimize creativity for search query generation
+                        max_tokens=query_response_token_limit,  # Setting too low risks malformed JSON, setting too high may affect performance
+                        n=1,
+                        tools=self.query_tools,
+                        seed=seed,
+                    ),
+                )
+            except BaseException:
+                if speculative_embedding:
+                    speculative_embedding.cancel()
+                raise
+            query_rewrite_duration = time.perf_counter() - step_start
+            prompt_usage_stats.record(chat_completion.usage)
 
-        query_text = self.get_search_query(chat_completion, original_user_query)
+            query_text = self.get_search_query(chat_completion, original_user_query)
 
         # STEP 2: Retrieve relevant documents from the search index with the GPT optimized query
 
-        # If retrieval mode includes vectors, compute an embedding for the query
-        vectors: list[VectorQuery] = []
-        if use_vector_search:
-            vectors.append(await self.compute_text_embedding(query_text))
-
-        results = await self.search(
-            top,
-            query_text,
-            filter,
-            vectors,
+        use_vector_search, use_semantic_ranker, use_semantic_captions, minimum_reranker_score = self.degrade_search(
+            deadline,
             use_text_search,
             use_vector_search,
             use_semantic_ranker,
             use_semantic_captions,
-            minimum_search_score,
             minimum_reranker_score,
         )
 
+        # If retrieval mode includes vectors, compute an embedding for the query
+        vectors: list[VectorQuery] = []
+        speculative_embedding_status = "disabled"
+        step_start = time.perf_counter()
+        query_is_question = " ".join(query_text.split()) == " ".join(original_user_query.split())
+        # The embedding of the question was already computed to look up a cached answer
+        if question_embedding and use_vector_search and query_is_question:
+            vectors.append(question_embedding)
+        if speculative_embedding:
+            if use_vector_search and query_is_question:
+                vectors.append(await deadline.run("embedding", speculative_embedding))
+                speculative_embedding_status = "used"
+            else:
+                speculative_embedding.cancel()
+                speculative_embedding_status = "discarded"
+        if use_vector_search and not vectors:
+            vectors.append(await deadline.run("embedding", self.compute_text_embedding(query_text)))
+        embedding_duration = time.perf_counter() - step_start
+
+        step_start = time.perf_counter()
+        results = await deadline.run(
+            "search",
+            self.search(
+                top,
+                query_text,
+                filter,
+                vectors,
+                use_text_search,
+                use_vector_search,
+                use_semantic_ranker,
+                use_semantic_captions,
+                minimum_search_score,
+                minimum_reranker_score,
+                include_vectors=overrides.get("include_vectors", False),
+            ),
+        )
+        search_duration = time.perf_counter() - step_start
+
         sources_content = self.get_sources_content(results, use_semantic_captions, use_image_citation=False)
         content = "\n".join(sources_content)
 
@@ -246,7 +351,7 @@ class ChatReadRetrieveReadApproach(ChatApproach):
             self.follow_up_questions_prompt_content if overrides.get("suggest_followup_questions") else "",
         )
 
-        response_token_limit = 1024
+        response_token_limit = self.response_token_limit
         messages = build_messages(
             model=self.chatgpt_model,
             system_prompt=system_message,
@@ -259,18 +364,29 @@ class ChatReadRetrieveReadApproach(ChatApproach):
 
         data_points = {"text": sources_content}
 
-        extra_info = {
-            "data_points": data_points,
-            "thoughts": [
+        # A query rewrite that was skipped for the deadline is listed with the skipped steps instead
+        query_rewrite_thoughts: list[ThoughtStep] = []
+        if not skip_query_rewrite:
+            query_rewrite_thoughts.append(
                 ThoughtStep(
                     "Prompt to generate search query",
                     query_messages,
                     (
-                        {"model": self.chatgpt_model, "deployment": self.chatgpt_deployment}
+                        {
+                            "model": self.chatgpt_model,
+                            "deployment": self.chatgpt_deployment,
+                            "duration_ms": round(query_rewrite_duration * 1000),
+                        }
                         if self.chatgpt_deployment
-                        else {"model": self.chatgpt_model}
+                        else {"model": self.chatgpt_model, "duration_ms": round(query_rewrite_duration * 1000)}
                     ),
-                ),
+                )
+            )
+
+        extra_info = {
+            "data_points": data_points,
+            "thoughts": [
+                *query_rewrite_thoughts,
                 ThoughtStep(
                     "Search using generated search query",
                     query_text,
@@ -281,11 +397,15 @@ class ChatReadRetrieveReadApproach(ChatApproach):
                         "filter": filter,
                         "use_vector_search": use_vector_search,
                         "use_text_search": use_text_search,
+                        "speculative_embedding": speculative_embedding_status,
+                        "embedding_duration_ms": round(embedding_duration * 1000),
+                        "search_duration_ms": round(search_duration * 1000),
                     },
                 ),
                 ThoughtStep(
                     "Search results",
-                    [result.serialize_for_results() for result in results],
+                    # Serialized by serialize_for_results when the response is sent
+                    results,
                 ),
                 ThoughtStep(
                     "Prompt to generate answer",
@@ -296,17 +416,24 @@ class ChatReadRetrieveReadApproach(ChatApproach):
                         else {"model": self.chatgpt_model}
                     ),
                 ),
+                *self.get_deadline_thoughts(deadline),
             ],
         }
 
-        chat_coroutine = self.openai_client.chat.completions.create(
-            # Azure OpenAI takes the deployment name as the model name
-            model=self.chatgpt_deployment if self.chatgpt_deployment else self.chatgpt_model,
-            messages=messages,
-            temperature=overrides.get("temperature", 0.3),
-            max_tokens=response_token_limit,
-            n=1,
-            stream=should_stream,
-            seed=seed,
+        await self.admit_chat_completion(self.chatgpt_model, messages, response_token_limit, deadline=deadline)
+        chat_coroutine = deadline.run(
+            "answer",
+            self.openai_client.chat.completions.create(
+                # Azure OpenAI takes the deployment name as the model name
+                model=self.chatgpt_deployment if self.chatgpt_deployment else self.chatgpt_model,
+                messages=messages,
+                temperature=overrides.get("temperature", 0.3),
+                max_tokens=response_token_limit,
+                n=1,
+                stream=should_stream,
+                # Reports the usage, including the cached prompt tokens, in a last chunk of the stream
+                stream_options={"include_usage": True} if should_stream and self.include_stream_usage else NOT_GIVEN,
+                seed=seed,
+            ),
         )
-        return (extra_info, chat_coroutine)
\ No newline at end of file
+        return (extra_info, chat_coroutine)
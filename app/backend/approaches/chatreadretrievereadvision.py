@@ -1,8 +1,10 @@
 from typing import Any, Awaitable, Callable, Coroutine, Optional, Union
 
+import aiohttp
 from azure.search.documents.aio import SearchClient
+from azure.search.documents.models import VectorQuery
 from azure.storage.blob.aio import ContainerClient
-from openai import AsyncOpenAI, AsyncStream
+from openai import NOT_GIVEN, AsyncOpenAI, AsyncStream
 from openai.types.chat import (
     ChatCompletion,
     ChatCompletionChunk,
@@ -10,12 +12,23 @@ from openai.types.chat import (
     ChatCompletionContentPartParam,
     ChatCompletionMessageParam,
 )
-from openai_messages_token_helper import build_messages, get_token_limit
+from openai_messages_token_helper import get_token_limit
 
 from approaches.approach import ThoughtStep
 from approaches.chatapproach import ChatApproach
+from core.admission import AdmissionController
 from core.authentication import AuthenticationHelper
-from core.imageshelper import fetch_image
+from core.deadline import RequestDeadline
+from core.embeddingcache import QueryEmbeddingCache
+from core.imageshelper import (
+    ImageCache,
+    ImageDelivery,
+    fetch_images,
+    redact_image_url,
+    redact_image_urls,
+)
+from core.messagebuilder import build_messages, precount_messages
+from core.promptusage import prompt_usage_stats
 
 
 class ChatReadRetrieveReadVisionApproach(ChatApproach):
@@ -44,7 +57,15 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
         query_language: str,
         query_speller: str,
         vision_endpoint: str,
-        vision_token_provider: Callable[[], Awaitable[str]]
+        vision_token_provider: Callable[[], Awaitable[str]],
+        embedding_cache: Optional[QueryEmbeddingCache] = None,
+        http_session: Optional[aiohttp.ClientSession] = None,
+        vector_field_timeouts: Optional[dict[str, float]] = None,
+        image_cache: Optional[ImageCache] = None,
+        image_fetch_concurrency: int = 4,
+        image_delivery: Optional[ImageDelivery] = None,
+        include_stream_usage: bool = False,
+        admission_controller: Optional[AdmissionController] = None,
     ):
         self.search_client = search_client
         self.blob_container_client = blob_container_client
@@ -54,6 +75,7 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
         self.chatgpt_deployment = chatgpt_deployment
         self.gpt4v_deployment = gpt4v_deployment
         self.gpt4v_model = gpt4v_model
+        self.answer_model = gpt4v_model
         self.embedding_deployment = embedding_deployment
         self.embedding_model = embedding_model
         self.embedding_dimensions = embedding_dimensions
@@ -61,9 +83,23 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
         self.content_field = content_field
         self.query_language = query_language
         self.query_speller = query_speller
+        self.embedding_cache = embedding_cache
+        self.admission_controller = admission_controller
         self.vision_endpoint = vision_endpoint
         self.vision_token_provider = vision_token_provider
+        self.http_session = http_session
+        if vector_field_timeouts:
+            self.vector_field_timeouts = vector_field_timeouts
+        self.image_cache = image_cache
+        self.image_fetch_concurrency = image_fetch_concurrency
+        self.image_delivery = image_delivery
+        self.include_stream_usage = include_stream_usage
         self.chatgpt_token_limit = get_token_limit(gpt4v_model, default_to_minimum=self.ALLOW_NON_GPT_MODELS)
+        # The prompts below are the same on every turn, so they are tokenized once here instead of per request
+        precount_messages(chatgpt_model, self.query_prompt_template, few_shots=self.query_prompt_few_shots)
+        self.render_system_prompts()
+        for system_prompt in self.system_prompts.values():
+            precount_messages(gpt4v_model, system_prompt, fallback_to_default=self.ALLOW_NON_GPT_MODELS)
 
     @property
     def system_message_chat_conversation(self):
@@ -147,7 +183,10 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
         overrides: dict[str, Any],
         auth_claims: dict[str, Any],
         should_stream: bool = False,
+        deadline: Optional[RequestDeadline] = None,
+        question_embedding: Optional[VectorQuery] = None,
     ) -> tuple[dict[str, Any], Coroutine[Any, Any, Union[ChatCompletion, AsyncStream[ChatCompletionChunk]]]]:
+        deadline = deadline or RequestDeadline()
         seed = overrides.get("seed", None)
         use_text_search = overrides.get("retrieval_mode") in ["text", "hybrid", None]
         use_vector_search = overrides.get("retrieval_mode") in ["vectors", "hybrid", None]
@@ -182,42 +221,63 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
             max_tokens=self.chatgpt_token_limit - query_response_token_limit,
         )
 
-        chat_completion: ChatCompletion = await self.openai_client.chat.completions.create(
-            model=query_deployment if query_deployment else query_model,
-            messages=query_messages,
-            temperature=0.0,  # Minimize creativity for search query generation
-            max_tokens=query_response_token_limit,
-            n=1,
-            seed=seed,
-        )
+        # With little time left, the question is searched as is
+        skip_query_rewrite = deadline.degrade("query_rewrite")
+        if skip_query_rewrite:
+            query_text = original_user_query
+        else:
+            await self.admit_chat_completion(query_model, query_messages, query_response_token_limit, deadline=deadline)
+            chat_completion: ChatCompletion = await deadline.run(
+                "query rewrite",
+                self.openai_client.chat.completions.create(
+                    model=query_deployment if query_deployment else query_model,
+                    messages=query_messages,
+                    temperature=0.0,  # Minimize creativity for search query generation
+                    max_tokens=query_response_token_limit,
+                    n=1,
+                    seed=seed,
+                ),
+            )
+            prompt_usage_stats.record(chat_completion.usage)
 
-        query_text = self.get_search_query(chat_completion, original_user_query)
+            query_text = self.get_search_query(chat_completion, original_user_query)
 
         # STEP 2: Retrieve relevant documents from the search index with the GPT optimized query
 
-        # If retrieval mode includes vectors, compute an embedding for the query
-        vectors = []
-        if use_vector_search:
-            for field in vector_fields:
-                vector = (
-                    await self.compute_text_embedding(query_text)
-                    if field == "embedding"
-                    else await self.compute_image_embedding(query_text)
-                )
-                vectors.append(vector)
-
-        results = await self.search(
-            top,
-            query_text,
-            filter,
-            vectors,
+        use_vector_search, use_semantic_ranker, use_semantic_captions, minimum_reranker_score = self.degrade_search(
+            deadline,
             use_text_search,
             use_vector_search,
             use_semantic_ranker,
             use_semantic_captions,
-            minimum_search_score,
             minimum_reranker_score,
         )
+
+        # If retrieval mode includes vectors, compute an embedding for the query
+        # (question_embedding is always None here, as this approach isn't given the answer cache)
+        vectors: list[VectorQuery] = []
+        vector_field_timings: dict[str, dict[str, Any]] = {}
+        if use_vector_search:
+            vectors, vector_field_timings = await deadline.run(
+                "embedding", self.compute_multi_vectors(query_text, vector_fields, use_text_search)
+            )
+
+        results = await deadline.run(
+            "search",
+            self.search(
+                top,
+                query_text,
+                filter,
+                vectors,
+                use_text_search,
+                use_vector_search,
+                use_semantic_ranker,
+                use_semantic_captions,
+                minimum_search_score,
+                minimum_reranker_score,
+                include_vectors=overrides.get("include_vectors", False),
+            ),
+        )
         sources_content = self.get_sources_content(results, use_semantic_captions, use_image_citation=True)
         content = "\n".join(sources_content)
 
@@ -235,13 +295,20 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
         if send_text_to_gptvision:
             user_content.append({"text": "\n\nSources:\n" + content, "type": "text"})
         if send_images_to_gptvision:
-            for result in results:
-                url = await fetch_image(self.blob_container_client, result)
-                if url:
-                    image_list.append({"image_url": url, "type": "image_url"})
+            for url in await deadline.run(
+                "images",
+                fetch_images(
+                    self.blob_container_client,
+                    results,
+                    self.image_cache,
+                    self.image_fetch_concurrency,
+                    self.image_delivery,
+                ),
+            ):
+                image_list.append({"image_url": url, "type": "image_url"})
             user_content.extend(image_list)
 
-        response_token_limit = 1024
+        response_token_limit = self.response_token_limit
         messages = build_messages(
             model=self.gpt4v_model,
             system_prompt=system_message,
@@ -253,12 +320,13 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
 
         data_points = {
             "text": sources_content,
-            "images": [d["image_url"] for d in image_list],
+            "images": [redact_image_url(d["image_url"]) for d in image_list],
         }
 
-        extra_info = {
-            "data_points": data_points,
-            "thoughts": [
+        # A query rewrite that was skipped for the deadline is listed with the skipped steps instead
+        query_rewrite_thoughts: list[ThoughtStep] = []
+        if not skip_query_rewrite:
+            query_rewrite_thoughts.append(
                 ThoughtStep(
                     "Prompt to generate search query",
                     query_messages,
@@ -267,7 +335,13 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
                         if query_deployment
                         else {"model": query_model}
                     ),
-                ),
+                )
+            )
+
+        extra_info = {
+            "data_points": data_points,
+            "thoughts": [
+                *query_rewrite_thoughts,
                 ThoughtStep(
                     "Search using generated search query",
                     query_text,
@@ -277,32 +351,41 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
                         "top": top,
                         "filter": filter,
                         "vector_fields": vector_fields,
+                        "vector_field_timings": vector_field_timings,
                         "use_text_search": use_text_search,
                     },
                 ),
                 ThoughtStep(
                     "Search results",
-                    [result.serialize_for_results() for result in results],
+                    # Serialized by serialize_for_results when the response is sent
+                    results,
                 ),
                 ThoughtStep(
                     "Prompt to generate answer",
-                    messages,
+                    redact_image_urls(messages),
                     (
                         {"model": self.gpt4v_model, "deployment": self.gpt4v_deployment}
                         if self.gpt4v_deployment
                         else {"model": self.gpt4v_model}
                     ),
                 ),
+                *self.get_deadline_thoughts(deadline),
             ],
         }
 
-        chat_coroutine = self.openai_client.chat.completions.create(
-            model=self.gpt4v_deployment if self.gpt4v_deployment else self.gpt4v_model,
-            messages=messages,
-            temperature=overrides.get("temperature", 0.3),
-            max_tokens=response_token_limit,
-            n=1,
-            stream=should_stream,
-            seed=seed,
+        await self.admit_chat_completion(self.gpt4v_model, messages, response_token_limit, deadline=deadline)
+        chat_coroutine = deadline.run(
+            "answer",
+            self.openai_client.chat.completions.create(
+                model=self.gpt4v_deployment if self.gpt4v_deployment else self.gpt4v_model,
+                messages=messages,
+                temperature=overrides.get("temperature", 0.3),
+                max_tokens=response_token_limit,
+                n=1,
+                stream=should_stream,
+                # Reports the usage, including the cached prompt tokens, in a last chunk of the stream
+                stream_options={"include_usage": True} if should_stream and self.include_stream_usage else NOT_GIVEN,
+                seed=seed,
+            ),
         )
         return (extra_info, chat_coroutine)
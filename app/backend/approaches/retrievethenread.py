@@ -4,10 +4,16 @@ from azure.search.documents.aio import SearchClient
 from azure.search.documents.models import VectorQuery
 from openai import AsyncOpenAI
 from openai.types.chat import ChatCompletionMessageParam
-from openai_messages_token_helper import build_messages, get_token_limit
+from openai_messages_token_helper import get_token_limit
 
 from approaches.approach import Approach, ThoughtStep
+from core.admission import AdmissionController
+from core.answercache import SemanticAnswerCache
 from core.authentication import AuthenticationHelper
+from core.deadline import RequestDeadline
+from core.embeddingcache import QueryEmbeddingCache
+from core.messagebuilder import build_messages, precount_messages
+from core.promptusage import prompt_usage_stats
 
 
 class RetrieveThenReadApproach(Approach):
@@ -36,6 +42,10 @@ info3.pdf: Overlake is the name of the area that includes a park and ride near B
 info4.pdf: In-network institutions include Overlake, Swedish and others in the region
 """
     answer = "In-network deductibles are $500 for employee and $1000 for family [info1.txt] and Overlake is in-network for the employee plan [info2.pdf][info4.pdf]."
+    few_shots: list[ChatCompletionMessageParam] = [
+        {"role": "user", "content": question},
+        {"role": "assistant", "content": answer},
+    ]
 
     def __init__(
         self,
@@ -52,6 +62,9 @@ info4.pdf: In-network institutions include Overlake, Swedish and others in the r
         content_field: str,
         query_language: str,
         query_speller: str,
+        embedding_cache: Optional[QueryEmbeddingCache] = None,
+        answer_cache: Optional[SemanticAnswerCache] = None,
+        admission_controller: Optional[AdmissionController] = None,
     ):
         self.search_client = search_client
         self.chatgpt_deployment = chatgpt_deployment
@@ -66,7 +79,17 @@ info4.pdf: In-network institutions include Overlake, Swedish and others in the r
         self.content_field = content_field
         self.query_language = query_language
         self.query_speller = query_speller
+        self.embedding_cache = embedding_cache
+        self.admission_controller = admission_controller
+        self.answer_cache = answer_cache
         self.chatgpt_token_limit = get_token_limit(chatgpt_model, self.ALLOW_NON_GPT_MODELS)
+        # The default prompt and the example are the same on every request, so they are tokenized once here
+        precount_messages(
+            chatgpt_model,
+            self.system_chat_template,
+            few_shots=self.few_shots,
+            fallback_to_default=self.ALLOW_NON_GPT_MODELS,
+        )
 
     async def run(
         self,
@@ -80,6 +103,7 @@ info4.pdf: In-network institutions include Overlake, Swedish and others in the r
         overrides = context.get("overrides", {})
         seed = overrides.get("seed", None)
         auth_claims = context.get("auth_claims", {})
+        deadline: RequestDeadline = context.get("deadline") or RequestDeadline()
         use_text_search = overrides.get("retrieval_mode") in ["text", "hybrid", None]
         use_vector_search = overrides.get("retrieval_mode") in ["vectors", "hybrid", None]
         use_semantic_ranker = True if overrides.get("semantic_ranker") else False
@@ -89,24 +113,51 @@ info4.pdf: In-network institutions include Overlake, Swedish and others in the r
         minimum_reranker_score = overrides.get("minimum_reranker_score", 0.0)
         filter = self.build_filter(overrides, auth_claims)
 
-        # If retrieval mode includes vectors, compute an embedding for the query
-        vectors: list[VectorQuery] = []
-        if use_vector_search:
-            vectors.append(await self.compute_text_embedding(q))
-
-        results = await self.search(
-            top,
-            q,
-            filter,
-            vectors,
+        answer_cache_scope = self.get_answer_cache_scope(overrides, auth_claims)
+        question_embedding = None
+        if answer_cache_scope:
+            question_embedding, match = await self.lookup_cached_answer(q, answer_cache_scope, deadline)
+            if match:
+                return {
+                    "message": {"content": match.answer.content, "role": "assistant"},
+                    "context": self.get_cached_answer_context(match),
+                    "session_state": session_state,
+                }
+
+        use_vector_search, use_semantic_ranker, use_semantic_captions, minimum_reranker_score = self.degrade_search(
+            deadline,
             use_text_search,
             use_vector_search,
             use_semantic_ranker,
             use_semantic_captions,
-            minimum_search_score,
             minimum_reranker_score,
         )
 
+        # If retrieval mode includes vectors, compute an embedding for the query
+        vectors: list[VectorQuery] = []
+        if use_vector_search and question_embedding:
+            # The embedding of the question was already computed to look up a cached answer
+            vectors.append(question_embedding)
+        elif use_vector_search:
+            vectors.append(await deadline.run("embedding", self.compute_text_embedding(q)))
+
+        results = await deadline.run(
+            "search",
+            self.search(
+                top,
+                q,
+                filter,
+                vectors,
+                use_text_search,
+                use_vector_search,
+                use_semantic_ranker,
+                use_semantic_captions,
+                minimum_search_score,
+                minimum_reranker_score,
+                include_vectors=overrides.get("include_vectors", False),
+            ),
+        )
+
         # Process results
         sources_content = self.get_sources_content(results, use_semantic_captions, use_image_citation=False)
 
@@ -118,21 +169,26 @@ info4.pdf: In-network institutions include Overlake, Swedish and others in the r
         updated_messages = build_messages(
             model=self.chatgpt_model,
             system_prompt=overrides.get("prompt_template", self.system_chat_template),
-            few_shots=[{"role": "user", "content": self.question}, {"role": "assistant", "content": self.answer}],
+            few_shots=self.few_shots,
             new_user_content=user_content,
             max_tokens=self.chatgpt_token_limit - response_token_limit,
             fallback_to_default=self.ALLOW_NON_GPT_MODELS,
         )
 
-        chat_completion = await self.openai_client.chat.completions.create(
-            # Azure OpenAI takes the deployment name as the model name
-            model=self.chatgpt_deployment if self.chatgpt_deployment else self.chatgpt_model,
-            messages=updated_messages,
-            temperature=overrides.get("temperature", 0.3),
-            max_tokens=response_token_limit,
-            n=1,
-            seed=seed,
+        await self.admit_chat_completion(self.chatgpt_model, updated_messages, response_token_limit, deadline=deadline)
+        chat_completion = await deadline.run(
+            "answer",
+            self.openai_client.chat.completions.create(
+                # Azure OpenAI takes the deployment name as the model name
+                model=self.chatgpt_deployment if self.chatgpt_deployment else self.chatgpt_model,
+                messages=updated_messages,
+                temperature=overrides.get("temperature", 0.3),
+                max_tokens=response_token_limit,
+                n=1,
+                seed=seed,
+            ),
         )
+        prompt_usage_stats.record(chat_completion.usage)
 
         data_points = {"text": sources_content}
         extra_info = {
@@ -152,7 +208,8 @@ info4.pdf: In-network institutions include Overlake, Swedish and others in the r
                 ),
                 ThoughtStep(
                     "Search results",
-                    [result.serialize_for_results() for result in results],
+                    # Serialized by serialize_for_results when the response is sent
+                    results,
                 ),
                 ThoughtStep(
                     "Prompt to generate answer",
@@ -163,12 +220,30 @@ info4.pdf: In-network institutions include Overlake, Swedish and others in the r
                         else {"model": self.chatgpt_model}
                     ),
                 ),
+                *self.get_deadline_thoughts(deadline),
             ],
         }
 
+        answer_content = chat_completion.choices[0].message.content
+        # An answer from a search that was cut short to meet the deadline isn't reused for other questions
+        if (
+            self.answer_cache
+            and answer_cache_scope
+            and question_embedding
+            and answer_content
+            and not deadline.degradations
+        ):
+            self.answer_cache.store(
+                answer_cache_scope,
+                q,
+                question_embedding.vector,
+                answer_content,
+                self.get_answer_cache_context(extra_info),
+            )
+
         return {
             "message": {
-                "content": chat_completion.choices[0].message.content,
+                "content": answer_content,
                 "role": chat_completion.choices[0].message.role,
             },
             "context": extra_info,
@@ -1,6 +1,8 @@
 from typing import Any, Awaitable, Callable, Optional
 
+import aiohttp
 from azure.search.documents.aio import SearchClient
+from azure.search.documents.models import VectorQuery
 from azure.storage.blob.aio import ContainerClient
 from openai import AsyncOpenAI
 from openai.types.chat import (
@@ -8,11 +10,22 @@ from openai.types.chat import (
     ChatCompletionContentPartParam,
     ChatCompletionMessageParam,
 )
-from openai_messages_token_helper import build_messages, get_token_limit
+from openai_messages_token_helper import get_token_limit
 
 from approaches.approach import Approach, ThoughtStep
+from core.admission import AdmissionController
 from core.authentication import AuthenticationHelper
-from core.imageshelper import fetch_image
+from core.deadline import RequestDeadline
+from core.embeddingcache import QueryEmbeddingCache
+from core.imageshelper import (
+    ImageCache,
+    ImageDelivery,
+    fetch_images,
+    redact_image_url,
+    redact_image_urls,
+)
+from core.messagebuilder import build_messages, precount_messages
+from core.promptusage import prompt_usage_stats
 
 
 class RetrieveThenReadVisionApproach(Approach):
@@ -49,7 +62,14 @@ class RetrieveThenReadVisionApproach(Approach):
         query_language: str,
         query_speller: str,
         vision_endpoint: str,
-        vision_token_provider: Callable[[], Awaitable[str]]
+        vision_token_provider: Callable[[], Awaitable[str]],
+        embedding_cache: Optional[QueryEmbeddingCache] = None,
+        http_session: Optional[aiohttp.ClientSession] = None,
+        vector_field_timeouts: Optional[dict[str, float]] = None,
+        image_cache: Optional[ImageCache] = None,
+        image_fetch_concurrency: int = 4,
+        image_delivery: Optional[ImageDelivery] = None,
+        admission_controller: Optional[AdmissionController] = None,
     ):
         self.search_client = search_client
         self.blob_container_client = blob_container_client
@@ -64,9 +84,19 @@ class RetrieveThenReadVisionApproach(Approach):
         self.gpt4v_model = gpt4v_model
         self.query_language = query_language
         self.query_speller = query_speller
+        self.embedding_cache = embedding_cache
+        self.admission_controller = admission_controller
         self.vision_endpoint = vision_endpoint
         self.vision_token_provider = vision_token_provider
+        self.http_session = http_session
+        if vector_field_timeouts:
+            self.vector_field_timeouts = vector_field_timeouts
+        self.image_cache = image_cache
+        self.image_fetch_concurrency = image_fetch_concurrency
+        self.image_delivery = image_delivery
         self.gpt4v_token_limit = get_token_limit(gpt4v_model, self.ALLOW_NON_GPT_MODELS)
+        # The default prompt is the same on every request, so it is tokenized once here
+        precount_messages(gpt4v_model, self.system_chat_template_gpt4v, fallback_to_default=self.ALLOW_NON_GPT_MODELS)
 
     async def run(
         self,
@@ -81,6 +111,7 @@ class RetrieveThenReadVisionApproach(Approach):
         overrides = context.get("overrides", {})
         seed = overrides.get("seed", None)
         auth_claims = context.get("auth_claims", {})
+        deadline: RequestDeadline = context.get("deadline") or RequestDeadline()
         use_text_search = overrides.get("retrieval_mode") in ["text", "hybrid", None]
         use_vector_search = overrides.get("retrieval_mode") in ["vectors", "hybrid", None]
         use_semantic_ranker = True if overrides.get("semantic_ranker") else False
@@ -94,30 +125,40 @@ class RetrieveThenReadVisionApproach(Approach):
         send_text_to_gptvision = overrides.get("gpt4v_input") in ["textAndImages", "texts", None]
         send_images_to_gptvision = overrides.get("gpt4v_input") in ["textAndImages", "images", None]
 
-        # If retrieval mode includes vectors, compute an embedding for the query
-        vectors = []
-        if use_vector_search:
-            for field in vector_fields:
-                vector = (
-                    await self.compute_text_embedding(q)
-                    if field == "embedding"
-                    else await self.compute_image_embedding(q)
-                )
-                vectors.append(vector)
-
-        results = await self.search(
-            top,
-            q,
-            filter,
-            vectors,
+        use_vector_search, use_semantic_ranker, use_semantic_captions, minimum_reranker_score = self.degrade_search(
+            deadline,
             use_text_search,
             use_vector_search,
             use_semantic_ranker,
             use_semantic_captions,
-            minimum_search_score,
             minimum_reranker_score,
         )
 
+        # If retrieval mode includes vectors, compute an embedding for the query
+        vectors: list[VectorQuery] = []
+        vector_field_timings: dict[str, dict[str, Any]] = {}
+        if use_vector_search:
+            vectors, vector_field_timings = await deadline.run(
+                "embedding", self.compute_multi_vectors(q, vector_fields, use_text_search)
+            )
+
+        results = await deadline.run(
+            "search",
+            self.search(
+                top,
+                q,
+                filter,
+                vectors,
+                use_text_search,
+                use_vector_search,
+                use_semantic_ranker,
+                use_semantic_captions,
+                minimum_search_score,
+                minimum_reranker_score,
+                include_vectors=overrides.get("include_vectors", False),
+            ),
+        )
+
         image_list: list[ChatCompletionContentPartImageParam] = []
         user_content: list[ChatCompletionContentPartParam] = [{"text": q, "type": "text"}]
 
@@ -128,10 +169,17 @@ class RetrieveThenReadVisionApproach(Approach):
             content = "\n".join(sources_content)
             user_content.append({"text": content, "type": "text"})
         if send_images_to_gptvision:
-            for result in results:
-                url = await fetch_image(self.blob_container_client, result)
-                if url:
-                    image_list.append({"image_url": url, "type": "image_url"})
+            for url in await deadline.run(
+                "images",
+                fetch_images(
+                    self.blob_container_client,
+                    results,
+                    self.image_cache,
+                    self.image_fetch_concurrency,
+                    self.image_delivery,
+                ),
+            ):
+                image_list.append({"image_url": url, "type": "image_url"})
             user_content.extend(image_list)
 
         response_token_limit = 1024
@@ -142,18 +190,23 @@ class RetrieveThenReadVisionApproach(Approach):
             max_tokens=self.gpt4v_token_limit - response_token_limit,
             fallback_to_default=self.ALLOW_NON_GPT_MODELS,
         )
-        chat_completion = await self.openai_client.chat.completions.create(
-            model=self.gpt4v_deployment if self.gpt4v_deployment else self.gpt4v_model,
-            messages=updated_messages,
-            temperature=overrides.get("temperature", 0.3),
-            max_tokens=response_token_limit,
-            n=1,
-            seed=seed,
+        await self.admit_chat_completion(self.gpt4v_model, updated_messages, response_token_limit, deadline=deadline)
+        chat_completion = await deadline.run(
+            "answer",
+            self.openai_client.chat.completions.create(
+                model=self.gpt4v_deployment if self.gpt4v_deployment else self.gpt4v_model,
+                messages=updated_messages,
+                temperature=overrides.get("temperature", 0.3),
+                max_tokens=response_token_limit,
+                n=1,
+                seed=seed,
+            ),
         )
+        prompt_usage_stats.record(chat_completion.usage)
 
         data_points = {
             "text": sources_content,
-            "images": [d["image_url"] for d in image_list],
+            "images": [redact_image_url(d["image_url"]) for d in image_list],
         }
 
         extra_info = {
@@ -168,23 +221,26 @@ class RetrieveThenReadVisionApproach(Approach):
                         "top": top,
                         "filter": filter,
                         "vector_fields": vector_fields,
+                        "vector_field_timings": vector_field_timings,
                         "use_vector_search": use_vector_search,
                         "use_text_search": use_text_search,
                     },
                 ),
                 ThoughtStep(
                     "Search results",
-                    [result.serialize_for_results() for result in results],
+                    # Serialized by serialize_for_results when the response is sent
+                    results,
                 ),
                 ThoughtStep(
                     "Prompt to generate answer",
-                    updated_messages,
+                    redact_image_urls(updated_messages),
                     (
                         {"model": self.gpt4v_model, "deployment": self.gpt4v_deployment}
                         if self.gpt4v_deployment
                         else {"model": self.gpt4v_model}
                     ),
                 ),
+                *self.get_deadline_thoughts(deadline),
             ],
         }
 
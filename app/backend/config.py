@@ -7,6 +7,17 @@ CONFIG_CHAT_APPROACH = "chat_approach"
 CONFIG_BLOB_CONTAINER_CLIENT = "blob_container_client"
 CONFIG_USER_UPLOAD_ENABLED = "user_upload_enabled"
 CONFIG_USER_BLOB_CONTAINER_CLIENT = "user_blob_container_client"
+CONFIG_CONTENT_CACHE = "content_cache"
+CONFIG_EMBEDDING_CACHE = "embedding_cache"
+CONFIG_ANSWER_CACHE = "answer_cache"
+CONFIG_ANSWER_CACHE_INDEX_CLIENT = "answer_cache_index_client"
+CONFIG_HTTP_CLIENTS = "http_clients"
+CONFIG_IMAGE_DELIVERY = "image_delivery"
+CONFIG_STREAM_COALESCE_BYTES = "stream_coalesce_bytes"
+CONFIG_STREAM_COALESCE_MS = "stream_coalesce_ms"
+CONFIG_FAIR_SHARE_SCHEDULER = "fair_share_scheduler"
+CONFIG_BEHIND_PROXY = "behind_proxy"
+CONFIG_DEADLINE_POLICY = "deadline_policy"
 CONFIG_AUTH_CLIENT = "auth_client"
 CONFIG_GPT4V_DEPLOYED = "gpt4v_deployed"
 CONFIG_SEMANTIC_RANKER_DEPLOYED = "semantic_ranker_deployed"
@@ -0,0 +1,138 @@
+import asyncio
+import time
+from typing import Optional
+
+from core.metrics import meter
+
+wait_time_histogram = meter.create_histogram(
+    "openai.admission.wait_time", unit="s", description="Time that OpenAI calls waited for the admission budget"
+)
+
+
+class AdmissionRejectedError(Exception):
+    """
+    Raised when a call to OpenAI can't be admitted within the maximum wait.
+    The status code is 429 when the budget is used up and 503 when too many calls are already queued.
+    """
+
+    def __init__(self, message: str, status_code: int, retry_after: float):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class RateBudget:
+    """A token bucket holding up to one minute of budget, refilled continuously."""
+
+    def __init__(self, per_minute: int, now: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.available = float(per_minute)
+        self.updated = now
+
+    def refill(self, now: float):
+        self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        self.refill(now)
+        # A single call larger than the whole budget is let through once the bucket is full
+        return max(0.0, (min(amount, self.capacity) - self.available) / self.rate)
+
+    def take(self, amount: float, now: float):
+        self.refill(now)
+        self.available -= min(amount, self.capacity)
+
+
+class AdmissionController:
+    """
+    Meters the chat completions sent to OpenAI against a tokens per minute and a requests per minute budget,
+    like Azure OpenAI does, so that bursts wait here in order instead of all failing with 429 upstream.
+    A call costs its prompt tokens plus its max_tokens, which is also what Azure OpenAI counts against the quota.
+    Calls wait in FIFO order, at most max_queue of them, and a call that would wait longer than max_wait
+    is rejected right away with a Retry-After instead of holding the user until the request times out.
+    The budgets are per worker process.
+    """
+
+    def __init__(
+        self,
+        tokens_per_minute: int = 0,
+        requests_per_minute: int = 0,
+        max_queue: int = 100,
+        max_wait: float = 30.0,
+    ):
+        now = time.monotonic()
+        self.token_budget = RateBudget(tokens_per_minute, now) if tokens_per_minute > 0 else None
+        self.request_budget = RateBudget(requests_per_minute, now) if requests_per_minute > 0 else None
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.lock: Optional[asyncio.Lock] = None
+        self.queued = 0
+        self.queued_tokens = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.wait_seconds = 0.0
+
+    def wait_time(self, tokens: float, requests: float, now: float) -> float:
+        wait = 0.0
+        if self.token_budget:
+            wait = self.token_budget.wait_time(tokens, now)
+        if self.request_budget:
+            wait = max(wait, self.request_budget.wait_time(requests, now))
+        return wait
+
+    def reject(self, message: str, status_code: int, retry_after: float) -> AdmissionRejectedError:
+        self.rejected += 1
+        return AdmissionRejectedError(message, status_code, retry_after)
+
+    async def admit(self, tokens: int):
+        """Waits until the budget allows a call that costs this many tokens, or raises AdmissionRejectedError."""
+        start = time.monotonic()
+        if self.queued >= self.max_queue:
+            raise self.reject("Too many OpenAI calls are waiting for the budget", 503, self.max_wait)
+        # The calls already queued are admitted first, so their tokens add to the wait of this one
+        estimated_wait = self.wait_time(self.queued_tokens + tokens, self.queued + 1, start)
+        if estimated_wait > self.max_wait:
+            raise self.reject("The OpenAI budget is used up", 429, estimated_wait)
+        if self.lock is None:
+            # Created on first use, as locks are bound to the event loop on older Python versions
+            self.lock = asyncio.Lock()
+        self.queued += 1
+        self.queued_tokens += tokens
+        try:
+            # asyncio.Lock wakes up its waiters in the order they arrived
+            async with self.lock:
+                now = time.monotonic()
+                wait = self.wait_time(tokens, 1, now)
+                if now - start + wait > self.max_wait:
+                    raise self.reject("The OpenAI budget is used up", 429, wait)
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                    now = time.monotonic()
+                if self.token_budget:
+                    self.token_budget.take(tokens, now)
+                if self.request_budget:
+                    self.request_budget.take(1, now)
+        finally:
+            self.queued -= 1
+            self.queued_tokens -= tokens
+        waited = time.monotonic() - start
+        self.admitted += 1
+        self.wait_seconds += waited
+        wait_time_histogram.record(waited)
+
+    def stats(self) -> dict[str, float]:
+        now = time.monotonic()
+        if self.token_budget:
+            self.token_budget.refill(now)
+        if self.request_budget:
+            self.request_budget.refill(now)
+        return {
+            "queue_depth": self.queued,
+            "queued_tokens": self.queued_tokens,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "average_wait_ms": round(self.wait_seconds / self.admitted * 1000, 1) if self.admitted else 0.0,
+            "available_tokens": round(self.token_budget.available) if self.token_budget else 0,
+            "available_requests": round(self.request_budget.available) if self.request_budget else 0,
+        }
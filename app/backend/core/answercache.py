@@ -0,0 +1,173 @@
+import asyncio
+import hashlib
+import json
+import logging
+import time
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Optional
+
+import numpy as np
+from azure.search.documents.indexes.aio import SearchIndexClient
+
+from core.cache import TTLCache
+from core.embeddingcache import normalize_query_text
+
+
+@dataclass
+class CachedAnswer:
+    question: str
+    vector: np.ndarray
+    content: str
+    context: dict[str, Any]
+    followup_questions: Optional[list[str]]
+    created_at: float
+
+
+@dataclass
+class AnswerCacheMatch:
+    answer: CachedAnswer
+    similarity: float
+
+
+class SemanticAnswerCache:
+    """
+    Cache of generated answers, looked up by the cosine similarity between the embedding of a new question
+    and the embeddings of the questions that were answered before.
+    Answers are partitioned by scope, which covers the approach, the search filter (including the security filter)
+    and the request overrides, so an answer is only ever reused for requests that would have searched the same documents.
+    Users with the same security filter share answers, so the stored thought process must not contain their questions.
+    """
+
+    def __init__(
+        self,
+        maxsize: int,
+        ttl: float,
+        similarity_threshold: float,
+        max_scopes: int = 1000,
+        index_check_interval: float = 60,
+        get_index_version: Optional[Callable[[], Awaitable[Any]]] = None,
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self.scopes: TTLCache[str, TTLCache[str, CachedAnswer]] = TTLCache(maxsize=max_scopes, ttl=float("inf"))
+        self.index_check_interval = index_check_interval
+        self.get_index_version = get_index_version
+        self.index_checked_at = float("-inf")
+        self.index_version: Any = None
+        self.index_check_task: Optional[asyncio.Task] = None
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def scope(approach: str, filter: Optional[str], overrides: dict[str, Any]) -> str:
+        return hashlib.sha256(
+            json.dumps([approach, filter, overrides], sort_keys=True, default=str).encode()
+        ).hexdigest()
+
+    @staticmethod
+    def normalize_vector(vector: list[float]) -> np.ndarray:
+        array = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(array)
+        return array / norm if norm else array
+
+    def lookup(self, scope: str, vector: list[float]) -> Optional[AnswerCacheMatch]:
+        answers = self.scopes.get(scope)
+        if answers:
+            best: Optional[AnswerCacheMatch] = None
+            query_vector = self.normalize_vector(vector)
+            now = time.monotonic()
+            for answer, expires_at in answers.entries.values():
+                if expires_at <= now:
+                    continue
+                similarity = float(np.dot(answer.vector, query_vector))
+                if similarity >= self.similarity_threshold and (best is None or similarity > best.similarity):
+                    best = AnswerCacheMatch(answer=answer, similarity=similarity)
+            if best is not None:
+                # Refreshes the recency of the matched answer
+                answers.get(normalize_query_text(best.answer.question))
+                self.hits += 1
+                return best
+        self.misses += 1
+        return None
+
+    def store(
+        self,
+        scope: str,
+        question: str,
+        vector: list[float],
+        content: str,
+        context: dict[str, Any],
+        followup_questions: Optional[list[str]] = None,
+    ):
+        answers = self.scopes.get(scope)
+        if answers is None:
+            answers = TTLCache(maxsize=self.maxsize, ttl=self.ttl)
+            self.scopes.set(scope, answers)
+        answers.set(
+            normalize_query_text(question),
+            CachedAnswer(
+                question=question,
+                vector=self.normalize_vector(vector),
+                content=content,
+                context=context,
+                followup_questions=followup_questions,
+                created_at=time.time(),
+            ),
+        )
+
+    def invalidate(self):
+        self.scopes.clear()
+        self.invalidations += 1
+
+    def schedule_index_check(self):
+        """
+        Compares the version of the search index with the one seen last time, at most once per index_check_interval,
+        and drops every answer when it changed because documents were ingested, re-ingested or removed.
+        The check runs in the background so that it never delays the request that triggered it.
+        """
+        if self.get_index_version is None:
+            return
+        if self.index_check_task or time.monotonic() - self.index_checked_at < self.index_check_interval:
+            return
+        self.index_checked_at = time.monotonic()
+        self.index_check_task = asyncio.create_task(self.check_index(self.get_index_version))
+
+    async def check_index(self, get_index_version: Callable[[], Awaitable[Any]]):
+        try:
+            index_version = await get_index_version()
+        except Exception as error:
+            logging.warning("Failed to check the search index for the answer cache: %s", error)
+            return
+        finally:
+            self.index_check_task = None
+        if self.index_version is not None and index_version != self.index_version:
+            logging.info("Search index changed, dropping cached answers")
+            self.invalidate()
+        self.index_version = index_version
+
+    def stats(self) -> dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "size": sum(len(answers) for answers, _ in self.scopes.entries.values()),
+            "scopes": len(self.scopes),
+            "invalidations": self.invalidations,
+        }
+
+    def close(self):
+        if self.index_check_task:
+            self.index_check_task.cancel()
+        self.scopes.clear()
+
+
+async def get_search_index_version(search_index_client: SearchIndexClient, index_name: str) -> tuple[int, int]:
+    """
+    Returns the document count and storage size of the index, as its version for the answer cache.
+    The storage size also changes when documents are re-ingested or edited in place, which keeps the count the same.
+    """
+    statistics = await search_index_client.get_index_statistics(index_name)
+    return statistics["document_count"], statistics["storage_size"]
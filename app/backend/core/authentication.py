@@ -1,24 +1,30 @@
 # Refactored from https://github.com/Azure-Samples/ms-identity-python-on-behalf-of
 
+import asyncio
 import base64
+import hashlib
 import json
 import logging
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any, Optional
 
 import aiohttp
 import jwt
 from azure.search.documents.aio import SearchClient
 from azure.search.documents.indexes.models import SearchIndex
-from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives.asymmetric import rsa
 from msal import ConfidentialClientApplication
 from msal.token_cache import TokenCache
-from tenacity import (
-    AsyncRetrying,
-    retry_if_exception_type,
-    stop_after_attempt,
-    wait_random_exponential,
-)
+
+from core.cache import TTLCache
+
+
+def remove_fragment(path: str) -> str:
+    fragment_index = path.find("#")
+    return path if fragment_index == -1 else path[:fragment_index]
 
 
 # AuthError is raised when the authentication token sent by the client UI cannot be parsed or there is an authentication error accessing the graph API
@@ -31,6 +37,106 @@ class AuthError(Exception):
         return self.error or ""
 
 
+def public_key_from_jwk(key: dict[str, Any]) -> rsa.RSAPublicKey:
+    # Construct the RSA public key from the modulus and exponent of a JSON Web Key
+    public_numbers = rsa.RSAPublicNumbers(
+        e=int.from_bytes(base64.urlsafe_b64decode(key["e"] + "=="), byteorder="big"),
+        n=int.from_bytes(base64.urlsafe_b64decode(key["n"] + "=="), byteorder="big"),
+    )
+    return public_numbers.public_key()
+
+
+class JwksKeyStore:
+    """
+    In-process cache of the Entra signing keys published at the JWKS endpoint.
+    Each key is parsed into an RSA public key once and kept until its TTL expires.
+    A token signed with an unknown or expired key id triggers a refresh of the whole key set,
+    and concurrent refreshes are collapsed into a single request to the JWKS endpoint.
+    The refresh is not retried, as every request waiting for a key waits on it: when it fails,
+    an expired key is still used until the next refresh succeeds, and a token with an unknown key id is rejected.
+    """
+
+    def __init__(
+        self, key_url: str, ttl: float = 24 * 60 * 60, min_refresh_interval: float = 30, refresh_timeout: float = 10
+    ):
+        self.key_url = key_url
+        self.ttl = ttl
+        self.refresh_timeout = refresh_timeout
+        # Limits how often tokens with unknown key ids can force a refresh of the key set
+        self.min_refresh_interval = min_refresh_interval
+        self.keys: dict[str, tuple[rsa.RSAPublicKey, float]] = {}
+        self.last_refresh: Optional[float] = None
+        self.refresh_lock = asyncio.Lock()
+        self.refresh_generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+
+    def stats(self) -> dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "refreshes": self.refreshes, "keys": len(self.keys)}
+
+    def lookup(self, kid: str) -> Optional[rsa.RSAPublicKey]:
+        entry = self.keys.get(kid)
+        if entry is None:
+            return None
+        public_key, expires_at = entry
+        if expires_at <= time.monotonic():
+            return None
+        return public_key
+
+    async def get_signing_key(self, kid: str) -> Optional[rsa.RSAPublicKey]:
+        if public_key := self.lookup(kid):
+            self.hits += 1
+            return public_key
+
+        self.misses += 1
+        generation = self.refresh_generation
+        async with self.refresh_lock:
+            # Another request may have refreshed the keys while this one was waiting for the lock
+            if self.refresh_generation == generation:
+                expired = kid in self.keys
+                recently_refreshed = (
+                    self.last_refresh is not None and time.monotonic() - self.last_refresh < self.min_refresh_interval
+                )
+                if expired or not recently_refreshed:
+                    try:
+                        await self.refresh()
+                    except AuthError as error:
+                        if not expired:
+                            raise
+                        logging.warning(
+                            "Using expired JWKS key %s, as the key set could not be refreshed: %s", kid, error
+                        )
+                        return self.keys[kid][0]
+        return self.lookup(kid)
+
+    async def refresh(self):
+        try:
+            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.refresh_timeout)) as session:
+                async with session.get(url=self.key_url) as resp:
+                    resp_status = resp.status
+                    if resp_status in [500, 502, 503, 504]:
+                        raise AuthError(error=f"Failed to get keys info: {await resp.text()}", status_code=resp_status)
+                    jwks = await resp.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+            raise AuthError(error=f"Failed to get keys info: {error}", status_code=503) from error
+
+        if not jwks or "keys" not in jwks:
+            raise AuthError("Unable to get keys to validate auth token.", 401)
+
+        expires_at = time.monotonic() + self.ttl
+        keys: dict[str, tuple[rsa.RSAPublicKey, float]] = {}
+        for key in jwks["keys"]:
+            try:
+                keys[key["kid"]] = (public_key_from_jwk(key), expires_at)
+            except (KeyError, ValueError):
+                logging.warning("Skipping JWKS key that is not a valid RSA key: %s", key.get("kid"))
+        self.keys = keys
+        self.last_refresh = time.monotonic()
+        self.refresh_generation += 1
+        self.refreshes += 1
+
+
 class AuthenticationHelper:
     scope: str = "https://graph.microsoft.com/.default"
 
@@ -45,6 +151,11 @@ class AuthenticationHelper:
         require_access_control: bool = False,
         enable_global_documents: bool = False,
         enable_unauthenticated_access: bool = False,
+        auth_claims_cache_size: int = 1000,
+        auth_claims_cache_ttl: float = 60 * 60,
+        obo_max_workers: int = 8,
+        path_auth_cache_size: int = 10000,
+        path_auth_cache_ttl: float = 60,
     ):
         self.use_authentication = use_authentication
         self.server_app_id = server_app_id
@@ -61,6 +172,18 @@ class AuthenticationHelper:
         self.valid_audiences = [f"api://{server_app_id}", str(server_app_id)]
         # See https://learn.microsoft.com/entra/identity-platform/access-tokens#validate-the-issuer for more information on token validation
         self.key_url = f"{self.authority}/discovery/v2.0/keys"
+        self.key_store = JwksKeyStore(self.key_url)
+        # Resolved claims are cached per access token, so the on-behalf-of exchange and Graph calls
+        # only happen once per token instead of once per request
+        self.auth_claims_cache: TTLCache[str, dict[str, Any]] = TTLCache(
+            maxsize=auth_claims_cache_size, ttl=auth_claims_cache_ttl
+        )
+        # Path authorization decisions are cached briefly per (oid, groups, path) so repeated citation loads
+        # don't each run a search query. ACL changes made in this process invalidate them through invalidate_path_auth,
+        # while changes made elsewhere, such as with scripts/manageacl.py, only apply once the cached decisions expire
+        self.path_auth_cache: TTLCache[tuple[str, str, str], bool] = TTLCache(
+            maxsize=path_auth_cache_size, ttl=path_auth_cache_ttl
+        )
 
         if self.use_authentication:
             field_names = [field.name for field in search_index.fields] if search_index else []
@@ -71,11 +194,33 @@ class AuthenticationHelper:
             self.confidential_client = ConfidentialClientApplication(
                 server_app_id, authority=self.authority, client_credential=server_app_secret, token_cache=TokenCache()
             )
+            # MSAL only offers a blocking API, so the on-behalf-of exchange runs on a dedicated bounded pool
+            # instead of stalling the event loop (and every other in-flight request) while it waits on Entra
+            self.obo_executor: Optional[ThreadPoolExecutor] = ThreadPoolExecutor(
+                max_workers=obo_max_workers, thread_name_prefix="msal-obo"
+            )
         else:
             self.has_auth_fields = False
             self.require_access_control = False
             self.enable_global_documents = True
             self.enable_unauthenticated_access = True
+            self.obo_executor = None
+        self.obo_calls = 0
+        self.obo_in_flight = 0
+        self.obo_pool_wait_seconds_total = 0.0
+        self.obo_pool_wait_seconds_max = 0.0
+
+    def obo_stats(self) -> dict[str, float]:
+        return {
+            "calls": self.obo_calls,
+            "in_flight": self.obo_in_flight,
+            "pool_wait_seconds_total": self.obo_pool_wait_seconds_total,
+            "pool_wait_seconds_max": self.obo_pool_wait_seconds_max,
+        }
+
+    def close(self):
+        if self.obo_executor:
+            self.obo_executor.shutdown(wait=False)
 
     def get_auth_setup_for_client(self) -> dict[str, Any]:
         # returns MSAL.js settings used by the client app
@@ -207,6 +352,26 @@ class AuthenticationHelper:
 
         return groups
 
+    async def acquire_token_on_behalf_of(self, auth_token: str) -> dict[str, Any]:
+        submitted_at = time.monotonic()
+
+        def acquire_token() -> tuple[float, dict[str, Any]]:
+            pool_wait = time.monotonic() - submitted_at
+            return pool_wait, self.confidential_client.acquire_token_on_behalf_of(
+                user_assertion=auth_token, scopes=[AuthenticationHelper.scope]
+            )
+
+        self.obo_calls += 1
+        self.obo_in_flight += 1
+        try:
+            pool_wait, result = await asyncio.get_running_loop().run_in_executor(self.obo_executor, acquire_token)
+        finally:
+            self.obo_in_flight -= 1
+        # Time spent queued behind other exchanges shows whether the pool is large enough
+        self.obo_pool_wait_seconds_total += pool_wait
+        self.obo_pool_wait_seconds_max = max(self.obo_pool_wait_seconds_max, pool_wait)
+        return result
+
     async def get_auth_claims_if_enabled(self, headers: dict) -> dict[str, Any]:
         if not self.use_authentication:
             return {}
@@ -215,14 +380,16 @@ class AuthenticationHelper:
             # The scope is set to the Microsoft Graph API, which may need to be called for more authorization information
             # https://learn.microsoft.com/entra/identity-platform/v2-oauth2-on-behalf-of-flow
             auth_token = AuthenticationHelper.get_token_auth_header(headers)
+            # Tokens are only cached after they have been validated, and only until they expire
+            token_hash = hashlib.sha256(auth_token.encode("utf-8")).hexdigest()
+            if cached_claims := self.auth_claims_cache.get(token_hash):
+                return {"oid": cached_claims["oid"], "groups": list(cached_claims["groups"])}
             # Validate the token before use
-            await self.validate_access_token(auth_token)
+            token_claims = await self.validate_access_token(auth_token)
 
             # Use the on-behalf-of-flow to acquire another token for use with Microsoft Graph
             # See https://learn.microsoft.com/entra/identity-platform/v2-oauth2-on-behalf-of-flow for more information
-            graph_resource_access_token = self.confidential_client.acquire_token_on_behalf_of(
-                user_assertion=auth_token, scopes=["https://graph.microsoft.com/.default"]
-            )
+            graph_resource_access_token = await self.acquire_token_on_behalf_of(auth_token)
             if "error" in graph_resource_access_token:
                 raise AuthError(error=str(graph_resource_access_token), status_code=401)
 
@@ -243,6 +410,12 @@ class AuthenticationHelper:
             if missing_groups_claim or has_group_overage_claim:
                 # Read the user's groups from Microsoft Graph
                 auth_claims["groups"] = await AuthenticationHelper.list_groups(graph_resource_access_token)
+            if token_claims and "exp" in token_claims:
+                self.auth_claims_cache.set(
+                    token_hash,
+                    {"oid": auth_claims["oid"], "groups": list(auth_claims["groups"])},
+                    ttl=token_claims["exp"] - time.time(),
+                )
             return auth_claims
         except AuthError as e:
             logging.exception("Exception getting authorization information - " + json.dumps(e.error))
@@ -263,9 +436,13 @@ class AuthenticationHelper:
             return True
 
         # Remove any fragment string from the path before checking
-        fragment_index = path.find("#")
-        if fragment_index != -1:
-            path = path[:fragment_index]
+        path = remove_fragment(path)
+
+        groups_fingerprint = hashlib.sha256(json.dumps(sorted(auth_claims.get("groups", []))).encode()).hexdigest()
+        cache_key = (auth_claims.get("oid", ""), groups_fingerprint, path)
+        cached_decision = self.path_auth_cache.get(cache_key)
+        if cached_decision is not None:
+            return cached_decision
 
         # Filter down to only chunks that are from the specific source file
         # Sourcepage is used for GPT-4V
@@ -282,60 +459,43 @@ class AuthenticationHelper:
             allowed = True
             break
 
+        self.path_auth_cache.set(cache_key, allowed)
         return allowed
 
-    async def create_pem_format(self, jwks, token):
-        unverified_header = jwt.get_unverified_header(token)
-        for key in jwks["keys"]:
-            if key["kid"] == unverified_header["kid"]:
-                # Construct the RSA public key
-                public_numbers = rsa.RSAPublicNumbers(
-                    e=int.from_bytes(base64.urlsafe_b64decode(key["e"] + "=="), byteorder="big"),
-                    n=int.from_bytes(base64.urlsafe_b64decode(key["n"] + "=="), byteorder="big"),
-                )
-                public_key = public_numbers.public_key()
-
-                # Convert to PEM format
-                pem_key = public_key.public_bytes(
-                    encoding=serialization.Encoding.PEM, format=serialization.PublicFormat.SubjectPublicKeyInfo
-                )
-                rsa_key = pem_key
-                return rsa_key
+    def invalidate_path_auth(self, path: Optional[str] = None):
+        """
+        Drops cached path authorization decisions for a source file, or all of them when no path is given.
+        Call this whenever the ACLs of indexed documents change.
+        """
+        if path is None:
+            self.path_auth_cache.clear()
+            return
+        # Decisions are also cached for the page images of the file (file-1.png), which share its ACLs
+        path = remove_fragment(path)
+        page_image_pattern = re.compile(re.escape(os.path.splitext(path)[0]) + r"-\d+\.png")
+        for cache_key in list(self.path_auth_cache.entries):
+            if cache_key[2] == path or page_image_pattern.fullmatch(cache_key[2]):
+                self.path_auth_cache.pop(cache_key)
 
     # See https://github.com/Azure-Samples/ms-identity-python-on-behalf-of/blob/939be02b11f1604814532fdacc2c2eccd198b755/FlaskAPI/helpers/authorization.py#L44
-    async def validate_access_token(self, token: str):
+    async def validate_access_token(self, token: str) -> dict[str, Any]:
         """
-        Validate an access token is issued by Entra
+        Validate an access token is issued by Entra, returning its verified claims
         """
-        jwks = None
-        async for attempt in AsyncRetrying(
-            retry=retry_if_exception_type(AuthError),
-            wait=wait_random_exponential(min=15, max=60),
-            stop=stop_after_attempt(5),
-        ):
-            with attempt:
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(url=self.key_url) as resp:
-                        resp_status = resp.status
-                        if resp_status in [500, 502, 503, 504]:
-                            raise AuthError(
-                                error=f"Failed to get keys info: {await resp.text()}", status_code=resp_status
-                            )
-                        jwks = await resp.json()
-
-        if not jwks or "keys" not in jwks:
-            raise AuthError("Unable to get keys to validate auth token.", 401)
-
         rsa_key = None
         issuer = None
         audience = None
         try:
+            unverified_header = jwt.get_unverified_header(token)
             unverified_claims = jwt.decode(token, options={"verify_signature": False})
             issuer = unverified_claims.get("iss")
             audience = unverified_claims.get("aud")
-            rsa_key = await self.create_pem_format(jwks, token)
         except jwt.PyJWTError as exc:
             raise AuthError("Unable to parse authorization token.", 401) from exc
+        # Signing keys are cached, so the JWKS endpoint is only called when keys expire or rotate
+        kid = unverified_header.get("kid")
+        if kid:
+            rsa_key = await self.key_store.get_signing_key(kid)
         if not rsa_key:
             raise AuthError("Unable to find appropriate key", 401)
 
@@ -349,7 +509,7 @@ class AuthenticationHelper:
             )
 
         try:
-            jwt.decode(token, rsa_key, algorithms=["RS256"], audience=audience, issuer=issuer)
+            return jwt.decode(token, rsa_key, algorithms=["RS256"], audience=audience, issuer=issuer)
         except jwt.ExpiredSignatureError as jwt_expired_exc:
             raise AuthError("Token is expired", 401) from jwt_expired_exc
         except (jwt.InvalidAudienceError, jwt.InvalidIssuerError) as jwt_claims_exc:
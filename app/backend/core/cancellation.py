@@ -0,0 +1,35 @@
+from typing import Union
+
+
+class CancellationStats:
+    """
+    Counts the requests that were cancelled because the client went away (closed the tab or pressed stop)
+    before their response started.
+    For streamed answers it also counts the completion tokens that were streamed before the upstream stream
+    was closed, and the tokens of max_tokens that the model was no longer asked to generate.
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.streams = 0
+        self.streamed_tokens = 0
+        self.saved_tokens = 0
+
+    def record_request(self):
+        self.requests += 1
+
+    def record_stream(self, streamed_tokens: int, max_tokens: int):
+        self.streams += 1
+        self.streamed_tokens += streamed_tokens
+        self.saved_tokens += max(0, max_tokens - streamed_tokens)
+
+    def stats(self) -> dict[str, Union[int, float]]:
+        return {
+            "requests": self.requests,
+            "streams": self.streams,
+            "streamed_tokens": self.streamed_tokens,
+            "saved_tokens": self.saved_tokens,
+        }
+
+
+cancellation_stats = CancellationStats()
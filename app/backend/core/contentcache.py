@@ -0,0 +1,172 @@
+import asyncio
+import hashlib
+import itertools
+import logging
+import os
+import shutil
+import socket
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+from typing import Any, AsyncIterator, Awaitable, Callable, Optional, Protocol
+
+
+class ContentDownloader(Protocol):
+    size: int
+    properties: Any
+
+    def chunks(self) -> AsyncIterator[bytes]: ...
+
+
+def pid_exists(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+@dataclass
+class CachedContentFile:
+    file_path: Path
+    etag: str
+    size: int
+    mime_type: str
+    last_modified: Optional[datetime]
+    validated_at: float
+
+
+class ContentFileCache:
+    """
+    Size-bounded on-disk cache of files served through /content, evicted in least-recently-used order.
+    Each worker process keeps its own directory and in-memory index, so nothing is shared or locked across workers,
+    and max_bytes bounds the files of each worker: the disk holds up to max_bytes times the number of workers.
+    The directories are named after the host as well as the pid, as the cache directory may be on storage that
+    is shared by several instances, whose pids are from separate namespaces.
+    Entries are revalidated against the ETag in the storage properties once they are older than revalidate_after seconds.
+    The file of a dropped entry is only deleted unlink_delay seconds later, as a response that was already created
+    for it may not have opened it yet (once opened, it can still be read after it is deleted).
+    """
+
+    def __init__(self, directory: str, max_bytes: int, revalidate_after: float = 60, unlink_delay: float = 60):
+        host_prefix = f"worker-{socket.gethostname()}-"
+        self.directory = Path(directory) / f"{host_prefix}{os.getpid()}"
+        self.max_bytes = max_bytes
+        self.revalidate_after = revalidate_after
+        self.unlink_delay = unlink_delay
+        self.entries: OrderedDict[str, CachedContentFile] = OrderedDict()
+        self.total_bytes = 0
+        self.fill_tasks: dict[str, asyncio.Task] = {}
+        # Each fill writes a new file, so a file that is being sent is never overwritten
+        self.file_numbers = itertools.count()
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        # Files left behind by a previous process with the same pid, or by workers of this host that crashed
+        # or were restarted, are not in any index, so they are removed. Other hosts clean up their own directories.
+        for worker_directory in Path(directory).glob(f"{host_prefix}*"):
+            pid = worker_directory.name[len(host_prefix) :]
+            if pid.isdigit() and (int(pid) == os.getpid() or not pid_exists(int(pid))):
+                shutil.rmtree(worker_directory, ignore_errors=True)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def lookup(self, key: str) -> Optional[CachedContentFile]:
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        return entry
+
+    def needs_revalidation(self, entry: CachedContentFile) -> bool:
+        return time.monotonic() - entry.validated_at >= self.revalidate_after
+
+    def mark_validated(self, entry: CachedContentFile):
+        entry.validated_at = time.monotonic()
+
+    def record_hit(self, bytes_served: int):
+        self.hits += 1
+        self.bytes_saved += bytes_served
+
+    def record_miss(self):
+        self.misses += 1
+
+    def evict(self, key: str):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= entry.size
+            asyncio.get_running_loop().call_later(self.unlink_delay, entry.file_path.unlink, True)
+
+    def schedule_fill(
+        self,
+        key: str,
+        mime_type: str,
+        download: Callable[[], Awaitable[ContentDownloader]],
+        size: Optional[int] = None,
+    ):
+        """
+        Downloads the whole file into the cache in the background, so that the request that missed is not slowed down
+        and ranged requests from PDF viewers can populate the cache as well.
+        Requests for the same file while it is being downloaded, such as the parallel ranged requests of a PDF viewer,
+        share that download. A file whose size is known to be larger than the whole cache is not downloaded at all.
+        """
+        if key in self.fill_tasks or key in self.entries or (size is not None and size > self.max_bytes):
+            return
+        task = asyncio.create_task(self.fill(key, mime_type, download))
+        self.fill_tasks[key] = task
+        task.add_done_callback(lambda _: self.fill_tasks.pop(key, None))
+
+    async def fill(self, key: str, mime_type: str, download: Callable[[], Awaitable[ContentDownloader]]):
+        file_path = self.directory / f"{hashlib.sha256(key.encode()).hexdigest()}-{next(self.file_numbers)}"
+        temp_path = file_path.with_suffix(".tmp")
+        loop = asyncio.get_running_loop()
+        try:
+            downloader = await download()
+            # Without an ETag the cached copy could never be revalidated
+            etag = downloader.properties.etag
+            if not etag or downloader.size > self.max_bytes:
+                return
+            temp_file = await loop.run_in_executor(None, open, temp_path, "wb")
+            try:
+                async for chunk in downloader.chunks():
+                    await loop.run_in_executor(None, temp_file.write, chunk)
+            finally:
+                await loop.run_in_executor(None, temp_file.close)
+            os.replace(temp_path, file_path)
+        except Exception as error:
+            logging.warning("Failed to cache content file %s: %s", key, error)
+            temp_path.unlink(missing_ok=True)
+            return
+        # A stale entry with the same key is replaced
+        self.evict(key)
+        self.entries[key] = CachedContentFile(
+            file_path=file_path,
+            etag=etag,
+            size=downloader.size,
+            mime_type=mime_type,
+            last_modified=downloader.properties.last_modified,
+            validated_at=time.monotonic(),
+        )
+        self.total_bytes += downloader.size
+        while self.total_bytes > self.max_bytes and self.entries:
+            self.evict(next(iter(self.entries)))
+
+    def stats(self) -> dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "bytes_saved": self.bytes_saved,
+            "bytes": self.total_bytes,
+            "files": len(self.entries),
+        }
+
+    def close(self):
+        for task in self.fill_tasks.values():
+            task.cancel()
+        self.entries.clear()
+        self.total_bytes = 0
+        shutil.rmtree(self.directory, ignore_errors=True)
@@ -0,0 +1,94 @@
+import asyncio
+import math
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncGenerator, Awaitable, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+class DeadlineExceededError(Exception):
+    """Raised when a step of a request is still running when the deadline of the request passes."""
+
+    def __init__(self, step: str):
+        super().__init__(f"The request deadline passed during the {step} step")
+        self.step = step
+
+
+class RequestDeadline:
+    """
+    The time left to answer one request, shared by all of its steps, so that one slow call to OpenAI or
+    AI Search can't use up the whole budget before the user gets an answer or an error.
+    Each call is given what is left of the budget as its timeout, including the retries of the SDKs.
+    degrade_below maps the optional steps, such as "query_rewrite", "vector_search" and "semantic_ranker",
+    to the seconds that must be left to still take them; the steps that were skipped are kept in degradations.
+    Without seconds, the request has no deadline and nothing is skipped.
+    Time spent queueing, for a fair-share slot or for the OpenAI admission budget, doesn't count against the deadline,
+    as those waits have limits of their own.
+    """
+
+    def __init__(self, seconds: Optional[float] = None, degrade_below: Optional[dict[str, float]] = None):
+        self.seconds = seconds
+        self.degrade_below = degrade_below or {}
+        self.degradations: list[dict[str, Any]] = []
+        self.start()
+
+    def start(self):
+        """Starts the budget over, for a deadline that was created before the request waited for its turn."""
+        self.expires = time.monotonic() + self.seconds if self.seconds else None
+
+    @asynccontextmanager
+    async def paused(self) -> AsyncGenerator[None, None]:
+        """Gives the time spent in the block back to the request, for waits in a queue."""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            if self.expires is not None:
+                self.expires += time.monotonic() - start
+
+    def remaining(self) -> float:
+        if self.expires is None:
+            return math.inf
+        return self.expires - time.monotonic()
+
+    def degrade(self, step: str) -> bool:
+        """Returns whether there is too little time left for the step, and records that it was skipped if so."""
+        remaining = self.remaining()
+        if remaining >= self.degrade_below.get(step, 0):
+            return False
+        self.degradations.append({"step": step, "remaining_ms": round(remaining * 1000)})
+        return True
+
+    async def run(self, step: str, awaitable: Awaitable[T]) -> T:
+        remaining = self.remaining()
+        if remaining == math.inf:
+            return await awaitable
+        if remaining <= 0:
+            # The call is dropped without being started, or cancelled if it is already running in a task
+            if asyncio.iscoroutine(awaitable):
+                awaitable.close()
+            elif isinstance(awaitable, asyncio.Future):
+                awaitable.cancel()
+            raise DeadlineExceededError(step)
+        try:
+            return await asyncio.wait_for(awaitable, remaining)
+        except asyncio.TimeoutError:
+            raise DeadlineExceededError(step) from None
+
+
+class DeadlinePolicy:
+    """Starts the deadline of each request, from a default number of seconds that can be set per route."""
+
+    def __init__(
+        self,
+        seconds: float = 0,
+        route_seconds: Optional[dict[str, float]] = None,
+        degrade_below: Optional[dict[str, float]] = None,
+    ):
+        self.seconds = seconds
+        self.route_seconds = route_seconds or {}
+        self.degrade_below = degrade_below or {}
+
+    def start(self, route: str) -> RequestDeadline:
+        return RequestDeadline(self.route_seconds.get(route, self.seconds), self.degrade_below)
@@ -0,0 +1,134 @@
+import asyncio
+import hashlib
+import json
+import logging
+import sqlite3
+import time
+import unicodedata
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from core.cache import TTLCache
+
+
+def normalize_query_text(text: str) -> str:
+    return " ".join(unicodedata.normalize("NFKC", text).split())
+
+
+class SQLiteEmbeddingStore:
+    """
+    Embedding store in a local SQLite file, so that workers on the same instance share the vectors they computed.
+    All queries run on a single dedicated thread, which keeps the connection on one thread and off the event loop.
+    """
+
+    def __init__(self, path: str, max_entries: int = 100000, prune_every: int = 1000):
+        self.max_entries = max_entries
+        self.prune_every = prune_every
+        self.writes = 0
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="embedding-store")
+        self.connection = self.executor.submit(self.connect, path).result()
+
+    def connect(self, path: str) -> sqlite3.Connection:
+        connection = sqlite3.connect(path, timeout=5, check_same_thread=False)
+        # Write-ahead logging lets other workers keep reading while one of them writes
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL, created_at REAL NOT NULL)"
+        )
+        connection.commit()
+        return connection
+
+    async def get(self, key: str) -> Optional[bytes]:
+        def select() -> Optional[bytes]:
+            row = self.connection.execute("SELECT vector FROM embeddings WHERE key = ?", (key,)).fetchone()
+            return row[0] if row else None
+
+        return await asyncio.get_running_loop().run_in_executor(self.executor, select)
+
+    async def set(self, key: str, vector: bytes):
+        self.writes += 1
+        prune = self.writes % self.prune_every == 0
+
+        def insert():
+            self.connection.execute(
+                "INSERT OR REPLACE INTO embeddings (key, vector, created_at) VALUES (?, ?, ?)",
+                (key, vector, time.time()),
+            )
+            if prune:
+                self.connection.execute(
+                    "DELETE FROM embeddings WHERE key IN "
+                    "(SELECT key FROM embeddings ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,),
+                )
+            self.connection.commit()
+
+        await asyncio.get_running_loop().run_in_executor(self.executor, insert)
+
+    def close(self):
+        self.executor.submit(self.connection.close).result()
+        self.executor.shutdown()
+
+
+class QueryEmbeddingCache:
+    """
+    Cache of query embeddings keyed by (model, dimensions, normalized text).
+    Vectors are kept as float32 arrays, which take half the memory of Python float lists.
+    Lookups go to the in-process LRU first and then to the optional shared store, whose hits are promoted in-process.
+    """
+
+    def __init__(self, maxsize: int, shared_store: Optional[SQLiteEmbeddingStore] = None):
+        self.memory: TTLCache[tuple[str, Optional[int], str], array] = TTLCache(maxsize=maxsize, ttl=float("inf"))
+        self.shared_store = shared_store
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def shared_key(key: tuple[str, Optional[int], str]) -> str:
+        return hashlib.sha256(json.dumps(key).encode()).hexdigest()
+
+    async def get(self, model: str, dimensions: Optional[int], text: str) -> Optional[list[float]]:
+        key = (model, dimensions, normalize_query_text(text))
+        vector = self.memory.get(key)
+        if vector is not None:
+            self.hits += 1
+            return vector.tolist()
+        if self.shared_store:
+            try:
+                vector_bytes = await self.shared_store.get(self.shared_key(key))
+            except sqlite3.Error as error:
+                logging.warning("Failed to read query embedding from the shared store: %s", error)
+                vector_bytes = None
+            if vector_bytes is not None:
+                vector = array("f")
+                vector.frombytes(vector_bytes)
+                self.memory.set(key, vector)
+                self.shared_hits += 1
+                return vector.tolist()
+        self.misses += 1
+        return None
+
+    async def set(self, model: str, dimensions: Optional[int], text: str, vector: list[float]):
+        key = (model, dimensions, normalize_query_text(text))
+        float32_vector = array("f", vector)
+        self.memory.set(key, float32_vector)
+        if self.shared_store:
+            try:
+                await self.shared_store.set(self.shared_key(key), float32_vector.tobytes())
+            except sqlite3.Error as error:
+                logging.warning("Failed to write query embedding to the shared store: %s", error)
+
+    def stats(self) -> dict[str, float]:
+        lookups = self.hits + self.shared_hits + self.misses
+        return {
+            "hits": self.hits,
+            "shared_hits": self.shared_hits,
+            "misses": self.misses,
+            "hit_ratio": (self.hits + self.shared_hits) / lookups if lookups else 0.0,
+            "size": len(self.memory),
+        }
+
+    def close(self):
+        if self.shared_store:
+            self.shared_store.close()
@@ -0,0 +1,134 @@
+import asyncio
+import heapq
+import itertools
+from contextlib import asynccontextmanager
+from typing import Any, AsyncGenerator, Optional
+
+from core.admission import AdmissionRejectedError
+
+
+class FairShareScheduler:
+    """
+    Limits the requests that run at the same time, and when they are all taken, lets the waiting requests in
+    by weighted fair queuing (start-time fair queuing) per identity, such as a user or a client address.
+    Every request of an identity moves its next place in line back by 1 / weight, so an identity that sends
+    many requests waits behind the others, and one with twice the weight gets twice the share.
+    With a max_concurrency of 0 requests are never queued, but their counts are still kept.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = 0,
+        max_wait: float = 60.0,
+        group_weights: Optional[dict[str, float]] = None,
+        route_weights: Optional[dict[str, float]] = None,
+    ):
+        self.max_concurrency = max_concurrency
+        self.max_wait = max_wait
+        self.group_weights = group_weights or {}
+        self.route_weights = route_weights or {}
+        for name, weight in {**self.group_weights, **self.route_weights}.items():
+            self.check_weight(weight, name)
+        self.virtual_time = 0.0
+        self.finish_tags: dict[str, float] = {}
+        self.running = 0
+        self.in_flight: dict[str, int] = {}
+        self.queued: dict[str, int] = {}
+        self.waiters: list[tuple[float, int, str, asyncio.Future]] = []
+        self.sequence = itertools.count()
+        self.rejected = 0
+
+    @staticmethod
+    def check_weight(weight: float, name: str = "request"):
+        # A weight of 0 would have no place in line, and a negative one would jump ahead of every request
+        if not isinstance(weight, (int, float)) or weight <= 0:
+            raise ValueError(f"The fair-share weight of {name} must be a number above 0, got {weight!r}")
+
+    def get_weight(self, auth_claims: dict[str, Any], route: str) -> float:
+        """The weight of the route, times the largest weight of the groups of the user (1 for no group)."""
+        group_weights = [
+            self.group_weights[group] for group in auth_claims.get("groups", []) if group in self.group_weights
+        ]
+        return self.route_weights.get(route, 1.0) * max(group_weights, default=1.0)
+
+    def dispatch(self, identity: str, start_tag: float):
+        self.running += 1
+        self.in_flight[identity] = self.in_flight.get(identity, 0) + 1
+        self.virtual_time = max(self.virtual_time, start_tag)
+
+    def forget(self, identity: str):
+        if self.in_flight.get(identity) == 0:
+            del self.in_flight[identity]
+        if self.queued.get(identity) == 0:
+            del self.queued[identity]
+        # Past finish tags are overtaken by the virtual time anyway
+        if identity not in self.in_flight and identity not in self.queued:
+            if self.finish_tags.get(identity, 0.0) <= self.virtual_time:
+                self.finish_tags.pop(identity, None)
+
+    async def acquire(self, identity: str, weight: float = 1.0):
+        self.check_weight(weight)
+        start_tag = max(self.virtual_time, self.finish_tags.get(identity, 0.0))
+        self.finish_tags[identity] = start_tag + 1 / weight
+        if self.max_concurrency <= 0 or (self.running < self.max_concurrency and not self.waiters):
+            self.dispatch(identity, start_tag)
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (start_tag, next(self.sequence), identity, future))
+        self.queued[identity] = self.queued.get(identity, 0) + 1
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.max_wait)
+        except asyncio.TimeoutError:
+            if not future.done():
+                future.cancel()
+                self.rejected += 1
+                raise AdmissionRejectedError("Too many requests are waiting to be answered", 503, self.max_wait)
+        except asyncio.CancelledError:
+            # The slot may have been handed over while this request was being cancelled
+            if not future.cancel():
+                self.release(identity)
+            raise
+        finally:
+            self.queued[identity] -= 1
+            self.forget(identity)
+
+    def release(self, identity: str):
+        self.running -= 1
+        self.in_flight[identity] -= 1
+        self.forget(identity)
+        while self.waiters and self.running < self.max_concurrency:
+            start_tag, _, waiter_identity, future = heapq.heappop(self.waiters)
+            if future.cancelled():
+                continue
+            self.dispatch(waiter_identity, start_tag)
+            future.set_result(None)
+
+    @asynccontextmanager
+    async def slot(self, identity: str, weight: float = 1.0) -> AsyncGenerator[None, None]:
+        await self.acquire(identity, weight)
+        try:
+            yield
+        finally:
+            self.release(identity)
+
+    async def schedule(
+        self, events: AsyncGenerator[dict[str, Any], None], identity: str, weight: float = 1.0
+    ) -> AsyncGenerator[dict[str, Any], None]:
+        """Holds a slot from when a streamed response starts until it is done or closed."""
+        try:
+            async with self.slot(identity, weight):
+                async for event in events:
+                    yield event
+        finally:
+            await events.aclose()
+
+    def stats(self) -> dict[str, float]:
+        # Identities are user IDs or addresses, so only the busiest one is published, not a value per identity
+        return {
+            "in_flight": self.running,
+            "queued": sum(self.queued.values()),
+            "identities": len(self.in_flight.keys() | self.queued.keys()),
+            "identity_max_in_flight": max(self.in_flight.values(), default=0),
+            "identity_max_queued": max(self.queued.values(), default=0),
+            "rejected": self.rejected,
+        }
@@ -0,0 +1,88 @@
+from types import SimpleNamespace
+from typing import Optional
+
+import aiohttp
+
+
+class HTTPClientRegistry:
+    """
+    App-lifetime aiohttp sessions for the services that are called without an Azure SDK client,
+    such as Azure AI Vision and Content Understanding.
+    Every named session shares one connection pool, so connections (and their TLS handshakes) are kept alive
+    and reused across requests instead of being opened for every call.
+    Sessions are created lazily because aiohttp needs a running event loop.
+    """
+
+    def __init__(self, limit: int = 100, limit_per_host: int = 20, keepalive_timeout: float = 30):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.connector: Optional[aiohttp.TCPConnector] = None
+        self.sessions: dict[str, aiohttp.ClientSession] = {}
+        self.requests_in_flight = 0
+        self.requests = 0
+        self.connections_created = 0
+        self.connections_reused = 0
+        self.connection_queued = 0
+
+    def create_trace_config(self) -> aiohttp.TraceConfig:
+        async def on_request_start(session, context: SimpleNamespace, params):
+            self.requests += 1
+            self.requests_in_flight += 1
+
+        async def on_request_end(session, context: SimpleNamespace, params):
+            self.requests_in_flight -= 1
+
+        async def on_connection_queued_start(session, context: SimpleNamespace, params):
+            self.connection_queued += 1
+
+        async def on_connection_create_end(session, context: SimpleNamespace, params):
+            self.connections_created += 1
+
+        async def on_connection_reuseconn(session, context: SimpleNamespace, params):
+            self.connections_reused += 1
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_request_end.append(on_request_end)
+        trace_config.on_request_exception.append(on_request_end)
+        trace_config.on_connection_queued_start.append(on_connection_queued_start)
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+        return trace_config
+
+    def session(self, name: str) -> aiohttp.ClientSession:
+        session = self.sessions.get(name)
+        if session is None or session.closed:
+            if self.connector is None or self.connector.closed:
+                self.connector = aiohttp.TCPConnector(
+                    limit=self.limit,
+                    limit_per_host=self.limit_per_host,
+                    keepalive_timeout=self.keepalive_timeout,
+                    ttl_dns_cache=300,
+                )
+            session = aiohttp.ClientSession(
+                connector=self.connector, connector_owner=False, trace_configs=[self.create_trace_config()]
+            )
+            self.sessions[name] = session
+        return session
+
+    def stats(self) -> dict[str, float]:
+        connections = self.connections_created + self.connections_reused
+        return {
+            "requests": self.requests,
+            "requests_in_flight": self.requests_in_flight,
+            "utilization": self.requests_in_flight / self.limit if self.limit else 0.0,
+            "connections_created": self.connections_created,
+            "connections_reused": self.connections_reused,
+            "connection_reuse_ratio": self.connections_reused / connections if connections else 0.0,
+            "connection_queued": self.connection_queued,
+        }
+
+    async def close(self):
+        for session in self.sessions.values():
+            await session.close()
+        self.sessions.clear()
+        if self.connector is not None:
+            await self.connector.close()
+            self.connector = None
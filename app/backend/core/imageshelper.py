@@ -1,10 +1,22 @@
+import asyncio
 import base64
+import datetime
+import io
 import logging
+import math
 import os
-from typing import Optional
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Optional, cast
+from urllib.parse import urlsplit
 
-from azure.core.exceptions import ResourceNotFoundError
-from azure.storage.blob.aio import ContainerClient
+from azure.core import MatchConditions
+from azure.core.exceptions import HttpResponseError, ResourceNotFoundError
+from azure.storage.blob import BlobSasPermissions, UserDelegationKey, generate_blob_sas
+from azure.storage.blob.aio import BlobServiceClient, ContainerClient
+from openai.types.chat import ChatCompletionMessageParam
+from PIL import Image
 from typing_extensions import Literal, Required, TypedDict
 
 from approaches.approach import Document
@@ -18,26 +30,290 @@ class ImageURL(TypedDict, total=False):
     """Specifies the detail level of the image."""
 
 
-async def download_blob_as_base64(blob_container_client: ContainerClient, file_path: str) -> Optional[str]:
+@dataclass
+class CachedImage:
+    etag: str
+    data_uri: str
+    validated_at: float
+
+
+class ImageCache:
+    """
+    Size-bounded in-memory cache of page images as ready-to-send base64 data URIs, evicted in least-recently-used order.
+    Each entry belongs to the ETag of the blob it was encoded from. Entries are served without contacting storage
+    until they are older than revalidate_after seconds, and are then downloaded again only if the ETag changed.
+    """
+
+    def __init__(self, max_bytes: int, revalidate_after: float = 60):
+        self.max_bytes = max_bytes
+        self.revalidate_after = revalidate_after
+        self.entries: OrderedDict[str, CachedImage] = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, blob_name: str) -> Optional[CachedImage]:
+        entry = self.entries.get(blob_name)
+        if entry is not None:
+            self.entries.move_to_end(blob_name)
+        return entry
+
+    def needs_revalidation(self, entry: CachedImage) -> bool:
+        return time.monotonic() - entry.validated_at >= self.revalidate_after
+
+    def mark_validated(self, entry: CachedImage):
+        entry.validated_at = time.monotonic()
+
+    def set(self, blob_name: str, etag: str, data_uri: str):
+        self.evict(blob_name)
+        if len(data_uri) > self.max_bytes:
+            return
+        self.entries[blob_name] = CachedImage(etag=etag, data_uri=data_uri, validated_at=time.monotonic())
+        self.total_bytes += len(data_uri)
+        while self.total_bytes > self.max_bytes:
+            self.evict(next(iter(self.entries)))
+
+    def evict(self, blob_name: str):
+        entry = self.entries.pop(blob_name, None)
+        if entry is not None:
+            self.total_bytes -= len(entry.data_uri)
+
+    def stats(self) -> dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "bytes": self.total_bytes,
+            "images": len(self.entries),
+        }
+
+
+def image_blob_name(file_path: str) -> str:
     base_name, _ = os.path.splitext(file_path)
-    image_filename = base_name + ".png"
+    return base_name + ".png"
+
+
+class ImageDelivery:
+    """
+    How page images are handed to GPT-4 vision.
+    "base64" inlines the stored PNG as a data URI, "downscale" inlines a JPEG recompressed to at most max_pixels,
+    and "sas" sends a short-lived read-only SAS URL so that the model downloads the image from Blob Storage itself.
+    The SAS URLs are signed with a user delegation key, which is requested once and reused until close to its expiry.
+    They are signed without checking that the blob exists, as every page of an indexed document has an image.
+    As anyone with a SAS URL can read the blob without the app's access checks, the URLs are redacted to the path
+    of the blob before they are shown to the client.
+    """
+
+    MODES = ("base64", "downscale", "sas")
+    DETAILS = ("auto", "low", "high")
+
+    def __init__(
+        self,
+        mode: str = "base64",
+        detail: str = "auto",
+        max_pixels: int = 768 * 768,
+        jpeg_quality: int = 80,
+        blob_service_client: Optional[BlobServiceClient] = None,
+        sas_expiry: datetime.timedelta = datetime.timedelta(minutes=15),
+    ):
+        if mode not in self.MODES:
+            raise ValueError(f"Image delivery mode must be one of {', '.join(self.MODES)}, got {mode}")
+        if detail not in self.DETAILS:
+            raise ValueError(f"Image detail must be one of {', '.join(self.DETAILS)}, got {detail}")
+        if mode == "sas" and blob_service_client is None:
+            raise ValueError("A blob service client is required to sign SAS URLs for images")
+        self.mode = mode
+        self.detail = cast(Literal["auto", "low", "high"], detail)
+        self.max_pixels = max_pixels
+        self.jpeg_quality = jpeg_quality
+        self.blob_service_client = blob_service_client
+        self.sas_expiry = sas_expiry
+        self.user_delegation_key: Optional[UserDelegationKey] = None
+        self.user_delegation_key_expiry: Optional[datetime.datetime] = None
+        # Concurrent image fetches that find no valid key wait for a single request for a new one
+        self.user_delegation_key_lock = asyncio.Lock()
+        self.images = 0
+        self.stored_bytes = 0
+        self.delivered_bytes = 0
+
+    def downscale(self, image_bytes: bytes) -> bytes:
+        with Image.open(io.BytesIO(image_bytes)) as image:
+            pixels = image.width * image.height
+            if pixels > self.max_pixels:
+                scale = math.sqrt(self.max_pixels / pixels)
+                image = image.resize(
+                    (max(1, int(image.width * scale)), max(1, int(image.height * scale))), Image.Resampling.LANCZOS
+                )
+            output = io.BytesIO()
+            image.convert("RGB").save(output, format="JPEG", quality=self.jpeg_quality, optimize=True)
+            return output.getvalue()
+
+    async def encode(self, image_bytes: bytes) -> str:
+        if self.mode == "downscale":
+            image_bytes = await asyncio.get_running_loop().run_in_executor(None, self.downscale, image_bytes)
+            return "data:image/jpeg;base64," + base64.b64encode(image_bytes).decode("utf-8")
+        return "data:image/png;base64," + base64.b64encode(image_bytes).decode("utf-8")
+
+    def has_valid_user_delegation_key(self, now: datetime.datetime) -> bool:
+        return (
+            self.user_delegation_key is not None
+            and self.user_delegation_key_expiry is not None
+            and self.user_delegation_key_expiry - now >= self.sas_expiry
+        )
+
+    async def get_user_delegation_key(self, now: datetime.datetime) -> UserDelegationKey:
+        if not self.has_valid_user_delegation_key(now):
+            async with self.user_delegation_key_lock:
+                # Another fetch may have requested a new key while this one was waiting for the lock
+                if not self.has_valid_user_delegation_key(now):
+                    if self.blob_service_client is None:
+                        raise ValueError("A blob service client is required to sign SAS URLs for images")
+                    # Backdate the start to tolerate clock skew between this host and the storage service
+                    expiry = now + datetime.timedelta(days=1)
+                    self.user_delegation_key = await self.blob_service_client.get_user_delegation_key(
+                        now - datetime.timedelta(minutes=5), expiry
+                    )
+                    self.user_delegation_key_expiry = expiry
+        return cast(UserDelegationKey, self.user_delegation_key)
+
+    async def sas_url(self, blob_container_client: ContainerClient, blob_name: str) -> str:
+        """Returns a read-only SAS URL for the blob."""
+        blob_client = blob_container_client.get_blob_client(blob_name)
+        now = datetime.datetime.now(datetime.timezone.utc)
+        user_delegation_key = await self.get_user_delegation_key(now)
+        if blob_client.account_name is None:
+            raise ValueError("The storage account name is required to sign SAS URLs for images")
+        sas_token = generate_blob_sas(
+            account_name=blob_client.account_name,
+            container_name=blob_container_client.container_name,
+            blob_name=blob_name,
+            user_delegation_key=user_delegation_key,
+            permission=BlobSasPermissions(read=True),
+            start=now - datetime.timedelta(minutes=5),
+            expiry=now + self.sas_expiry,
+        )
+        return f"{blob_client.url}?{sas_token}"
+
+    def record(self, stored_bytes: int, delivered_bytes: int):
+        self.images += 1
+        self.stored_bytes += stored_bytes
+        self.delivered_bytes += delivered_bytes
+
+    def stats(self) -> dict[str, float]:
+        return {
+            "images": self.images,
+            "stored_bytes": self.stored_bytes,
+            "delivered_bytes": self.delivered_bytes,
+            "delivered_ratio": self.delivered_bytes / self.stored_bytes if self.stored_bytes else 0.0,
+        }
+
+    async def close(self):
+        if self.blob_service_client:
+            await self.blob_service_client.close()
+
+
+async def download_blob_as_base64(
+    blob_container_client: ContainerClient,
+    file_path: str,
+    image_cache: Optional[ImageCache] = None,
+    delivery: Optional[ImageDelivery] = None,
+) -> Optional[str]:
+    image_filename = image_blob_name(file_path)
+    cached = image_cache.lookup(image_filename) if image_cache else None
+    if image_cache and cached:
+        if not image_cache.needs_revalidation(cached):
+            image_cache.hits += 1
+            return cached.data_uri
     try:
-        blob = await blob_container_client.get_blob_client(image_filename).download_blob()
+        blob_client = blob_container_client.get_blob_client(image_filename)
+        if cached:
+            blob = await blob_client.download_blob(etag=cached.etag, match_condition=MatchConditions.IfModified)
+        else:
+            blob = await blob_client.download_blob()
         if not blob.properties:
             logging.warning(f"No blob exists for {image_filename}")
             return None
-        img = base64.b64encode(await blob.readall()).decode("utf-8")
-        return f"data:image/png;base64,{img}"
+        image_bytes = await blob.readall()
+        if delivery:
+            data_uri = await delivery.encode(image_bytes)
+            delivery.record(len(image_bytes), len(data_uri))
+        else:
+            img = base64.b64encode(image_bytes).decode("utf-8")
+            data_uri = f"data:image/png;base64,{img}"
     except ResourceNotFoundError:
         logging.warning(f"No blob exists for {image_filename}")
+        if image_cache:
+            image_cache.evict(image_filename)
         return None
+    except HttpResponseError as error:
+        # The storage SDK reports an unchanged blob as an error with status 304
+        if image_cache and cached and error.status_code == 304:
+            image_cache.mark_validated(cached)
+            image_cache.hits += 1
+            return cached.data_uri
+        raise
+    if image_cache:
+        image_cache.misses += 1
+        if blob.properties.etag:
+            image_cache.set(image_filename, blob.properties.etag, data_uri)
+    return data_uri
 
 
-async def fetch_image(blob_container_client: ContainerClient, result: Document) -> Optional[ImageURL]:
+async def fetch_image(
+    blob_container_client: ContainerClient,
+    result: Document,
+    image_cache: Optional[ImageCache] = None,
+    delivery: Optional[ImageDelivery] = None,
+) -> Optional[ImageURL]:
     if result.sourcepage:
-        img = await download_blob_as_base64(blob_container_client, result.sourcepage)
+        detail = delivery.detail if delivery else "auto"
+        if delivery and delivery.mode == "sas":
+            sas_url = await delivery.sas_url(blob_container_client, image_blob_name(result.sourcepage))
+            return {"url": sas_url, "detail": detail}
+        img = await download_blob_as_base64(blob_container_client, result.sourcepage, image_cache, delivery)
         if img:
-            return {"url": img, "detail": "auto"}
+            return {"url": img, "detail": detail}
         else:
             return None
     return None
+
+
+async def fetch_images(
+    blob_container_client: ContainerClient,
+    results: list[Document],
+    image_cache: Optional[ImageCache] = None,
+    max_concurrency: int = 4,
+    delivery: Optional[ImageDelivery] = None,
+) -> list[ImageURL]:
+    """Fetches the page images of the results concurrently, in the order of the results, skipping missing images."""
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def fetch(result: Document) -> Optional[ImageURL]:
+        async with semaphore:
+            return await fetch_image(blob_container_client, result, image_cache, delivery)
+
+    images = await asyncio.gather(*(fetch(result) for result in results))
+    return [image for image in images if image]
+
+
+def redact_image_url(image_url: Any) -> Any:
+    """Replaces a SAS URL of an image, which grants access to the blob without any check, by the path of the blob."""
+    if image_url["url"].startswith("data:"):
+        return image_url
+    return {**image_url, "url": urlsplit(image_url["url"]).path}
+
+
+def redact_image_urls(messages: list[ChatCompletionMessageParam]) -> list[ChatCompletionMessageParam]:
+    """Returns the messages to show to the client, with the SAS URLs of their images redacted."""
+    redacted: list[Any] = []
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, list):
+            redacted_content = [
+                {**part, "image_url": redact_image_url(part["image_url"])} if part["type"] == "image_url" else part
+                for part in content
+            ]
+            message = cast(ChatCompletionMessageParam, {**message, "content": redacted_content})
+        redacted.append(message)
+    return redacted
@@ -0,0 +1,194 @@
+import hashlib
+import json
+import logging
+import math
+import unicodedata
+from collections.abc import Iterable
+from typing import Any, Optional, Union
+
+from openai.types.chat import (
+    ChatCompletionContentPartParam,
+    ChatCompletionMessageParam,
+    ChatCompletionToolChoiceOptionParam,
+    ChatCompletionToolParam,
+)
+from openai_messages_token_helper import (
+    count_tokens_for_message,
+    count_tokens_for_system_and_tools,
+    get_token_limit,
+)
+from openai_messages_token_helper.model_helper import encoding_for_model
+
+from core.cache import TTLCache
+
+
+def normalize_content(content: Union[str, Iterable[ChatCompletionContentPartParam], None]) -> Any:
+    if content is None:
+        return None
+    if isinstance(content, str):
+        return unicodedata.normalize("NFC", content)
+    for part in content:
+        if "image_url" not in part:
+            part["text"] = unicodedata.normalize("NFC", part["text"])  # type: ignore[typeddict-item]
+    return content
+
+
+class TokenCountCache:
+    """
+    Per-process cache of the token counts from openai_messages_token_helper, keyed by the model and a hash of the message.
+    The conversation history, the system prompts, the few-shots and the tools are the same from one turn to the next,
+    so each of them is tokenized once instead of on every build_messages call.
+    """
+
+    def __init__(self, maxsize: int = 10000):
+        self.counts: TTLCache[tuple[str, bool, bytes], int] = TTLCache(maxsize, math.inf)
+
+    @staticmethod
+    def key(model: str, fallback_to_default: bool, *parts: Any) -> tuple[str, bool, bytes]:
+        payload = json.dumps(parts, ensure_ascii=False, sort_keys=True, default=str)
+        return model, fallback_to_default, hashlib.blake2b(payload.encode("utf-8"), digest_size=16).digest()
+
+    def count_message(self, model: str, message: ChatCompletionMessageParam, fallback_to_default: bool = False) -> int:
+        key = self.key(model, fallback_to_default, message)
+        count = self.counts.get(key)
+        if count is None:
+            count = count_tokens_for_message(model, message, default_to_cl100k=fallback_to_default)
+            self.counts.set(key, count)
+        return count
+
+    def count_system_and_tools(
+        self,
+        model: str,
+        system_message: ChatCompletionMessageParam,
+        tools: Optional[list[ChatCompletionToolParam]] = None,
+        tool_choice: Optional[ChatCompletionToolChoiceOptionParam] = None,
+        fallback_to_default: bool = False,
+    ) -> int:
+        key = self.key(model, fallback_to_default, system_message, tools, tool_choice)
+        count = self.counts.get(key)
+        if count is None:
+            count = count_tokens_for_system_and_tools(
+                model, system_message, tools, tool_choice, default_to_cl100k=fallback_to_default  # type: ignore[arg-type]
+            )
+            self.counts.set(key, count)
+        return count
+
+    def stats(self) -> dict[str, int]:
+        return self.counts.stats()
+
+
+token_count_cache = TokenCountCache()
+
+
+def make_message(
+    role: str, content: Any, tool_calls: Optional[Any] = None, tool_call_id: Optional[str] = None
+) -> ChatCompletionMessageParam:
+    if role == "user":
+        return {"role": "user", "content": normalize_content(content)}
+    elif role == "assistant" and isinstance(content, str):
+        return {"role": "assistant", "content": normalize_content(content)}
+    elif role == "assistant" and tool_calls is not None:
+        return {"role": "assistant", "tool_calls": tool_calls}
+    elif role == "tool" and tool_call_id is not None:
+        return {"role": "tool", "tool_call_id": tool_call_id, "content": normalize_content(content)}
+    raise ValueError("Invalid message for builder")
+
+
+def build_messages(
+    model: str,
+    system_prompt: str,
+    *,
+    tools: Optional[list[ChatCompletionToolParam]] = None,
+    tool_choice: Optional[ChatCompletionToolChoiceOptionParam] = None,
+    new_user_content: Union[str, list[ChatCompletionContentPartParam], None] = None,
+    past_messages: list[ChatCompletionMessageParam] = [],
+    few_shots: list[ChatCompletionMessageParam] = [],
+    max_tokens: Optional[int] = None,
+    fallback_to_default: bool = False,
+) -> list[ChatCompletionMessageParam]:
+    """
+    Drop-in replacement for openai_messages_token_helper.build_messages that returns the same messages,
+    but takes the token counts from token_count_cache.
+    The history is added newest first for as long as it fits in max_tokens, as in the original.
+    """
+    if max_tokens is None:
+        max_tokens = get_token_limit(model, default_to_minimum=fallback_to_default)
+
+    system_message: ChatCompletionMessageParam = {"role": "system", "content": normalize_content(system_prompt)}
+    required_messages: list[ChatCompletionMessageParam] = []
+    for shot in few_shots:
+        if shot["role"] is None or (shot.get("content") is None and shot.get("tool_calls") is None):
+            raise ValueError("Few-shot messages must have role and either content or tool_calls")
+        tool_call_id = shot.get("tool_call_id")
+        if tool_call_id is not None and not isinstance(tool_call_id, str):
+            raise ValueError("tool_call_id must be a string value")
+        tool_calls = shot.get("tool_calls")
+        if tool_calls is not None and not isinstance(tool_calls, Iterable):
+            raise ValueError("tool_calls must be a list of tool calls")
+        required_messages.append(make_message(shot["role"], shot.get("content"), tool_calls, tool_call_id))
+    if new_user_content:
+        required_messages.append(make_message("user", new_user_content))
+
+    total_token_count = token_count_cache.count_system_and_tools(
+        model, system_message, tools, tool_choice, fallback_to_default
+    )
+    for message in required_messages:
+        total_token_count += token_count_cache.count_message(model, message, fallback_to_default)
+
+    history: list[ChatCompletionMessageParam] = []
+    for message in reversed(past_messages):
+        potential_message_count = token_count_cache.count_message(model, message, fallback_to_default)
+        if (total_token_count + potential_message_count) > max_tokens:
+            logging.info("Reached max tokens of %d, history will be truncated", max_tokens)
+            break
+        if message["role"] is None or message["content"] is None:
+            raise ValueError("Few-shot messages must have both role and content")
+        history.append(make_message(message["role"], message["content"]))
+        total_token_count += potential_message_count
+    history.reverse()
+
+    append_index = len(few_shots)
+    return [system_message] + required_messages[:append_index] + history + required_messages[append_index:]
+
+
+def count_prompt_tokens(
+    model: str,
+    messages: list[ChatCompletionMessageParam],
+    *,
+    tools: Optional[list[ChatCompletionToolParam]] = None,
+    fallback_to_default: bool = False,
+) -> int:
+    """Counts the prompt tokens of messages returned by build_messages, which are mostly in token_count_cache already."""
+    system_message, *other_messages = messages
+    count = token_count_cache.count_system_and_tools(model, system_message, tools, None, fallback_to_default)
+    for message in other_messages:
+        count += token_count_cache.count_message(model, message, fallback_to_default)
+    return count
+
+
+def count_text_tokens(model: str, text: str, fallback_to_default: bool = False) -> int:
+    """Counts the tokens of generated text, such as the part of an answer that was streamed before it was cancelled."""
+    return len(encoding_for_model(model, default_to_cl100k=fallback_to_default).encode(text))
+
+
+def precount_messages(
+    model: str,
+    system_prompt: str,
+    *,
+    tools: Optional[list[ChatCompletionToolParam]] = None,
+    few_shots: list[ChatCompletionMessageParam] = [],
+    fallback_to_default: bool = False,
+):
+    """Tokenizes a static prompt ahead of the first request, so that build_messages finds its counts in the cache."""
+    try:
+        build_messages(
+            model,
+            system_prompt,
+            tools=tools,
+            few_shots=few_shots,
+            max_tokens=math.inf,  # type: ignore[arg-type]
+            fallback_to_default=fallback_to_default,
+        )
+    except Exception:
+        # The tokenizer may not be available yet (its encoding is downloaded on first use), so count on first request
+        logging.warning("Could not count the tokens of a static prompt ahead of time", exc_info=True)
@@ -0,0 +1,35 @@
+from typing import Callable, Dict, Iterable, Mapping, Set, Union
+
+from opentelemetry import metrics
+from opentelemetry.metrics import CallbackOptions, Observation
+
+# Instruments created from this meter are no-ops unless a meter provider is configured,
+# which configure_azure_monitor() does when APPLICATIONINSIGHTS_CONNECTION_STRING is set
+meter = metrics.get_meter("app")
+
+# setup_clients() runs again for every test app and worker restart, so gauges are created once per name
+# and their callbacks read whichever stats function was registered last for the prefix
+_stats_sources: Dict[str, Callable[[], Mapping[str, Union[int, float]]]] = {}
+_registered_gauges: Set[str] = set()
+
+
+def register_stats_gauges(prefix: str, stats: Callable[[], Mapping[str, Union[int, float]]]):
+    """
+    Publishes every entry returned by the stats function as an OpenTelemetry observable gauge named "{prefix}.{key}".
+    The stats function is only called when metrics are collected, so it should be cheap and non-blocking.
+    Registering the same prefix again replaces the stats function instead of creating new gauges.
+    """
+
+    def make_callback(key: str):
+        def callback(options: CallbackOptions) -> Iterable[Observation]:
+            current = _stats_sources[prefix]()
+            return [Observation(current[key])] if key in current else []
+
+        return callback
+
+    _stats_sources[prefix] = stats
+    for key in stats():
+        name = f"{prefix}.{key}"
+        if name not in _registered_gauges:
+            _registered_gauges.add(name)
+            meter.create_observable_gauge(name, callbacks=[make_callback(key)])
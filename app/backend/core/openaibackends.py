@@ -0,0 +1,292 @@
+import logging
+import time
+from typing import Any, AsyncIterator, Optional, cast
+from urllib.parse import urlsplit
+
+import httpx
+
+# Rate limit headers older than this are ignored, as Azure OpenAI quotas are counted per minute
+RATE_LIMIT_WINDOW_SECONDS = 60
+# Latency is smoothed over the last few calls, so one slow answer doesn't send all traffic elsewhere
+LATENCY_SMOOTHING = 0.2
+# A backend with almost no headroom left still gets a bounded score instead of a division by zero
+MIN_HEADROOM = 0.05
+# Assumed latency while no backend has answered yet, so that the calls in flight still spread the load
+DEFAULT_LATENCY = 1.0
+# Errors raised before the request reached the backend, so it is safe to send the call to another one
+CONNECTION_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout)
+
+
+def parse_number(value: Optional[str]) -> Optional[float]:
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+class OpenAIBackend:
+    """
+    One Azure OpenAI endpoint that OpenAIBackendPool can send calls to, with its live latency and rate limit headroom.
+    Backends with a lower priority number are used first, and the others only take the overflow.
+    deployments maps the deployment names used by the app to the names of the same models on this endpoint.
+    """
+
+    def __init__(
+        self,
+        endpoint: str,
+        name: Optional[str] = None,
+        priority: int = 0,
+        weight: float = 1.0,
+        deployments: Optional[dict[str, str]] = None,
+        api_key: Optional[str] = None,
+    ):
+        if weight <= 0:
+            raise ValueError("The weight of an OpenAI backend must be positive")
+        self.endpoint = endpoint.rstrip("/")
+        self.name = name or (urlsplit(self.endpoint).hostname or self.endpoint).split(".")[0]
+        self.priority = priority
+        self.weight = weight
+        self.deployments = deployments or {}
+        self.api_key = api_key
+        # Smoothed time until the response headers arrive, which is the time to first token for streamed answers
+        self.latency: Optional[float] = None
+        self.in_flight = 0
+        self.ejected_until = 0.0
+        self.remaining_requests: Optional[float] = None
+        self.remaining_tokens: Optional[float] = None
+        self.limit_tokens: Optional[float] = None
+        self.rate_limits_updated: Optional[float] = None
+        self.requests = 0
+        self.throttled = 0
+        self.errors = 0
+
+    def record_latency(self, seconds: float):
+        if self.latency is None:
+            self.latency = seconds
+        else:
+            self.latency += LATENCY_SMOOTHING * (seconds - self.latency)
+
+    def update_rate_limits(self, headers: httpx.Headers, now: float):
+        remaining_requests = parse_number(headers.get("x-ratelimit-remaining-requests"))
+        remaining_tokens = parse_number(headers.get("x-ratelimit-remaining-tokens"))
+        if remaining_requests is None and remaining_tokens is None:
+            return
+        self.remaining_requests = remaining_requests
+        self.remaining_tokens = remaining_tokens
+        if remaining_tokens is not None:
+            # Azure OpenAI only reports what remains, so the most ever seen remaining stands in for the limit
+            limit_tokens = parse_number(headers.get("x-ratelimit-limit-tokens"))
+            self.limit_tokens = limit_tokens or max(self.limit_tokens or 0, remaining_tokens)
+        self.rate_limits_updated = now
+
+    def headroom(self, now: float) -> float:
+        """The share of the token quota that is left, from 0 to 1, or 1 when it isn't known."""
+        if self.rate_limits_updated is None or now - self.rate_limits_updated > RATE_LIMIT_WINDOW_SECONDS:
+            return 1.0
+        if self.remaining_requests == 0:
+            return 0.0
+        if self.remaining_tokens is None or not self.limit_tokens:
+            return 1.0
+        return self.remaining_tokens / self.limit_tokens
+
+    def score(self, now: float, default_latency: float = DEFAULT_LATENCY) -> float:
+        """
+        Lower is better: the expected latency with the calls in flight, scaled by weight and headroom.
+        A backend without latency samples yet is assumed to be as fast as default_latency.
+        """
+        latency = self.latency if self.latency is not None else default_latency
+        return latency * (self.in_flight + 1) / (self.weight * max(self.headroom(now), MIN_HEADROOM))
+
+    def stats(self, now: float) -> dict[str, float]:
+        return {
+            "requests": self.requests,
+            "in_flight": self.in_flight,
+            "throttled": self.throttled,
+            "errors": self.errors,
+            "ejected": 1 if self.ejected_until > now else 0,
+            "latency_ms": round((self.latency or 0.0) * 1000, 1),
+            "headroom": round(self.headroom(now), 3),
+        }
+
+
+class InFlightStream(httpx.AsyncByteStream):
+    """
+    The body of a response, which keeps its call counted as in flight on the backend until it is closed,
+    as a streamed chat completion keeps the backend busy until its last chunk.
+    """
+
+    def __init__(self, stream: httpx.AsyncByteStream, backend: OpenAIBackend):
+        self.stream = stream
+        self.backend = backend
+        self.closed = False
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        async for chunk in self.stream:
+            yield chunk
+
+    async def aclose(self):
+        if not self.closed:
+            self.closed = True
+            self.backend.in_flight -= 1
+        await self.stream.aclose()
+
+
+class OpenAIBackendPool(httpx.AsyncBaseTransport):
+    """
+    An httpx transport that spreads the calls of one OpenAI client over several Azure OpenAI endpoints,
+    so chat completions and embeddings keep working when one deployment runs out of quota.
+    Each call goes to the backend with the best score in the lowest priority that still has headroom.
+    A backend that answers 429 is ejected until its retry-after and the call is sent to the next one;
+    the 429 only reaches the OpenAI SDK (and its own retries) once every backend has been throttled.
+    Calls that fail with a 5xx or can't connect are sent to the next backend as well, and a backend that
+    can't be connected to is ejected for default_retry_after seconds.
+    The client is created for the endpoint of the first backend, and its URLs are rewritten for the others.
+    """
+
+    def __init__(
+        self,
+        backends: list[OpenAIBackend],
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+        default_retry_after: float = 10.0,
+    ):
+        if not backends:
+            raise ValueError("At least one OpenAI backend is required")
+        if len({backend.name for backend in backends}) != len(backends):
+            raise ValueError("OpenAI backend names must be unique")
+        self.backends = backends
+        self.endpoint = backends[0].endpoint
+        # Same connection limits as the OpenAI SDK uses for its own transport
+        self.transport = transport or httpx.AsyncHTTPTransport(
+            limits=httpx.Limits(max_connections=1000, max_keepalive_connections=100)
+        )
+        self.default_retry_after = default_retry_after
+
+    @classmethod
+    def from_config(cls, config: list[dict[str, Any]]) -> "OpenAIBackendPool":
+        return cls([OpenAIBackend(**backend) for backend in config])
+
+    def choose(self, now: float, tried: list[OpenAIBackend]) -> Optional[OpenAIBackend]:
+        candidates = [backend for backend in self.backends if backend not in tried]
+        available = [backend for backend in candidates if backend.ejected_until <= now]
+        if not available:
+            if tried or not candidates:
+                return None
+            # Every backend is throttled, so the call goes to the one that recovers first rather than failing here
+            return min(candidates, key=lambda backend: backend.ejected_until)
+        with_headroom = [backend for backend in available if backend.headroom(now) > 0] or available
+        priority = min(backend.priority for backend in with_headroom)
+        # Backends that haven't answered yet are compared as if they were as fast as the average of the others
+        latencies = [backend.latency for backend in self.backends if backend.latency is not None]
+        default_latency = sum(latencies) / len(latencies) if latencies else DEFAULT_LATENCY
+        return min(
+            (backend for backend in with_headroom if backend.priority == priority),
+            key=lambda backend: backend.score(now, default_latency),
+        )
+
+    def rewrite(self, request: httpx.Request, backend: OpenAIBackend) -> httpx.Request:
+        url = str(request.url)
+        if not url.startswith(self.endpoint) or (
+            backend.endpoint == self.endpoint and not backend.deployments and not backend.api_key
+        ):
+            return request
+        path = url[len(self.endpoint) :]
+        for deployment, backend_deployment in backend.deployments.items():
+            prefix = f"/openai/deployments/{deployment}/"
+            if path.startswith(prefix):
+                path = f"/openai/deployments/{backend_deployment}/{path[len(prefix) :]}"
+                break
+        headers = request.headers.copy()
+        # Set again by httpx for the new URL
+        headers.pop("host", None)
+        if backend.api_key:
+            headers.pop("authorization", None)
+            headers["api-key"] = backend.api_key
+        elif backend.endpoint != self.endpoint:
+            # The key of the client is only valid for the first endpoint, the others are called with the token alone
+            headers.pop("api-key", None)
+        return httpx.Request(
+            request.method,
+            backend.endpoint + path,
+            headers=headers,
+            content=request.content,
+            extensions=request.extensions,
+        )
+
+    def get_retry_after(self, headers: httpx.Headers) -> float:
+        if (retry_after_ms := parse_number(headers.get("retry-after-ms"))) is not None:
+            return retry_after_ms / 1000
+        if (retry_after := parse_number(headers.get("retry-after"))) is not None:
+            return retry_after
+        return self.default_retry_after
+
+    async def send(self, backend: OpenAIBackend, request: httpx.Request) -> httpx.Response:
+        backend.requests += 1
+        backend.in_flight += 1
+        start = time.monotonic()
+        response: Optional[httpx.Response] = None
+        try:
+            response = await self.transport.handle_async_request(self.rewrite(request, backend))
+        except CONNECTION_ERRORS:
+            backend.errors += 1
+            backend.ejected_until = time.monotonic() + self.default_retry_after
+            logging.warning(
+                "OpenAI backend %s can't be reached, ejecting it for %.1f seconds",
+                backend.name,
+                self.default_retry_after,
+            )
+            raise
+        except Exception:
+            backend.errors += 1
+            raise
+        finally:
+            if response is None:
+                backend.in_flight -= 1
+        # The call stays in flight until its response is closed, after the whole body was read
+        response.stream = InFlightStream(cast(httpx.AsyncByteStream, response.stream), backend)
+        now = time.monotonic()
+        if response.status_code == 429:
+            backend.throttled += 1
+            retry_after = self.get_retry_after(response.headers)
+            backend.ejected_until = now + retry_after
+            logging.warning("OpenAI backend %s is throttled, ejecting it for %.1f seconds", backend.name, retry_after)
+        else:
+            if response.status_code >= 500:
+                backend.errors += 1
+            backend.record_latency(now - start)
+            backend.update_rate_limits(response.headers, now)
+        return response
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        # The body is sent again when a call moves to another backend
+        await request.aread()
+        tried: list[OpenAIBackend] = []
+        response: Optional[httpx.Response] = None
+        connection_error: Optional[Exception] = None
+        while (backend := self.choose(time.monotonic(), tried)) is not None:
+            tried.append(backend)
+            try:
+                backend_response = await self.send(backend, request)
+            except CONNECTION_ERRORS as error:
+                connection_error = error
+                continue
+            if response is not None:
+                await response.aclose()
+            response = backend_response
+            if response.status_code != 429 and response.status_code < 500:
+                break
+        # The last error response is returned, so the OpenAI SDK can retry it, or else the last connection error raised
+        if response is None:
+            assert connection_error is not None
+            raise connection_error
+        return response
+
+    def stats(self) -> dict[str, float]:
+        now = time.monotonic()
+        return {
+            f"{backend.name}.{key}": value for backend in self.backends for key, value in backend.stats(now).items()
+        }
+
+    async def aclose(self):
+        await self.transport.aclose()
@@ -0,0 +1,44 @@
+from typing import Any, Optional, Union
+
+
+def get_cached_tokens(usage: Any) -> Optional[int]:
+    """
+    Returns the number of prompt tokens that the provider served from its prompt cache,
+    or None if the usage does not report it (older API versions and SDKs).
+    """
+    details = getattr(usage, "prompt_tokens_details", None)
+    if isinstance(details, dict):
+        return details.get("cached_tokens")
+    return getattr(details, "cached_tokens", None)
+
+
+class PromptUsageStats:
+    """
+    Totals of the prompt tokens sent to OpenAI and of the part of them that hit the provider's prompt cache,
+    so that the effect of keeping a stable prompt prefix can be measured.
+    """
+
+    def __init__(self):
+        self.completions = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+
+    def record(self, usage: Any) -> Optional[int]:
+        if usage is None:
+            return None
+        cached_tokens = get_cached_tokens(usage)
+        self.completions += 1
+        self.prompt_tokens += usage.prompt_tokens or 0
+        self.cached_tokens += cached_tokens or 0
+        return cached_tokens
+
+    def stats(self) -> dict[str, Union[int, float]]:
+        return {
+            "completions": self.completions,
+            "prompt_tokens": self.prompt_tokens,
+            "cached_tokens": self.cached_tokens,
+            "cached_ratio": round(self.cached_tokens / self.prompt_tokens, 3) if self.prompt_tokens else 0.0,
+        }
+
+
+prompt_usage_stats = PromptUsageStats()
@@ -0,0 +1,169 @@
+import asyncio
+import dataclasses
+import json
+from typing import Any, AsyncGenerator, Optional, Type
+
+from quart.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None  # type: ignore[assignment]
+
+
+def serialize_default(o: Any) -> Any:
+    """
+    Converts the objects that JSON encoders don't handle natively.
+    Objects with a serialize_for_results method, such as search results, are kept as is in the response
+    and only converted here, when the response is actually sent.
+    """
+    if dataclasses.is_dataclass(o) and not isinstance(o, type):
+        # Shallow conversion, the encoder recurses into the field values without copying them first
+        return {field.name: getattr(o, field.name) for field in dataclasses.fields(o)}
+    serialize_for_results = getattr(o, "serialize_for_results", None)
+    if serialize_for_results is not None:
+        return serialize_for_results()
+    raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
+
+class JSONEncoder(json.JSONEncoder):
+    def default(self, o):
+        try:
+            return serialize_default(o)
+        except TypeError:
+            return super().default(o)
+
+
+class JSONProvider(DefaultJSONProvider):
+    """The app's JSON provider, which serializes responses like dumps_ndjson_line does."""
+
+    @staticmethod
+    def default(o: Any) -> Any:
+        try:
+            return serialize_default(o)
+        except TypeError:
+            return DefaultJSONProvider.default(o)
+
+
+def dumps_ndjson_line(event: Any) -> bytes:
+    """
+    Serializes one event of a response stream as a line of NDJSON.
+    Uses orjson when it is installed, which serializes dataclasses and numpy arrays natively,
+    and otherwise falls back to the standard library with the same compact output.
+    """
+    if orjson is not None:
+        return orjson.dumps(
+            event, default=serialize_default, option=orjson.OPT_APPEND_NEWLINE | orjson.OPT_SERIALIZE_NUMPY
+        )
+    return (json.dumps(event, ensure_ascii=False, separators=(",", ":"), cls=JSONEncoder) + "\n").encode("utf-8")
+
+
+async def coalesce_deltas(
+    events: AsyncGenerator[dict[str, Any], None], max_bytes: int, max_delay: float
+) -> AsyncGenerator[dict[str, Any], None]:
+    """
+    Merges consecutive content deltas of a chat response stream into one delta frame,
+    until max_bytes of content are buffered or max_delay seconds have passed since the first buffered delta,
+    so that a long answer is written in a few larger chunks instead of one per token.
+    The first content delta is passed through immediately so that the time to first token is unchanged.
+    Every other frame (such as the context and the follow-up questions) flushes the buffer and is passed through as is.
+    """
+    loop = asyncio.get_running_loop()
+    iterator = events.__aiter__()
+    buffer: list[str] = []
+    buffered_bytes = 0
+    role = "assistant"
+    deadline: Optional[float] = None
+    first_content_sent = False
+    next_event: Optional[asyncio.Future] = None
+
+    def flush() -> dict[str, Any]:
+        nonlocal buffered_bytes, deadline
+        frame = {"delta": {"content": "".join(buffer), "role": role}}
+        buffer.clear()
+        buffered_bytes = 0
+        deadline = None
+        return frame
+
+    try:
+        while True:
+            try:
+                if deadline is None and next_event is None:
+                    event = await iterator.__anext__()
+                else:
+                    # Waits for the next event only until the buffered content is due, without cancelling the wait
+                    if next_event is None:
+                        next_event = asyncio.ensure_future(iterator.__anext__())
+                    timeout = None if deadline is None else max(0, deadline - loop.time())
+                    done, _ = await asyncio.wait({next_event}, timeout=timeout)
+                    if not done:
+                        yield flush()
+                        continue
+                    event = next_event.result()
+                    next_event = None
+            except StopAsyncIteration:
+                next_event = None
+                break
+            if event.keys() == {"delta"} and "content" in event["delta"]:
+                content = event["delta"]["content"]
+                if not content:
+                    continue
+                if not first_content_sent:
+                    first_content_sent = True
+                    yield event
+                    continue
+                role = event["delta"].get("role") or role
+                buffer.append(content)
+                buffered_bytes += len(content.encode("utf-8"))
+                if deadline is None:
+                    deadline = loop.time() + max_delay
+                if buffered_bytes >= max_bytes:
+                    yield flush()
+            else:
+                if buffer:
+                    yield flush()
+                yield event
+        if buffer:
+            yield flush()
+    finally:
+        if next_event is not None:
+            next_event.cancel()
+            # The read has to unwind before the stream below can be closed
+            await asyncio.wait({next_event})
+        await events.aclose()
+
+
+async def start_stream(
+    events: AsyncGenerator[dict[str, Any], None], raise_early: tuple[Type[Exception], ...]
+) -> AsyncGenerator[dict[str, Any], None]:
+    """
+    Runs a response stream up to its first event before the response is started,
+    so that errors of the raise_early types are raised here and can still be returned with their own status code.
+    Any other error is raised again by the returned stream, to be reported inside the response as before.
+    """
+    try:
+        first_event = await events.__anext__()
+    except raise_early:
+        raise
+    except StopAsyncIteration:
+        first_event = None
+    except Exception as error:
+        early_error = error
+
+        async def failed_stream() -> AsyncGenerator[dict[str, Any], None]:
+            raise early_error
+            yield  # pragma: no cover
+
+        return failed_stream()
+
+    async def resumed_stream() -> AsyncGenerator[dict[str, Any], None]:
+        try:
+            if first_event is None:
+                return
+            yield first_event
+            async for event in events:
+                yield event
+        finally:
+            await events.aclose()
+
+    return resumed_stream()
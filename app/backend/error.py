@@ -1,14 +1,22 @@
 import logging
+import math
 
 from openai import APIError
 from quart import jsonify
 
+from core.admission import AdmissionRejectedError
+from core.deadline import DeadlineExceededError
+
 ERROR_MESSAGE = """The app encountered an error processing your request.
 If you are an administrator of the app, view the full error in the logs. See aka.ms/appservice-logs for more information.
 Error type: {error_type}
 """
 ERROR_MESSAGE_FILTER = """Your message contains content that was flagged by the OpenAI content filter."""
 
+ERROR_MESSAGE_BUSY = """The app is handling too many requests right now. Please try again in a moment."""
+
+ERROR_MESSAGE_TIMEOUT = """The answer took too long to generate. Please try again in a moment."""
+
 ERROR_MESSAGE_LENGTH = """Your message exceeded the context length limit for this OpenAI model. Please shorten your message or change your settings to retrieve fewer search results."""
 
 
@@ -17,10 +25,20 @@ def error_dict(error: Exception) -> dict:
         return {"error": ERROR_MESSAGE_FILTER}
     if isinstance(error, APIError) and error.code == "context_length_exceeded":
         return {"error": ERROR_MESSAGE_LENGTH}
+    if isinstance(error, AdmissionRejectedError):
+        return {"error": ERROR_MESSAGE_BUSY}
+    if isinstance(error, DeadlineExceededError):
+        return {"error": ERROR_MESSAGE_TIMEOUT}
     return {"error": ERROR_MESSAGE.format(error_type=type(error))}
 
 
 def error_response(error: Exception, route: str, status_code: int = 500):
+    if isinstance(error, AdmissionRejectedError):
+        logging.warning("Request to %s rejected: %s", route, error)
+        return jsonify(error_dict(error)), error.status_code, {"Retry-After": str(math.ceil(error.retry_after))}
+    if isinstance(error, DeadlineExceededError):
+        logging.warning("Request to %s timed out: %s", route, error)
+        return jsonify(error_dict(error)), 504
     logging.exception("Exception in %s: %s", route, error)
     if isinstance(error, APIError) and error.code == "content_filter":
         status_code = 400
@@ -1,5 +1,5 @@
 import logging
-from typing import List, Optional
+from typing import Any, Callable, List, Optional
 
 from azure.core.credentials import AzureKeyCredential
 
@@ -129,12 +129,15 @@ class UploadUserFileStrategy:
         file_processors: dict[str, FileProcessor],
         embeddings: Optional[OpenAIEmbeddings] = None,
         image_embeddings: Optional[ImageEmbeddings] = None,
+        on_acl_change: Optional[Callable[[str], Any]] = None,
     ):
         self.file_processors = file_processors
         self.embeddings = embeddings
         self.image_embeddings = image_embeddings
         self.search_info = search_info
         self.search_manager = SearchManager(self.search_info, None, True, False, self.embeddings)
+        # Called with the file name whenever the documents (and therefore ACLs) of a file change in the index
+        self.on_acl_change = on_acl_change
 
     async def add_file(self, file: File):
         if self.image_embeddings:
@@ -142,9 +145,13 @@ class UploadUserFileStrategy:
         sections = await parse_file(file, self.file_processors)
         if sections:
             await self.search_manager.update_content(sections, url=file.url)
+            if self.on_acl_change:
+                self.on_acl_change(file.filename())
 
     async def remove_file(self, filename: str, oid: str):
         if filename is None or filename == "":
             logging.warning("Filename is required to remove a file")
             return
         await self.search_manager.remove_content(filename, oid)
+        if self.on_acl_change:
+            self.on_acl_change(filename)
@@ -25,6 +25,7 @@ export interface SettingsProps {
     useGPT4V: boolean;
     gpt4vInput: GPT4VInput;
     vectorFieldList: VectorFieldOptions[];
+    includeVectors: boolean;
     showSemanticRankerOption: boolean;
     showGPT4VOptions: boolean;
     showVectorOption: boolean;
@@ -57,6 +58,7 @@ export const Settings = ({
     useGPT4V,
     gpt4vInput,
     vectorFieldList,
+    includeVectors,
     showSemanticRankerOption,
     showGPT4VOptions,
     showVectorOption,
@@ -100,6 +102,8 @@ export const Settings = ({
     const useOidSecurityFilterFieldId = useId("useOidSecurityFilterField");
     const useGroupsSecurityFilterId = useId("useGroupsSecurityFilter");
     const useGroupsSecurityFilterFieldId = useId("useGroupsSecurityFilterField");
+    const includeVectorsId = useId("includeVectors");
+    const includeVectorsFieldId = useId("includeVectorsField");
     const shouldStreamId = useId("shouldStream");
     const shouldStreamFieldId = useId("shouldStreamField");
     const suggestFollowupQuestionsId = useId("suggestFollowupQuestions");
@@ -284,6 +288,18 @@ export const Settings = ({
                 />
             )}
 
+            {showVectorOption && (
+                <Checkbox
+                    id={includeVectorsFieldId}
+                    className={styles.settingsSeparator}
+                    checked={includeVectors}
+                    label={t("labels.includeVectors")}
+                    onChange={(_ev, checked) => onChange("includeVectors", !!checked)}
+                    aria-labelledby={includeVectorsId}
+                    onRenderLabel={props => renderLabel(props, includeVectorsId, includeVectorsFieldId, t("helpTexts.includeVectors"))}
+                />
+            )}
+
             {/* Streaming checkbox for Chat */}
             {shouldStream !== undefined && (
                 <Checkbox
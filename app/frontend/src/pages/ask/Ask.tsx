@@ -38,6 +38,7 @@ export function Component(): JSX.Element {
     const [excludeCategory, setExcludeCategory] = useState<string>("");
     const [question, setQuestion] = useState<string>("");
     const [vectorFieldList, setVectorFieldList] = useState<VectorFieldOptions[]>([VectorFieldOptions.Embedding, VectorFieldOptions.ImageEmbedding]);
+    const [includeVectors, setIncludeVectors] = useState<boolean>(false);
     const [useOidSecurityFilter, setUseOidSecurityFilter] = useState<boolean>(false);
     const [useGroupsSecurityFilter, setUseGroupsSecurityFilter] = useState<boolean>(false);
     const [showGPT4VOptions, setShowGPT4VOptions] = useState<boolean>(false);
@@ -129,6 +130,7 @@ export function Component(): JSX.Element {
                         use_oid_security_filter: useOidSecurityFilter,
                         use_groups_security_filter: useGroupsSecurityFilter,
                         vector_fields: vectorFieldList,
+                        include_vectors: includeVectors,
                         use_gpt4v: useGPT4V,
                         gpt4v_input: gpt4vInput,
                         language: i18n.language,
@@ -201,6 +203,9 @@ export function Component(): JSX.Element {
             case "vectorFieldList":
                 setVectorFieldList(value);
                 break;
+            case "includeVectors":
+                setIncludeVectors(value);
+                break;
             case "retrievalMode":
                 setRetrievalMode(value);
                 break;
@@ -327,6 +332,7 @@ export function Component(): JSX.Element {
                     useGPT4V={useGPT4V}
                     gpt4vInput={gpt4vInput}
                     vectorFieldList={vectorFieldList}
+                    includeVectors={includeVectors}
                     showSemanticRankerOption={showSemanticRankerOption}
                     showGPT4VOptions={showGPT4VOptions}
                     showVectorOption={showVectorOption}
@@ -54,6 +54,7 @@ const Chat = () => {
     const [excludeCategory, setExcludeCategory] = useState<string>("");
     const [useSuggestFollowupQuestions, setUseSuggestFollowupQuestions] = useState<boolean>(false);
     const [vectorFieldList, setVectorFieldList] = useState<VectorFieldOptions[]>([VectorFieldOptions.Embedding]);
+    const [includeVectors, setIncludeVectors] = useState<boolean>(false);
     const [useOidSecurityFilter, setUseOidSecurityFilter] = useState<boolean>(false);
     const [useGroupsSecurityFilter, setUseGroupsSecurityFilter] = useState<boolean>(false);
     const [gpt4vInput, setGPT4VInput] = useState<GPT4VInput>(GPT4VInput.TextAndImages);
@@ -201,6 +202,7 @@ const Chat = () => {
                         use_oid_security_filter: useOidSecurityFilter,
                         use_groups_security_filter: useGroupsSecurityFilter,
                         vector_fields: vectorFieldList,
+                        include_vectors: includeVectors,
                         use_gpt4v: useGPT4V,
                         gpt4v_input: gpt4vInput,
                         language: i18n.language,
@@ -315,6 +317,9 @@ const Chat = () => {
             case "vectorFieldList":
                 setVectorFieldList(value);
                 break;
+            case "includeVectors":
+                setIncludeVectors(value);
+                break;
             case "retrievalMode":
                 setRetrievalMode(value);
                 break;
@@ -505,6 +510,7 @@ const Chat = () => {
                         useGPT4V={useGPT4V}
                         gpt4vInput={gpt4vInput}
                         vectorFieldList={vectorFieldList}
+                        includeVectors={includeVectors}
                         showSemanticRankerOption={showSemanticRankerOption}
                         showGPT4VOptions={showGPT4VOptions}
                         showVectorOption={showVectorOption}
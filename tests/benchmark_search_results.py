@@ -0,0 +1,151 @@
+"""
+Microbenchmark of turning search hits into the "Search results" thought process step.
+Compares the previous path (a dataclass per hit, score filter re-run after every page,
+eager serialize_for_results) with the current one (slotted Document, single-pass filter,
+serialization when the response is written by dumps_ndjson_line).
+
+Run from the repository root with: python tests/benchmark_search_results.py
+"""
+
+import asyncio
+import sys
+import time
+import tracemalloc
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, List, Optional
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "app" / "backend"))
+
+from approaches.approach import Approach, Document, ThoughtStep  # noqa: E402
+from core import streaming  # noqa: E402
+
+TOP = 50
+PAGE_SIZE = 10
+REPEAT = 200
+
+
+@dataclass
+class PreviousDocument:
+    id: Optional[str]
+    content: Optional[str]
+    embedding: Optional[List[float]]
+    image_embedding: Optional[List[float]]
+    category: Optional[str]
+    sourcepage: Optional[str]
+    sourcefile: Optional[str]
+    oids: Optional[List[str]]
+    groups: Optional[List[str]]
+    captions: List[Any]
+    score: Optional[float] = None
+    reranker_score: Optional[float] = None
+
+    serialize_for_results = Document.serialize_for_results
+    trim_embedding = Document.trim_embedding
+
+
+class AsyncList:
+    def __init__(self, items):
+        self.items = items
+
+    def __aiter__(self):
+        return self.iterate()
+
+    async def iterate(self):
+        for item in self.items:
+            yield item
+
+
+class Results:
+    def __init__(self, hits):
+        self.hits = hits
+
+    def by_page(self):
+        return AsyncList([AsyncList(self.hits[i : i + PAGE_SIZE]) for i in range(0, len(self.hits), PAGE_SIZE)])
+
+
+class SearchClient:
+    def __init__(self, hits):
+        self.hits = hits
+
+    async def search(self, **kwargs):
+        return Results(self.hits)
+
+
+def make_hits() -> list[dict[str, Any]]:
+    return [
+        {
+            "id": f"file-Benefit_Options_pdf-{i}",
+            "content": "There is a whistleblower policy. " * 30,
+            "category": None,
+            "sourcepage": f"Benefit_Options-{i}.pdf",
+            "sourcefile": "Benefit_Options.pdf",
+            "@search.score": 0.03 + i / 1000,
+            "@search.reranker_score": 2.5,
+        }
+        for i in range(TOP)
+    ]
+
+
+async def previous(hits) -> bytes:
+    documents = []
+    qualified_documents: list[PreviousDocument] = []
+    results = await SearchClient(hits).search()
+    async for page in results.by_page():
+        async for document in page:
+            documents.append(
+                PreviousDocument(
+                    id=document.get("id"),
+                    content=document.get("content"),
+                    embedding=document.get("embedding"),
+                    image_embedding=document.get("imageEmbedding"),
+                    category=document.get("category"),
+                    sourcepage=document.get("sourcepage"),
+                    sourcefile=document.get("sourcefile"),
+                    oids=document.get("oids"),
+                    groups=document.get("groups"),
+                    captions=document.get("@search.captions"),
+                    score=document.get("@search.score"),
+                    reranker_score=document.get("@search.reranker_score"),
+                )
+            )
+            qualified_documents = [
+                doc for doc in documents if (doc.score or 0) >= 0.02 and (doc.reranker_score or 0) >= 1.5
+            ]
+    step = ThoughtStep("Search results", [result.serialize_for_results() for result in qualified_documents])
+    return streaming.dumps_ndjson_line({"context": {"thoughts": [step]}})
+
+
+async def current(approach: Approach) -> bytes:
+    results = await approach.search(TOP, "policy", None, [], True, False, False, False, 0.02, 1.5)
+    step = ThoughtStep("Search results", results)
+    return streaming.dumps_ndjson_line({"context": {"thoughts": [step]}})
+
+
+async def measure(function, *args) -> tuple[float, int]:
+    start = time.process_time()
+    for _ in range(REPEAT):
+        await function(*args)
+    duration = (time.process_time() - start) / REPEAT
+    tracemalloc.start()
+    await function(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return duration, peak
+
+
+async def main():
+    hits = make_hits()
+    approach = Approach.__new__(Approach)
+    approach.search_client = SearchClient(hits)  # type: ignore[assignment]
+    approach.auth_helper = None  # type: ignore[assignment]
+    assert await previous(hits) == await current(approach)
+    before, before_peak = await measure(previous, hits)
+    after, after_peak = await measure(current, approach)
+    print(f"Search results step (top {TOP}, {PAGE_SIZE} per page)")
+    print(f"  before: {before * 1e6:.0f} µs, peak {before_peak / 1024:.0f} KiB")
+    print(f"  after:  {after * 1e6:.0f} µs ({before / after:.1f}x), peak {after_peak / 1024:.0f} KiB")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
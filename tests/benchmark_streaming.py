@@ -0,0 +1,110 @@
+"""
+Microbenchmark of the per-token CPU cost of /chat/stream serialization.
+Compares the previous path (model_dump of every chunk, json.dumps with dataclasses.asdict)
+with the current one (delta attributes read directly, dumps_ndjson_line).
+
+Run from the repository root with: python tests/benchmark_streaming.py
+"""
+
+import dataclasses
+import json
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "app" / "backend"))
+
+from openai.types.chat import ChatCompletionChunk  # noqa: E402
+
+from approaches.approach import ThoughtStep  # noqa: E402
+from core import streaming  # noqa: E402
+
+TOKENS = 20000
+
+
+class AsDictJSONEncoder(json.JSONEncoder):
+    def default(self, o):
+        if dataclasses.is_dataclass(o) and not isinstance(o, type):
+            return dataclasses.asdict(o)
+        return super().default(o)
+
+
+def make_chunks() -> list[ChatCompletionChunk]:
+    return [
+        ChatCompletionChunk.model_validate(
+            {
+                "id": "chatcmpl-123",
+                "object": "chat.completion.chunk",
+                "created": 1703462735,
+                "model": "gpt-4o",
+                "choices": [
+                    {"delta": {"content": f" token{i}", "role": "assistant"}, "finish_reason": None, "index": 0}
+                ],
+            }
+        )
+        for i in range(TOKENS)
+    ]
+
+
+def make_context() -> dict:
+    results = [
+        {"id": f"file-{i}", "content": "There is a whistleblower policy. " * 40, "score": 0.03, "captions": []}
+        for i in range(5)
+    ]
+    return {
+        "delta": {"role": "assistant"},
+        "context": {
+            "data_points": {"text": [f"Benefit_Options-{i}.pdf: " + "Lorem ipsum " * 100 for i in range(5)]},
+            "thoughts": [
+                ThoughtStep("Prompt to generate search query", [{"role": "system", "content": "x" * 2000}]),
+                ThoughtStep("Search using generated search query", "whistleblower policy", {"top": 5}),
+                ThoughtStep("Search results", results),
+            ],
+        },
+        "session_state": None,
+    }
+
+
+def previous(chunks: list[ChatCompletionChunk]):
+    for chunk in chunks:
+        event = chunk.model_dump()
+        completion = {
+            "delta": {
+                "content": event["choices"][0]["delta"].get("content"),
+                "role": event["choices"][0]["delta"]["role"],
+            }
+        }
+        json.dumps(completion, ensure_ascii=False, cls=AsDictJSONEncoder) + "\n"
+
+
+def current(chunks: list[ChatCompletionChunk]):
+    for chunk in chunks:
+        delta = chunk.choices[0].delta
+        streaming.dumps_ndjson_line({"delta": {"content": delta.content, "role": delta.role}})
+
+
+def measure(function, *args, repeat: int = 1) -> float:
+    start = time.process_time()
+    for _ in range(repeat):
+        function(*args)
+    return (time.process_time() - start) / repeat
+
+
+def main():
+    chunks = make_chunks()
+    context = make_context()
+    backend = "orjson" if streaming.orjson is not None else "json"
+    before = measure(previous, chunks)
+    after = measure(current, chunks)
+    print(f"Delta frames ({TOKENS} tokens, backend: {backend})")
+    print(f"  before: {before / TOKENS * 1e6:.2f} µs/token")
+    print(f"  after:  {after / TOKENS * 1e6:.2f} µs/token ({before / after:.1f}x)")
+    before = measure(lambda: json.dumps(context, ensure_ascii=False, cls=AsDictJSONEncoder), repeat=200)
+    after = measure(lambda: streaming.dumps_ndjson_line(context), repeat=200)
+    print("Context frame")
+    print(f"  before: {before * 1e6:.1f} µs")
+    print(f"  after:  {after * 1e6:.1f} µs ({before / after:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
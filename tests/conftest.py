@@ -179,6 +179,9 @@ def mock_openai_chatcompletion(monkeypatch):
             else:
                 raise StopAsyncIteration
 
+        async def close(self):
+            pass
+
     async def mock_acreate(*args, **kwargs):
         # The only two possible values for seed:
         assert kwargs.get("seed") is None or kwargs.get("seed") == 42
@@ -0,0 +1,48 @@
+import asyncio
+import time
+
+import pytest
+
+from core.admission import AdmissionController, AdmissionRejectedError
+
+
+@pytest.mark.asyncio
+async def test_admit_waits_for_token_budget():
+    # 6000 tokens per minute refill at 100 tokens per second
+    controller = AdmissionController(tokens_per_minute=6000, max_wait=5)
+    await controller.admit(6000)
+    start = time.monotonic()
+    await asyncio.gather(controller.admit(10), controller.admit(10))
+    assert 0.15 <= time.monotonic() - start < 1
+    stats = controller.stats()
+    assert stats["admitted"] == 3
+    assert stats["rejected"] == 0
+    assert stats["queue_depth"] == 0
+
+
+@pytest.mark.asyncio
+async def test_admit_rejects_when_wait_exceeds_deadline():
+    controller = AdmissionController(tokens_per_minute=600, requests_per_minute=100, max_wait=1)
+    await controller.admit(550)
+    # 100 tokens are missing, which take 10 seconds to refill
+    with pytest.raises(AdmissionRejectedError) as exc_info:
+        await controller.admit(150)
+    assert exc_info.value.status_code == 429
+    assert exc_info.value.retry_after == pytest.approx(10, abs=0.1)
+    assert controller.stats()["rejected"] == 1
+    assert controller.stats()["queue_depth"] == 0
+
+
+@pytest.mark.asyncio
+async def test_admit_rejects_when_queue_is_full():
+    controller = AdmissionController(requests_per_minute=600, max_queue=1, max_wait=5)
+    for _ in range(600):
+        await controller.admit(0)
+    waiting = asyncio.create_task(controller.admit(0))
+    await asyncio.sleep(0)
+    assert controller.stats()["queue_depth"] == 1
+    with pytest.raises(AdmissionRejectedError) as exc_info:
+        await controller.admit(0)
+    assert exc_info.value.status_code == 503
+    await waiting
+    assert controller.stats()["admitted"] == 601
@@ -0,0 +1,203 @@
+import json
+import time
+from types import SimpleNamespace
+
+import pytest
+from azure.search.documents.indexes.aio import SearchIndexClient
+
+import app
+from approaches.approach import Approach, ThoughtStep
+from core.answercache import SemanticAnswerCache
+
+
+def test_answer_cache_similarity_and_scope():
+    cache = SemanticAnswerCache(maxsize=10, ttl=60, similarity_threshold=0.95)
+    scope = cache.scope("ChatReadRetrieveReadApproach", "oids/any(g:search.in(g, 'OID_X'))", {"top": 3})
+    other_scope = cache.scope("ChatReadRetrieveReadApproach", "oids/any(g:search.in(g, 'OID_Y'))", {"top": 3})
+    cache.store(scope, "What is the deductible?", [1.0, 0.0, 0.0], "The deductible is $500", {"data_points": {}})
+
+    match = cache.lookup(scope, [0.99, 0.05, 0.0])
+    assert match is not None
+    assert match.answer.content == "The deductible is $500"
+    assert match.similarity == pytest.approx(0.9987, abs=1e-4)
+    # Dissimilar questions and other security filters never share answers
+    assert cache.lookup(scope, [0.5, 0.5, 0.5]) is None
+    assert cache.lookup(other_scope, [1.0, 0.0, 0.0]) is None
+    assert cache.stats() == {"hits": 1, "misses": 2, "hit_ratio": 1 / 3, "size": 1, "scopes": 1, "invalidations": 0}
+
+
+def test_answer_cache_scope_shared_by_filter():
+    approach = SimpleNamespace(
+        answer_cache=SemanticAnswerCache(maxsize=10, ttl=60, similarity_threshold=0.95),
+        answer_cache_override_keys=Approach.answer_cache_override_keys,
+    )
+    approach.build_filter = lambda overrides, auth_claims: None
+
+    def get_scope(overrides, auth_claims):
+        return Approach.get_answer_cache_scope(approach, overrides, auth_claims)
+
+    # Users whose searches have the same filter share answers, whatever overrides don't change the answer
+    assert get_scope({}, {"oid": "OID_X"}) == get_scope({}, {"oid": "OID_Y"})
+    assert get_scope({"include_vectors": True}, {"oid": "OID_X"}) == get_scope({}, {"oid": "OID_X"})
+    assert get_scope({"top": 5}, {"oid": "OID_X"}) != get_scope({}, {"oid": "OID_X"})
+    assert get_scope({"retrieval_mode": "text"}, {"oid": "OID_X"}) is None
+
+
+def test_answer_cache_context_leaves_out_question_and_prompts():
+    approach = SimpleNamespace(per_user_thoughts=Approach.per_user_thoughts)
+    extra_info = {
+        "data_points": {"text": ["Benefit_Options.pdf#page=3: The deductible is $500"]},
+        "thoughts": [
+            ThoughtStep("Search using user query", "What is my deductible?", {"top": 3}),
+            ThoughtStep("Search results", [{"sourcepage": "Benefit_Options.pdf#page=3"}]),
+            ThoughtStep("Prompt to generate answer", [{"role": "user", "content": "What is my deductible?"}]),
+        ],
+        "followup_questions": ["What is covered?"],
+    }
+
+    context = Approach.get_answer_cache_context(approach, extra_info)
+    assert context == {
+        "data_points": extra_info["data_points"],
+        "thoughts": [
+            ThoughtStep("Search using user query", None, {"top": 3}),
+            ThoughtStep("Search results", [{"sourcepage": "Benefit_Options.pdf#page=3"}]),
+            ThoughtStep("Prompt to generate answer", None),
+        ],
+    }
+
+
+def test_answer_cache_ttl():
+    cache = SemanticAnswerCache(maxsize=10, ttl=0.01, similarity_threshold=0.95)
+    cache.store("scope", "What is the deductible?", [1.0, 0.0], "The deductible is $500", {})
+    assert cache.lookup("scope", [1.0, 0.0]) is not None
+    time.sleep(0.02)
+    assert cache.lookup("scope", [1.0, 0.0]) is None
+
+
+@pytest.mark.asyncio
+async def test_answer_cache_invalidated_when_index_changes():
+    # Documents that were re-ingested in place keep the count but change the storage size
+    index_versions = iter([(100, 5000), (100, 5000), (100, 5200)])
+
+    async def get_index_version():
+        return next(index_versions)
+
+    cache = SemanticAnswerCache(
+        maxsize=10, ttl=60, similarity_threshold=0.95, index_check_interval=0, get_index_version=get_index_version
+    )
+    cache.store("scope", "What is the deductible?", [1.0, 0.0], "The deductible is $500", {})
+    for _ in range(2):
+        cache.schedule_index_check()
+        await cache.index_check_task
+        assert cache.lookup("scope", [1.0, 0.0]) is not None
+
+    cache.schedule_index_check()
+    await cache.index_check_task
+    assert cache.lookup("scope", [1.0, 0.0]) is None
+    assert cache.stats()["invalidations"] == 1
+
+
+@pytest.mark.asyncio
+async def test_chat_stream_replays_cached_answer(
+    monkeypatch,
+    mock_env,
+    mock_openai_chatcompletion,
+    mock_openai_embedding,
+    mock_acs_search,
+    mock_blob_container_client,
+    mock_azurehttp_calls,
+):
+    async def mock_get_index_statistics(*args, **kwargs):
+        return {"document_count": 10, "storage_size": 5000}
+
+    monkeypatch.setattr(SearchIndexClient, "get_index_statistics", mock_get_index_statistics)
+    monkeypatch.setenv("USE_ANSWER_CACHE", "true")
+
+    quart_app = app.create_app()
+    async with quart_app.test_app() as test_app:
+        mock_openai_chatcompletion(test_app.app.config[app.CONFIG_OPENAI_CLIENT])
+        mock_openai_embedding(test_app.app.config[app.CONFIG_OPENAI_CLIENT])
+        client = test_app.test_client()
+        request_json = {
+            "messages": [{"content": "What is the capital of France?", "role": "user"}],
+            "context": {
+                "overrides": {
+                    "suggest_followup_questions": True,
+                    "prompt_template": "Generate 3 very brief follow-up questions.",
+                }
+            },
+        }
+
+        response = await client.post("/chat/stream", json=request_json)
+        live_lines = [json.loads(line) for line in (await response.get_data()).decode().splitlines()]
+        response = await client.post("/chat/stream", json=request_json)
+        replayed_lines = [json.loads(line) for line in (await response.get_data()).decode().splitlines()]
+
+        live_content = "".join(line["delta"].get("content") or "" for line in live_lines)
+        assert replayed_lines[1]["delta"]["content"] == live_content
+        assert replayed_lines[0]["context"]["data_points"] == live_lines[0]["context"]["data_points"]
+        assert replayed_lines[0]["context"]["thoughts"][0]["title"] == "Answer reused from a similar question"
+        # The question and the prompts of the user who got the answer first aren't replayed
+        replayed_thoughts = {thought["title"]: thought for thought in replayed_lines[0]["context"]["thoughts"]}
+        assert replayed_thoughts["Prompt to generate answer"]["description"] is None
+        assert "What is the capital of France?" not in json.dumps(replayed_lines[0]["context"])
+        assert live_lines[-1]["context"]["followup_questions"] == ["What is the capital of Spain?"]
+        assert replayed_lines[-1]["context"]["followup_questions"] == ["What is the capital of Spain?"]
+
+        # The non-streaming route shares the answers of the streaming one
+        response = await client.post("/chat", json=request_json)
+        result = await response.get_json()
+        assert result["message"]["content"] == live_content
+        assert result["context"]["followup_questions"] == ["What is the capital of Spain?"]
+
+        # Later turns depend on the history, so they are never answered from the cache
+        history_json = {
+            **request_json,
+            "messages": [
+                {"content": "Hi", "role": "user"},
+                {"content": "Hello", "role": "assistant"},
+                *request_json["messages"],
+            ],
+        }
+        response = await client.post("/chat", json=history_json)
+        result = await response.get_json()
+        assert result["context"]["thoughts"][0]["title"] != "Answer reused from a similar question"
+        assert quart_app.config[app.CONFIG_ANSWER_CACHE].stats()["hits"] == 2
+
+
+@pytest.mark.asyncio
+async def test_ask_reuses_lookup_embedding_for_search(
+    monkeypatch,
+    mock_env,
+    mock_openai_chatcompletion,
+    mock_openai_embedding,
+    mock_acs_search,
+    mock_blob_container_client,
+    mock_azurehttp_calls,
+):
+    async def mock_get_index_statistics(*args, **kwargs):
+        return {"document_count": 10, "storage_size": 5000}
+
+    monkeypatch.setattr(SearchIndexClient, "get_index_statistics", mock_get_index_statistics)
+    monkeypatch.setenv("USE_ANSWER_CACHE", "true")
+    monkeypatch.setenv("QUERY_EMBEDDING_CACHE_SIZE", "0")
+
+    quart_app = app.create_app()
+    async with quart_app.test_app() as test_app:
+        openai_client = test_app.app.config[app.CONFIG_OPENAI_CLIENT]
+        mock_openai_chatcompletion(openai_client)
+        mock_openai_embedding(openai_client)
+        create_embedding = openai_client.embeddings.create
+        embedded_inputs = []
+
+        async def count_embeddings(*args, **kwargs):
+            embedded_inputs.append(kwargs["input"])
+            return await create_embedding(*args, **kwargs)
+
+        monkeypatch.setattr(openai_client.embeddings, "create", count_embeddings)
+        response = await test_app.test_client().post(
+            "/ask", json={"messages": [{"content": "What is the capital of France?", "role": "user"}]}
+        )
+        assert response.status_code == 200
+        # Without the query embedding cache, the search still doesn't embed the question a second time
+        assert embedded_inputs == ["What is the capital of France?"]
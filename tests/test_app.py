@@ -9,6 +9,8 @@ from httpx import Request, Response
 from openai import BadRequestError
 
 import app
+from core.admission import AdmissionController
+from error import ERROR_MESSAGE_BUSY
 
 
 def fake_response(http_code):
@@ -354,6 +356,24 @@ async def test_chat_handle_exception_streaming(client, monkeypatch, snapshot, ca
     snapshot.assert_match(result, "result.jsonlines")
 
 
+@pytest.mark.asyncio
+async def test_chat_stream_rejected_by_admission_controller(client, monkeypatch):
+    # One call per minute admits the query rewrite, after which the answer would wait for a minute
+    monkeypatch.setattr(
+        client.app.config[app.CONFIG_CHAT_APPROACH],
+        "admission_controller",
+        AdmissionController(requests_per_minute=1, max_wait=5),
+    )
+
+    response = await client.post(
+        "/chat/stream",
+        json={"messages": [{"content": "What is the capital of France?", "role": "user"}]},
+    )
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "60"
+    assert (await response.get_json()) == {"error": ERROR_MESSAGE_BUSY}
+
+
 @pytest.mark.asyncio
 async def test_chat_handle_exception_contentsafety_streaming(client, monkeypatch, snapshot, caplog):
     chat_client = client.app.config[app.CONFIG_OPENAI_CLIENT]
@@ -941,7 +961,9 @@ async def test_chat_vision_vectors(client, snapshot):
 
 
 @pytest.mark.asyncio
-async def test_ask_vision(client, snapshot):
+async def test_ask_vision(client, snapshot, monkeypatch):
+    # Keeps the per-field embedding timings in the thoughts stable
+    monkeypatch.setattr("approaches.approach.time.perf_counter", lambda: 0.0)
     response = await client.post(
         "/ask",
         json={
@@ -967,4 +989,4 @@ async def test_format_as_ndjson():
         yield {"b": "Newlines inside \n strings are fine"}
 
     result = [line async for line in app.format_as_ndjson(gen())]
-    assert result == ['{"a": "I ❤️ 🐍"}\n', '{"b": "Newlines inside \\n strings are fine"}\n']
+    assert result == ['{"a":"I ❤️ 🐍"}\n'.encode(), b'{"b":"Newlines inside \\n strings are fine"}\n']
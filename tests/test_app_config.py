@@ -53,6 +53,19 @@ async def test_app_azure_custom_identity(monkeypatch, minimal_env):
         assert quart_app.config[app.CONFIG_OPENAI_CLIENT].base_url == "http://azureapi.com/api/v1/openai/"
 
 
+@pytest.mark.asyncio
+async def test_app_vision_shares_http_session(monkeypatch, minimal_env):
+    monkeypatch.setenv("USE_GPT4V", "true")
+    monkeypatch.setenv("AZURE_OPENAI_GPT4V_MODEL", "gpt-4")
+    monkeypatch.setenv("VISION_ENDPOINT", "https://testvision.cognitiveservices.azure.com/")
+
+    quart_app = app.create_app()
+    async with quart_app.test_app():
+        vision_session = quart_app.config[app.CONFIG_HTTP_CLIENTS].session("vision")
+        assert quart_app.config[app.CONFIG_ASK_VISION_APPROACH].http_session is vision_session
+        assert quart_app.config[app.CONFIG_CHAT_VISION_APPROACH].http_session is vision_session
+
+
 @pytest.mark.asyncio
 async def test_app_user_upload_processors(monkeypatch, minimal_env):
     monkeypatch.setenv("AZURE_USERSTORAGE_ACCOUNT", "test-user-storage-account")
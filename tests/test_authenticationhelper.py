@@ -1,6 +1,6 @@
+import asyncio
 import base64
 import json
-import re
 from datetime import datetime, timedelta
 
 import aiohttp
@@ -9,10 +9,14 @@ import pytest
 from azure.core.credentials import AzureKeyCredential
 from azure.search.documents.aio import SearchClient
 from azure.search.documents.indexes.models import SearchField, SearchIndex
-from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives.asymmetric import rsa
 
-from core.authentication import AuthenticationHelper, AuthError
+from core.authentication import (
+    AuthenticationHelper,
+    AuthError,
+    JwksKeyStore,
+    public_key_from_jwk,
+)
 
 from .mocks import MockAsyncPageIterator, MockResponse
 
@@ -111,6 +115,68 @@ async def test_get_auth_claims_overage_unauthorized(
     assert len(auth_claims.keys()) == 0
 
 
+@pytest.mark.asyncio
+async def test_acquire_token_on_behalf_of_runs_off_event_loop(monkeypatch, mock_validate_token_success):
+    import threading
+
+    import msal
+
+    event_loop_thread = threading.get_ident()
+    obo_threads = []
+
+    def mock_init(self, *args, **kwargs):
+        pass
+
+    def mock_acquire_token_on_behalf_of(self, *args, **kwargs):
+        obo_threads.append(threading.get_ident())
+        return {"access_token": "MockToken", "id_token_claims": {"oid": "OID_X", "groups": ["GROUP_Y"]}}
+
+    monkeypatch.setattr(msal.ConfidentialClientApplication, "__init__", mock_init)
+    monkeypatch.setattr(
+        msal.ConfidentialClientApplication, "acquire_token_on_behalf_of", mock_acquire_token_on_behalf_of
+    )
+
+    helper = create_authentication_helper()
+    auth_claims = await helper.get_auth_claims_if_enabled(headers={"Authorization": "Bearer Token"})
+    assert auth_claims == {"oid": "OID_X", "groups": ["GROUP_Y"]}
+    assert len(obo_threads) == 1 and obo_threads[0] != event_loop_thread
+    stats = helper.obo_stats()
+    assert stats["calls"] == 1
+    assert stats["in_flight"] == 0
+    assert stats["pool_wait_seconds_max"] >= 0
+    helper.close()
+
+
+@pytest.mark.asyncio
+async def test_get_auth_claims_cached_per_token(monkeypatch, mock_confidential_client_success):
+    token_exp = int((datetime.utcnow() + timedelta(hours=1)).timestamp())
+    validations = 0
+
+    async def mock_validate_access_token(self, token):
+        nonlocal validations
+        validations += 1
+        return {"oid": "OID_X", "exp": token_exp}
+
+    monkeypatch.setattr(AuthenticationHelper, "validate_access_token", mock_validate_access_token)
+
+    helper = create_authentication_helper()
+    first_claims = await helper.get_auth_claims_if_enabled(headers={"Authorization": "Bearer Token"})
+    second_claims = await helper.get_auth_claims_if_enabled(headers={"Authorization": "Bearer Token"})
+    assert first_claims == second_claims == {"oid": "OID_X", "groups": ["GROUP_Y", "GROUP_Z"]}
+    assert validations == 1
+    assert helper.auth_claims_cache.stats() == {"hits": 1, "misses": 1, "size": 1}
+
+    # A different token is validated and exchanged separately
+    await helper.get_auth_claims_if_enabled(headers={"Authorization": "Bearer OtherToken"})
+    assert validations == 2
+
+    # Tokens that are about to expire are not cached
+    token_exp = int(datetime.utcnow().timestamp())
+    await helper.get_auth_claims_if_enabled(headers={"Authorization": "Bearer ExpiringToken"})
+    await helper.get_auth_claims_if_enabled(headers={"Authorization": "Bearer ExpiringToken"})
+    assert validations == 4
+
+
 @pytest.mark.asyncio
 async def test_list_groups_success(mock_list_groups_success, mock_validate_token_success):
     groups = await AuthenticationHelper.list_groups(graph_resource_access_token={"access_token": "MockToken"})
@@ -403,6 +469,46 @@ async def test_check_path_auth_allowed_empty(
     assert filter is None
 
 
+@pytest.mark.asyncio
+async def test_check_path_auth_cached(monkeypatch, mock_confidential_client_success, mock_validate_token_success):
+    auth_helper_require_access_control = create_authentication_helper(require_access_control=True)
+    searches = []
+
+    async def mock_search(self, *args, **kwargs):
+        searches.append(kwargs.get("filter"))
+        return MockAsyncPageIterator(data=[{"sourcefile": "Benefit_Options.pdf"}])
+
+    monkeypatch.setattr(SearchClient, "search", mock_search)
+
+    async def check(path, groups):
+        return await auth_helper_require_access_control.check_path_auth(
+            path=path, auth_claims={"oid": "OID_X", "groups": groups}, search_client=create_search_client()
+        )
+
+    assert await check("Benefit_Options.pdf", ["GROUP_Y", "GROUP_Z"]) is True
+    # Page fragments and group order don't change the decision, so they share the cache entry
+    assert await check("Benefit_Options.pdf#page=2", ["GROUP_Z", "GROUP_Y"]) is True
+    assert len(searches) == 1
+    # Different groups can grant different access, so they are checked separately
+    assert await check("Benefit_Options.pdf", ["GROUP_Y"]) is True
+    assert len(searches) == 2
+
+    auth_helper_require_access_control.invalidate_path_auth("Other.pdf")
+    assert await check("Benefit_Options.pdf", ["GROUP_Y", "GROUP_Z"]) is True
+    assert len(searches) == 2
+    assert await check("Benefit_Options-2.png", ["GROUP_Y", "GROUP_Z"]) is True
+    assert await check("Benefit_Options-Summary.pdf", ["GROUP_Y", "GROUP_Z"]) is True
+    assert len(searches) == 4
+    # Changing the ACLs of a file drops the decisions for its page images as well
+    auth_helper_require_access_control.invalidate_path_auth("Benefit_Options.pdf#page=1")
+    assert await check("Benefit_Options.pdf", ["GROUP_Y", "GROUP_Z"]) is True
+    assert await check("Benefit_Options-2.png", ["GROUP_Y", "GROUP_Z"]) is True
+    assert await check("Benefit_Options-Summary.pdf", ["GROUP_Y", "GROUP_Z"]) is True
+    assert len(searches) == 6
+    auth_helper_require_access_control.invalidate_path_auth()
+    assert len(auth_helper_require_access_control.path_auth_cache) == 0
+
+
 @pytest.mark.asyncio
 async def test_check_path_auth_allowed_public_empty(
     monkeypatch, mock_confidential_client_success, mock_validate_token_success
@@ -518,134 +624,117 @@ async def test_check_path_auth_allowed_public_without_access_control(
     assert called_search is False
 
 
+def create_mock_jwk(public_key, kid="mock_kid"):
+    def encode(value: int) -> str:
+        return (
+            base64.urlsafe_b64encode(value.to_bytes((value.bit_length() + 7) // 8, byteorder="big"))
+            .decode()
+            .rstrip("=")
+        )
+
+    return {
+        "kty": "RSA",
+        "use": "sig",
+        "kid": kid,
+        "n": encode(public_key.public_numbers().n),
+        "e": encode(public_key.public_numbers().e),
+    }
+
+
 @pytest.mark.asyncio
-async def test_create_pem_format(mock_confidential_client_success, mock_validate_token_success):
-    helper = create_authentication_helper()
+async def test_validate_access_token(monkeypatch, mock_confidential_client_success):
     mock_token, public_key, payload = create_mock_jwt(oid="OID_X")
-    _, other_public_key, _ = create_mock_jwt(oid="OID_Y")
-    mock_jwks = {
-        "keys": [
-            # Include a key with a different KID to ensure the correct key is selected
-            {
-                "kty": "RSA",
-                "kid": "other_mock_kid",
-                "use": "sig",
-                "n": base64.urlsafe_b64encode(
-                    other_public_key.public_numbers().n.to_bytes(
-                        (other_public_key.public_numbers().n.bit_length() + 7) // 8, byteorder="big"
-                    )
-                )
-                .decode("utf-8")
-                .rstrip("="),
-                "e": base64.urlsafe_b64encode(
-                    other_public_key.public_numbers().e.to_bytes(
-                        (other_public_key.public_numbers().e.bit_length() + 7) // 8, byteorder="big"
-                    )
-                )
-                .decode("utf-8")
-                .rstrip("="),
-            },
-            {
-                "kty": "RSA",
-                "kid": "mock_kid",
-                "use": "sig",
-                "n": base64.urlsafe_b64encode(
-                    public_key.public_numbers().n.to_bytes(
-                        (public_key.public_numbers().n.bit_length() + 7) // 8, byteorder="big"
-                    )
-                )
-                .decode("utf-8")
-                .rstrip("="),
-                "e": base64.urlsafe_b64encode(
-                    public_key.public_numbers().e.to_bytes(
-                        (public_key.public_numbers().e.bit_length() + 7) // 8, byteorder="big"
-                    )
-                )
-                .decode("utf-8")
-                .rstrip("="),
-            },
-        ]
-    }
+    key_requests = 0
 
-    pem_key = await helper.create_pem_format(mock_jwks, mock_token)
+    def mock_get(*args, **kwargs):
+        nonlocal key_requests
+        key_requests += 1
+        return MockResponse(
+            status=200,
+            text=json.dumps({"keys": [create_mock_jwk(public_key, kid="other_kid"), create_mock_jwk(public_key)]}),
+        )
 
-    # Assert that the result is bytes
-    assert isinstance(pem_key, bytes), "create_pem_format should return bytes"
+    monkeypatch.setattr(aiohttp.ClientSession, "get", mock_get)
 
-    # Convert bytes to string for regex matching
-    pem_str = pem_key.decode("utf-8")
+    helper = create_authentication_helper()
+    await helper.validate_access_token(mock_token)
+    await helper.validate_access_token(mock_token)
+    # The signing keys are only downloaded once and then served from the key store
+    assert key_requests == 1
+    assert helper.key_store.stats() == {"hits": 1, "misses": 1, "refreshes": 1, "keys": 2}
 
-    # Assert that the key starts and ends with the correct markers
-    assert pem_str.startswith("-----BEGIN PUBLIC KEY-----"), "PEM key should start with the correct marker"
-    assert pem_str.endswith("-----END PUBLIC KEY-----\n"), "PEM key should end with the correct marker"
 
-    # Assert that the format matches the structure of a PEM key
-    pem_regex = r"^-----BEGIN PUBLIC KEY-----\n([A-Za-z0-9+/\n]+={0,2})\n-----END PUBLIC KEY-----\n$"
-    assert re.match(pem_regex, pem_str), "PEM key format is incorrect"
+@pytest.mark.asyncio
+async def test_validate_access_token_unknown_kid(monkeypatch, mock_confidential_client_success):
+    mock_token, public_key, payload = create_mock_jwt(kid="rotated_kid", oid="OID_X")
+    key_requests = 0
 
-    # Verify that the key can be used to decode the token
-    try:
-        decoded = jwt.decode(
-            mock_token, key=pem_key, algorithms=["RS256"], audience=payload["aud"], issuer=payload["iss"]
-        )
-        assert decoded["oid"] == payload["oid"], "Decoded token should contain correct OID"
-    except Exception as e:
-        pytest.fail(f"jwt.decode raised an unexpected exception: {str(e)}")
+    def mock_get(*args, **kwargs):
+        nonlocal key_requests
+        key_requests += 1
+        return MockResponse(status=200, text=json.dumps({"keys": [create_mock_jwk(public_key)]}))
 
-    # Try to load the key using cryptography library to ensure it's a valid PEM format
-    try:
-        loaded_public_key = serialization.load_pem_public_key(pem_key)
-        assert isinstance(loaded_public_key, rsa.RSAPublicKey), "Loaded key should be an RSA public key"
-    except Exception as e:
-        pytest.fail(f"Failed to load PEM key: {str(e)}")
+    monkeypatch.setattr(aiohttp.ClientSession, "get", mock_get)
+
+    helper = create_authentication_helper()
+    with pytest.raises(AuthError) as exc_info:
+        await helper.validate_access_token(mock_token)
+    assert exc_info.value.error == "Unable to find appropriate key"
+    # A second token with the unknown kid does not force another refresh right away
+    with pytest.raises(AuthError):
+        await helper.validate_access_token(mock_token)
+    assert key_requests == 1
 
 
 @pytest.mark.asyncio
-async def test_validate_access_token(monkeypatch, mock_confidential_client_success):
-    mock_token, public_key, payload = create_mock_jwt(oid="OID_X")
+async def test_jwks_key_store_refresh(monkeypatch):
+    _, public_key, _ = create_mock_jwt()
+    key_requests = 0
+    jwks = {"keys": [create_mock_jwk(public_key, kid="kid_1")]}
 
     def mock_get(*args, **kwargs):
-        return MockResponse(
-            status=200,
-            text=json.dumps(
-                {
-                    "keys": [
-                        {
-                            "kty": "RSA",
-                            "use": "sig",
-                            "kid": "23nt",
-                            "x5t": "23nt",
-                            "n": "hu2SJ",
-                            "e": "AQAB",
-                            "x5c": ["MIIC/jCC"],
-                            "issuer": "https://login.microsoftonline.com/TENANT_ID/v2.0",
-                        },
-                        {
-                            "kty": "RSA",
-                            "use": "sig",
-                            "kid": "MGLq",
-                            "x5t": "MGLq",
-                            "n": "yfNcG8",
-                            "e": "AQAB",
-                            "x5c": ["MIIC/jCC"],
-                            "issuer": "https://login.microsoftonline.com/TENANT_ID/v2.0",
-                        },
-                    ]
-                }
-            ),
-        )
+        nonlocal key_requests
+        key_requests += 1
+        return MockResponse(status=200, text=json.dumps(jwks))
 
     monkeypatch.setattr(aiohttp.ClientSession, "get", mock_get)
 
-    def mock_decode(*args, **kwargs):
-        return payload
+    key_store = JwksKeyStore("https://login.microsoftonline.com/TENANT_ID/discovery/v2.0/keys", min_refresh_interval=0)
+    # Concurrent lookups for an unknown kid are collapsed into a single refresh
+    results = await asyncio.gather(*[key_store.get_signing_key("kid_1") for _ in range(5)])
+    assert all(result is not None for result in results)
+    assert key_requests == 1
+    assert key_store.stats() == {"hits": 0, "misses": 5, "refreshes": 1, "keys": 1}
 
-    monkeypatch.setattr(jwt, "decode", mock_decode)
+    # A key that rotated in after the last refresh is picked up by refreshing again
+    jwks = {"keys": [create_mock_jwk(public_key, kid="kid_1"), create_mock_jwk(public_key, kid="kid_2")]}
+    assert await key_store.get_signing_key("kid_2") is not None
+    assert key_requests == 2
 
-    async def mock_create_pem_format(*args, **kwargs):
-        return public_key
+    # Expired keys are refreshed
+    key_store.keys = {kid: (key, 0) for kid, (key, _) in key_store.keys.items()}
+    assert await key_store.get_signing_key("kid_1") is not None
+    assert key_requests == 3
 
-    monkeypatch.setattr(AuthenticationHelper, "create_pem_format", mock_create_pem_format)
 
-    helper = create_authentication_helper()
-    await helper.validate_access_token(mock_token)
+@pytest.mark.asyncio
+async def test_jwks_key_store_refresh_failure(monkeypatch):
+    _, public_key, _ = create_mock_jwt()
+    key_requests = 0
+
+    def mock_get(*args, **kwargs):
+        nonlocal key_requests
+        key_requests += 1
+        return MockResponse(status=503, text="Service Unavailable")
+
+    monkeypatch.setattr(aiohttp.ClientSession, "get", mock_get)
+
+    key_store = JwksKeyStore("https://login.microsoftonline.com/TENANT_ID/discovery/v2.0/keys", min_refresh_interval=0)
+    key_store.keys = {"kid_1": (public_key_from_jwk(create_mock_jwk(public_key, kid="kid_1")), 0)}
+    # The key set is fetched once, without retries, and an expired key is used until it can be refreshed
+    assert await key_store.get_signing_key("kid_1") is not None
+    assert key_requests == 1
+    # A token with an unknown key id can't be validated
+    with pytest.raises(AuthError):
+        await key_store.get_signing_key("kid_2")
+    assert key_requests == 2
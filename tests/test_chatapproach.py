@@ -1,11 +1,19 @@
+import asyncio
 import json
+from types import SimpleNamespace
 
 import pytest
 from azure.core.credentials import AzureKeyCredential
 from azure.search.documents.aio import SearchClient
-from openai.types.chat import ChatCompletion
+from azure.search.documents.models import VectorizedQuery
+from openai.types.chat import ChatCompletion, ChatCompletionChunk
 
+from approaches import chatapproach
+from approaches.chatapproach import FollowupQuestionParser
 from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
+from core.authentication import AuthenticationHelper
+from core.cancellation import CancellationStats
+from core.deadline import DeadlineExceededError, RequestDeadline
 
 from .mocks import (
     MOCK_EMBEDDING_DIMENSIONS,
@@ -112,6 +120,17 @@ def test_get_search_query_returns_default(chat_approach):
     assert query == default_query
 
 
+def test_get_system_prompt_prerendered(chat_approach):
+    chat_approach.render_system_prompts()
+    for follow_up_questions_prompt in ("", chat_approach.follow_up_questions_prompt_content):
+        assert chat_approach.get_system_prompt(None, follow_up_questions_prompt) == (
+            chat_approach.system_message_chat_conversation.format(
+                injected_prompt="", follow_up_questions_prompt=follow_up_questions_prompt
+            )
+        )
+    assert "Odpowiadaj krótko.\n" in chat_approach.get_system_prompt(">>>Odpowiadaj krótko.", "")
+
+
 def test_extract_followup_questions(chat_approach):
     content = "Here is answer to your question.<<What is the dress code?>>"
     pre_content, followup_questions = chat_approach.extract_followup_questions(content)
@@ -148,6 +167,31 @@ def test_extract_followup_questions_no_pre_content(chat_approach):
     assert followup_questions == ["What is the dress code?"]
 
 
+def test_followup_question_parser_split_delimiters():
+    parser = FollowupQuestionParser()
+    chunks = ["Here is the answer. <", "<What is", " the dress code?>", "><", "<Is there a uniform?>", ">"]
+    results = [parser.feed(chunk) for chunk in chunks]
+    assert results == [
+        ("Here is the answer. ", []),
+        ("", []),
+        ("", []),
+        ("", ["What is the dress code?"]),
+        ("", []),
+        ("", ["Is there a uniform?"]),
+    ]
+    assert parser.close() == ""
+    assert parser.questions == ["What is the dress code?", "Is there a uniform?"]
+
+
+def test_followup_question_parser_trailing_angle_bracket():
+    parser = FollowupQuestionParser()
+    assert parser.feed("Use x <") == ("Use x ", [])
+    assert parser.feed(" y") == ("< y", [])
+    assert parser.feed(" <") == (" ", [])
+    assert parser.close() == "<"
+    assert not parser.started
+
+
 @pytest.mark.asyncio
 @pytest.mark.parametrize(
     "minimum_search_score,minimum_reranker_score,expected_result_count",
@@ -198,3 +242,308 @@ async def test_search_results_filtering_by_scores(
     assert (
         len(filtered_results) == expected_result_count
     ), f"Expected {expected_result_count} results with minimum_search_score={minimum_search_score} and minimum_reranker_score={minimum_reranker_score}"
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "include_vectors,expected_select",
+    [
+        (False, ["id", "content", "category", "sourcepage", "sourcefile"]),
+        (True, ["id", "content", "category", "sourcepage", "sourcefile", "embedding"]),
+    ],
+)
+async def test_search_selects_fields(monkeypatch, chat_approach, include_vectors, expected_select):
+    search_kwargs = {}
+
+    async def capture_search(*args, **kwargs):
+        search_kwargs.update(kwargs)
+        return await mock_search(*args, **kwargs)
+
+    chat_approach.search_client = SearchClient(endpoint="", index_name="", credential=AzureKeyCredential(""))
+    monkeypatch.setattr(SearchClient, "search", capture_search)
+
+    await chat_approach.search(
+        top=3,
+        query_text="test query",
+        filter=None,
+        vectors=[VectorizedQuery(vector=[0.1, 0.2], k_nearest_neighbors=50, fields="embedding")],
+        use_text_search=True,
+        use_vector_search=True,
+        use_semantic_ranker=False,
+        use_semantic_captions=False,
+        minimum_search_score=None,
+        minimum_reranker_score=None,
+        include_vectors=include_vectors,
+    )
+
+    assert search_kwargs["select"] == expected_select
+
+
+class MockOpenAIClient:
+    def __init__(self, rewritten_query: str):
+        self.rewritten_query = rewritten_query
+        self.embedded_texts: list[str] = []
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create_chat_completion))
+        self.embeddings = SimpleNamespace(create=self.create_embedding)
+
+    async def create_chat_completion(self, *args, **kwargs):
+        if kwargs.get("stream") is not None:
+            return None
+        # Give the speculative embedding a chance to run while the rewrite is "in flight"
+        await asyncio.sleep(0)
+        return ChatCompletion.model_validate(
+            {
+                "id": "test",
+                "object": "chat.completion",
+                "created": 0,
+                "model": "gpt-35-turbo",
+                "choices": [
+                    {
+                        "index": 0,
+                        "finish_reason": "stop",
+                        "message": {"role": "assistant", "content": self.rewritten_query},
+                    }
+                ],
+            }
+        )
+
+    async def create_embedding(self, *args, **kwargs):
+        self.embedded_texts.append(kwargs["input"])
+        return SimpleNamespace(data=[SimpleNamespace(embedding=[0.1] * MOCK_EMBEDDING_DIMENSIONS)])
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "rewritten_query, history, expected_status, expected_embedded_texts",
+    [
+        (ChatReadRetrieveReadApproach.NO_RESPONSE, [], "used", ["What is the deductible?"]),
+        ("What is the  deductible?", [], "used", ["What is the deductible?"]),
+        ("deductible health plan", [], "discarded", ["What is the deductible?", "deductible health plan"]),
+        (
+            "deductible health plan",
+            [{"role": "user", "content": "Hi"}, {"role": "assistant", "content": "Hello"}],
+            "disabled",
+            ["deductible health plan"],
+        ),
+    ],
+)
+async def test_speculative_query_embedding(
+    monkeypatch, rewritten_query, history, expected_status, expected_embedded_texts
+):
+    openai_client = MockOpenAIClient(rewritten_query)
+    chat_approach = ChatReadRetrieveReadApproach(
+        search_client=SearchClient(endpoint="", index_name="", credential=AzureKeyCredential("")),
+        auth_helper=AuthenticationHelper(
+            search_index=None,
+            use_authentication=False,
+            server_app_id=None,
+            server_app_secret=None,
+            client_app_id=None,
+            tenant_id=None,
+        ),
+        openai_client=openai_client,
+        chatgpt_model="gpt-35-turbo",
+        chatgpt_deployment="chat",
+        embedding_deployment="embeddings",
+        embedding_model=MOCK_EMBEDDING_MODEL_NAME,
+        embedding_dimensions=MOCK_EMBEDDING_DIMENSIONS,
+        sourcepage_field="",
+        content_field="",
+        query_language="en-US",
+        query_speller="lexicon",
+        speculative_query_embedding=True,
+    )
+    monkeypatch.setattr(SearchClient, "search", mock_search)
+
+    extra_info, chat_coroutine = await chat_approach.run_until_final_call(
+        history + [{"role": "user", "content": "What is the deductible?"}],
+        overrides={"retrieval_mode": "hybrid"},
+        auth_claims={},
+        should_stream=False,
+    )
+    await chat_coroutine
+
+    assert openai_client.embedded_texts == expected_embedded_texts
+    query_step, search_step = extra_info["thoughts"][0], extra_info["thoughts"][1]
+    assert search_step.props["speculative_embedding"] == expected_status
+    assert isinstance(query_step.props["duration_ms"], int)
+    assert isinstance(search_step.props["embedding_duration_ms"], int)
+    assert isinstance(search_step.props["search_duration_ms"], int)
+
+
+class MockChatCompletionStream:
+    def __init__(self, words: list[str]):
+        self.chunks = [
+            ChatCompletionChunk.model_validate(
+                {
+                    "object": "chat.completion.chunk",
+                    "choices": [{"delta": {"content": word, "role": "assistant"}, "index": 0, "finish_reason": None}],
+                    "id": "test-123",
+                    "model": "gpt-35-turbo",
+                    "created": 1,
+                }
+            )
+            for word in words
+        ]
+        self.closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self.chunks:
+            raise StopAsyncIteration
+        return self.chunks.pop(0)
+
+    async def close(self):
+        self.closed = True
+
+
+@pytest.mark.asyncio
+async def test_run_with_streaming_closes_stream_when_cancelled(monkeypatch, chat_approach):
+    stream = MockChatCompletionStream(["The", " capital", " of", " France"])
+
+    async def chat_coroutine():
+        return stream
+
+    async def run_until_final_call(*args, **kwargs):
+        return {}, chat_coroutine()
+
+    def count_text_tokens(model, text, fallback_to_default=False):
+        counted.append((model, text))
+        return len(text.split())
+
+    counted: list[tuple[str, str]] = []
+    stats = CancellationStats()
+    monkeypatch.setattr(chatapproach, "cancellation_stats", stats)
+    monkeypatch.setattr(chatapproach, "count_text_tokens", count_text_tokens)
+    monkeypatch.setattr(chat_approach, "run_until_final_call", run_until_final_call)
+    events = chat_approach.run_with_streaming([{"role": "user", "content": "What is the capital?"}], {}, {})
+    assert (await events.__anext__())["delta"] == {"role": "assistant"}
+    assert (await events.__anext__())["delta"]["content"] == "The"
+    assert (await events.__anext__())["delta"]["content"] == " capital"
+
+    # The client disconnected, so the rest of the answer is not read from OpenAI
+    await events.aclose()
+    assert stream.closed
+    assert len(stream.chunks) == 2
+    # The tokens are counted in the streamed text, as a chunk can hold several of them
+    assert counted == [("gpt-35-turbo", "The capital")]
+    assert stats.stats() == {"requests": 0, "streams": 1, "streamed_tokens": 2, "saved_tokens": 1022}
+
+    # A stream that is read to the end is closed too, but isn't counted as cancelled
+    stream = MockChatCompletionStream(["Paris"])
+    events = chat_approach.run_with_streaming([{"role": "user", "content": "What is the capital?"}], {}, {})
+    assert [event["delta"].get("content") async for event in events] == [None, "Paris"]
+    assert stream.closed
+    assert stats.streams == 1
+
+
+@pytest.mark.asyncio
+async def test_run_with_streaming_stops_stalled_stream_at_deadline(monkeypatch, chat_approach):
+    class StalledChatCompletionStream(MockChatCompletionStream):
+        async def __anext__(self):
+            await asyncio.sleep(10)
+            return await super().__anext__()
+
+    stream = StalledChatCompletionStream(["Paris"])
+
+    async def chat_coroutine():
+        return stream
+
+    async def run_until_final_call(*args, **kwargs):
+        return {}, chat_coroutine()
+
+    monkeypatch.setattr(chat_approach, "run_until_final_call", run_until_final_call)
+    events = chat_approach.run_with_streaming(
+        [{"role": "user", "content": "What is the capital?"}], {}, {}, deadline=RequestDeadline(0.1)
+    )
+    assert (await events.__anext__())["delta"] == {"role": "assistant"}
+    with pytest.raises(DeadlineExceededError):
+        await events.__anext__()
+    assert stream.closed
+
+
+@pytest.mark.asyncio
+async def test_run_with_streaming_ends_answer_between_chunks_at_deadline(monkeypatch, chat_approach):
+    class SlowChatCompletionStream(MockChatCompletionStream):
+        async def __anext__(self):
+            if len(self.chunks) < 3:
+                await asyncio.sleep(0.1)
+            return await super().__anext__()
+
+    stream = SlowChatCompletionStream(["The", " capital", " is", " Paris"])
+
+    async def chat_coroutine():
+        return stream
+
+    async def run_until_final_call(*args, **kwargs):
+        return {}, chat_coroutine()
+
+    monkeypatch.setattr(chat_approach, "run_until_final_call", run_until_final_call)
+    events = chat_approach.run_with_streaming(
+        [{"role": "user", "content": "What is the capital?"}], {}, {}, deadline=RequestDeadline(0.05)
+    )
+    assert (await events.__anext__())["delta"] == {"role": "assistant"}
+    assert (await events.__anext__())["delta"]["content"] == "The"
+    assert (await events.__anext__())["delta"]["content"] == " capital"
+    # The chunk that arrives after the deadline ends the answer, what was already sent is kept
+    with pytest.raises(DeadlineExceededError):
+        await events.__anext__()
+    assert stream.closed
+
+
+@pytest.mark.asyncio
+async def test_deadline_skips_query_rewrite_and_semantic_ranker(monkeypatch):
+    openai_client = MockOpenAIClient("deductible health plan")
+    chat_approach = ChatReadRetrieveReadApproach(
+        search_client=SearchClient(endpoint="", index_name="", credential=AzureKeyCredential("")),
+        auth_helper=AuthenticationHelper(
+            search_index=None,
+            use_authentication=False,
+            server_app_id=None,
+            server_app_secret=None,
+            client_app_id=None,
+            tenant_id=None,
+        ),
+        openai_client=openai_client,
+        chatgpt_model="gpt-35-turbo",
+        chatgpt_deployment="chat",
+        embedding_deployment="embeddings",
+        embedding_model=MOCK_EMBEDDING_MODEL_NAME,
+        embedding_dimensions=MOCK_EMBEDDING_DIMENSIONS,
+        sourcepage_field="",
+        content_field="",
+        query_language="en-US",
+        query_speller="lexicon",
+    )
+    search_kwargs = {}
+
+    async def search(*args, **kwargs):
+        search_kwargs.update(kwargs)
+        return await mock_search(*args, **kwargs)
+
+    monkeypatch.setattr(SearchClient, "search", search)
+    deadline = RequestDeadline(10, degrade_below={"query_rewrite": 15, "semantic_ranker": 10, "vector_search": 5})
+
+    extra_info, chat_coroutine = await chat_approach.run_until_final_call(
+        [{"role": "user", "content": "What is the deductible?"}],
+        overrides={"retrieval_mode": "hybrid", "semantic_ranker": True, "semantic_captions": True},
+        auth_claims={},
+        should_stream=False,
+        deadline=deadline,
+    )
+    await chat_coroutine
+
+    # The question is searched as is, without semantic ranking, but still with its embedding
+    assert openai_client.embedded_texts == ["What is the deductible?"]
+    assert search_kwargs["search_text"] == "What is the deductible?"
+    assert "query_type" not in search_kwargs
+    # The skipped query rewrite is only listed with the skipped steps
+    search_step, deadline_step = extra_info["thoughts"][0], extra_info["thoughts"][-1]
+    assert search_step.title == "Search using generated search query"
+    assert search_step.props["use_semantic_ranker"] is False
+    assert search_step.props["use_semantic_captions"] is False
+    assert deadline_step.title == "Steps skipped to answer within the request deadline"
+    assert [degradation["step"] for degradation in deadline_step.description] == ["query_rewrite", "semantic_ranker"]
+    assert deadline_step.props == {"deadline_seconds": 10}
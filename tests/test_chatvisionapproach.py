@@ -1,5 +1,7 @@
+import asyncio
 import json
 
+import aiohttp
 import pytest
 from azure.search.documents.indexes.models import SearchField, SearchIndex
 from azure.search.documents.models import (
@@ -148,3 +150,34 @@ async def test_compute_text_embedding(chat_approach, openai_client, mock_openai_
     assert result.vector == [0.0023064255, -0.009327292, -0.0028842222]
     assert result.k_nearest_neighbors == 50
     assert result.fields == "embedding"
+
+
+@pytest.mark.asyncio
+async def test_compute_multi_vectors_degrades(chat_approach, openai_client, mock_openai_embedding, monkeypatch):
+    mock_openai_embedding(openai_client)
+
+    async def slow_image_embedding(q):
+        await asyncio.sleep(1)
+
+    monkeypatch.setattr(chat_approach, "compute_image_embedding", slow_image_embedding)
+    chat_approach.vector_field_timeouts = {"embedding": 1, "imageEmbedding": 0.01}
+
+    vectors, timings = await chat_approach.compute_multi_vectors(
+        "test query", ["embedding", "imageEmbedding"], use_text_search=False
+    )
+    assert [vector.fields for vector in vectors] == ["embedding"]
+    assert timings["embedding"]["status"] == "ok"
+    assert timings["imageEmbedding"]["status"] == "timeout"
+    assert timings["imageEmbedding"]["duration_ms"] >= 10
+
+    async def failing_image_embedding(q):
+        raise aiohttp.ClientResponseError(request_info=None, history=(), status=500)
+
+    monkeypatch.setattr(chat_approach, "compute_image_embedding", failing_image_embedding)
+    vectors, timings = await chat_approach.compute_multi_vectors("test query", ["imageEmbedding"], use_text_search=True)
+    assert vectors == []
+    assert timings["imageEmbedding"]["status"] == "failed"
+
+    # Without any vector or text search left, the request fails instead of searching with nothing
+    with pytest.raises(aiohttp.ClientResponseError):
+        await chat_approach.compute_multi_vectors("test query", ["imageEmbedding"], use_text_search=False)
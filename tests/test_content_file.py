@@ -1,4 +1,6 @@
+import asyncio
 import os
+import socket
 
 import aiohttp
 import azure.storage.blob.aio
@@ -10,9 +12,11 @@ from azure.core.pipeline.transport import (
     AsyncHttpTransport,
     HttpRequest,
 )
+from azure.storage.blob import BlobProperties
 from azure.storage.blob.aio import BlobServiceClient
 
 import app
+from core.contentcache import ContentFileCache
 
 from .mocks import MockAzureCredential, MockBlob
 
@@ -28,11 +32,11 @@ class MockAiohttpClientResponse404(aiohttp.ClientResponse):
 
 
 class MockAiohttpClientResponse(aiohttp.ClientResponse):
-    def __init__(self, url, body_bytes, headers=None):
+    def __init__(self, url, body_bytes, headers=None, status=200):
         self._body = body_bytes
         self._headers = headers
         self._cache = {}
-        self.status = 200
+        self.status = status
         self.reason = "OK"
         self._url = url
 
@@ -97,11 +101,308 @@ async def test_content_file(monkeypatch, mock_env, mock_acs_search):
         assert await response.get_data() == b"test content"
 
 
+@pytest.mark.asyncio
+async def test_content_file_range_and_revalidation(monkeypatch, mock_env, mock_acs_search):
+    content = b"%PDF-1.4 test content of the pdf"
+    etag = '"0x8DC1234567890AB"'
+    requests = []
+
+    class MockTransport(AsyncHttpTransport):
+        async def send(self, request: HttpRequest, **kwargs) -> AioHttpTransportResponse:
+            requests.append(request)
+            if request.headers.get("If-None-Match") == etag:
+                return AioHttpTransportResponse(
+                    request, MockAiohttpClientResponse(request.url, b"", {"ETag": etag}, status=304)
+                )
+            if request.headers.get("If-Match", etag) != etag:
+                return AioHttpTransportResponse(
+                    request,
+                    MockAiohttpClientResponse(request.url, b"", {"x-ms-error-code": "ConditionNotMet"}, status=412),
+                )
+            if request.method == "HEAD":
+                return AioHttpTransportResponse(
+                    request,
+                    MockAiohttpClientResponse(
+                        request.url, b"", {"Content-Length": str(len(content)), "ETag": etag}, status=200
+                    ),
+                )
+            start, end = request.headers["x-ms-range"].removeprefix("bytes=").split("-")
+            if int(start) >= len(content):
+                return AioHttpTransportResponse(request, MockAiohttpClientResponse(request.url, b"", {}, status=416))
+            body = content[int(start) : int(end) + 1]
+            return AioHttpTransportResponse(
+                request,
+                MockAiohttpClientResponse(
+                    request.url,
+                    body,
+                    {
+                        "Content-Type": "application/pdf",
+                        "Content-Range": f"bytes {start}-{int(start) + len(body) - 1}/{len(content)}",
+                        "Content-Length": str(len(body)),
+                        "ETag": etag,
+                        "Last-Modified": "Wed, 01 May 2024 10:00:00 GMT",
+                    },
+                    status=206,
+                ),
+            )
+
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *args):
+            pass
+
+        async def open(self):
+            pass
+
+        async def close(self):
+            pass
+
+    blob_client = BlobServiceClient(
+        f"https://{os.environ['AZURE_STORAGE_ACCOUNT']}.blob.core.windows.net",
+        credential=MockAzureCredential(),
+        transport=MockTransport(),
+        retry_total=0,
+        max_single_get_size=8,
+        max_chunk_get_size=8,
+    )
+    blob_container_client = blob_client.get_container_client(os.environ["AZURE_STORAGE_CONTAINER"])
+
+    quart_app = app.create_app()
+    async with quart_app.test_app() as test_app:
+        quart_app.config.update({"blob_container_client": blob_container_client})
+        client = test_app.test_client()
+
+        # The whole file is streamed in storage-sized chunks
+        response = await client.get("/content/role_library.pdf")
+        assert response.status_code == 200
+        assert response.headers["Accept-Ranges"] == "bytes"
+        assert response.headers["ETag"] == etag
+        assert response.headers["Last-Modified"] == "Wed, 01 May 2024 10:00:00 GMT"
+        assert response.headers["Content-Length"] == str(len(content))
+        assert await response.get_data() == content
+        assert len(requests) == 4
+
+        response = await client.get("/content/role_library.pdf", headers={"Range": "bytes=9-12"})
+        assert response.status_code == 206
+        assert response.headers["Content-Range"] == f"bytes 9-12/{len(content)}"
+        assert response.headers["Content-Length"] == "4"
+        assert await response.get_data() == b"test"
+        assert requests[-1].headers["x-ms-range"] == "bytes=9-12"
+
+        response = await client.get("/content/role_library.pdf", headers={"Range": "bytes=28-"})
+        assert response.status_code == 206
+        assert response.headers["Content-Range"] == f"bytes 28-31/{len(content)}"
+        assert await response.get_data() == b" pdf"
+
+        response = await client.get(
+            "/content/role_library.pdf", headers={"Range": "bytes=9-12", "If-Range": '"0x8DC0000000000AA"'}
+        )
+        assert response.status_code == 200
+        assert await response.get_data() == content
+
+        response = await client.get("/content/role_library.pdf", headers={"Range": "bytes=100-"})
+        assert response.status_code == 416
+        assert response.headers["Content-Range"] == f"bytes */{len(content)}"
+
+        # If-None-Match goes to storage, and If-Range is checked against the ETag of the download
+        stale_etag = '"0x8DC0000000000AA"'
+        response = await client.get(
+            "/content/role_library.pdf", headers={"Range": "bytes=9-12", "If-None-Match": stale_etag, "If-Range": etag}
+        )
+        assert response.status_code == 206
+        assert await response.get_data() == b"test"
+        assert requests[-1].headers["If-None-Match"] == stale_etag
+        response = await client.get(
+            "/content/role_library.pdf",
+            headers={"Range": "bytes=9-12", "If-None-Match": stale_etag, "If-Range": stale_etag},
+        )
+        assert response.status_code == 200
+        assert await response.get_data() == content
+
+        response = await client.get("/content/role_library.pdf", headers={"If-None-Match": etag})
+        assert response.status_code == 304
+        assert response.headers["ETag"] == etag
+        assert await response.get_data() == b""
+
+
+@pytest.mark.asyncio
+async def test_content_file_disk_cache(monkeypatch, tmp_path, mock_env, mock_acs_search):
+    blob = {"content": b"%PDF-1.4 cached content", "etag": '"0x8DC1"'}
+    requests = []
+
+    class MockTransport(AsyncHttpTransport):
+        async def send(self, request: HttpRequest, **kwargs) -> AioHttpTransportResponse:
+            requests.append(request.method)
+            content = blob["content"]
+            headers = {
+                "Content-Type": "application/pdf",
+                "ETag": blob["etag"],
+                "Last-Modified": "Wed, 01 May 2024 10:00:00 GMT",
+            }
+            if request.method == "HEAD":
+                headers["Content-Length"] = str(len(content))
+                return AioHttpTransportResponse(request, MockAiohttpClientResponse(request.url, b"", headers))
+            headers["Content-Range"] = f"bytes 0-{len(content) - 1}/{len(content)}"
+            headers["Content-Length"] = str(len(content))
+            return AioHttpTransportResponse(
+                request, MockAiohttpClientResponse(request.url, content, headers, status=206)
+            )
+
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *args):
+            pass
+
+        async def open(self):
+            pass
+
+        async def close(self):
+            pass
+
+    blob_client = BlobServiceClient(
+        f"https://{os.environ['AZURE_STORAGE_ACCOUNT']}.blob.core.windows.net",
+        credential=MockAzureCredential(),
+        transport=MockTransport(),
+        retry_total=0,
+    )
+    blob_container_client = blob_client.get_container_client(os.environ["AZURE_STORAGE_CONTAINER"])
+    monkeypatch.setenv("CONTENT_CACHE_DIR", str(tmp_path))
+
+    quart_app = app.create_app()
+    async with quart_app.test_app() as test_app:
+        quart_app.config.update({"blob_container_client": blob_container_client})
+        content_cache = quart_app.config["content_cache"]
+        client = test_app.test_client()
+
+        # A miss is streamed from storage while the cache is filled in the background
+        response = await client.get("/content/role_library.pdf")
+        assert response.status_code == 200
+        assert await response.get_data() == blob["content"]
+        await asyncio.gather(*content_cache.fill_tasks.values())
+        assert requests == ["GET", "GET"]
+        assert content_cache.stats()["files"] == 1
+
+        # Hits are served from disk without contacting storage until they need revalidation
+        response = await client.get("/content/role_library.pdf")
+        assert response.status_code == 200
+        assert response.headers["Content-Type"] == "application/pdf"
+        assert response.headers["ETag"] == blob["etag"]
+        assert "Cache-Control" not in response.headers
+        assert await response.get_data() == blob["content"]
+
+        response = await client.get("/content/role_library.pdf", headers={"Range": "bytes=9-14"})
+        assert response.status_code == 206
+        assert response.headers["Content-Range"] == f"bytes 9-14/{len(blob['content'])}"
+        assert await response.get_data() == b"cached"
+
+        response = await client.get("/content/role_library.pdf", headers={"If-None-Match": blob["etag"]})
+        assert response.status_code == 304
+        assert requests == ["GET", "GET"]
+
+        # An unchanged ETag keeps the entry, a changed one evicts it and falls back to storage
+        content_cache.entries["blob/role_library.pdf"].validated_at = 0
+        response = await client.get("/content/role_library.pdf")
+        assert await response.get_data() == blob["content"]
+        assert requests == ["GET", "GET", "HEAD"]
+
+        blob.update({"content": b"%PDF-1.4 updated content", "etag": '"0x8DC2"'})
+        content_cache.entries["blob/role_library.pdf"].validated_at = 0
+        response = await client.get("/content/role_library.pdf")
+        assert response.headers["ETag"] == blob["etag"]
+        assert await response.get_data() == b"%PDF-1.4 updated content"
+        await asyncio.gather(*content_cache.fill_tasks.values())
+        assert requests[2:] == ["HEAD", "HEAD", "GET", "GET"]
+        assert content_cache.entries["blob/role_library.pdf"].etag == blob["etag"]
+
+        stats = content_cache.stats()
+        assert stats["hits"] == 4
+        assert stats["misses"] == 2
+        assert stats["hit_ratio"] == 4 / 6
+        assert stats["bytes_saved"] == 2 * len(b"%PDF-1.4 cached content") + len(b"cached")
+
+
+@pytest.mark.asyncio
+async def test_content_file_cache_eviction(tmp_path):
+    class MockDownloader:
+        def __init__(self, content):
+            self.size = len(content)
+            self.properties = BlobProperties(ETag=f'"{len(content)}"')
+            self.content = content
+
+        async def chunks(self):
+            yield self.content
+
+    def download(content):
+        async def download_content():
+            return MockDownloader(content)
+
+        return download_content
+
+    # Folders of workers of this host that are gone are removed, those of running workers and other hosts are kept
+    host = socket.gethostname()
+    (tmp_path / f"worker-{host}-999999999").mkdir()
+    (tmp_path / f"worker-{host}-{os.getppid()}").mkdir()
+    (tmp_path / "worker-other-host-999999999").mkdir()
+    content_cache = ContentFileCache(str(tmp_path), max_bytes=10, unlink_delay=0.01)
+    assert sorted(path.name for path in tmp_path.iterdir()) == sorted(
+        [f"worker-{host}-{os.getppid()}", f"worker-{host}-{os.getpid()}", "worker-other-host-999999999"]
+    )
+    await content_cache.fill("a", "text/plain", download(b"aaaa"))
+    await content_cache.fill("b", "text/plain", download(b"bbbb"))
+    assert content_cache.lookup("a") is not None
+    # Files larger than the whole cache are never stored
+    await content_cache.fill("big", "text/plain", download(b"x" * 11))
+    assert content_cache.lookup("big") is None
+    # "b" is now the least recently used entry, so it is evicted to make room
+    evicted_path = content_cache.entries["b"].file_path
+    await content_cache.fill("c", "text/plain", download(b"cccc"))
+    assert list(content_cache.entries) == ["a", "c"]
+    assert content_cache.stats()["bytes"] == 8
+    # The evicted file is kept for a while, as a response may still be about to send it
+    assert evicted_path.exists()
+    await asyncio.sleep(0.05)
+    assert sorted(path.name for path in content_cache.directory.iterdir()) == sorted(
+        entry.file_path.name for entry in content_cache.entries.values()
+    )
+    content_cache.close()
+    assert not content_cache.directory.exists()
+
+
+@pytest.mark.asyncio
+async def test_content_file_cache_merges_fills(tmp_path):
+    downloads = []
+
+    class MockDownloader:
+        size = 4
+        properties = BlobProperties(ETag='"etag"')
+
+        async def chunks(self):
+            yield b"aaaa"
+
+    async def download():
+        downloads.append(1)
+        await asyncio.sleep(0)
+        return MockDownloader()
+
+    content_cache = ContentFileCache(str(tmp_path), max_bytes=10)
+    # The parallel ranged requests of a PDF viewer share one download of the whole file
+    for _ in range(3):
+        content_cache.schedule_fill("a", "application/pdf", download)
+    # A file known to be larger than the cache is not downloaded
+    content_cache.schedule_fill("big", "application/pdf", download, size=11)
+    await asyncio.gather(*content_cache.fill_tasks.values())
+    assert len(downloads) == 1
+    assert list(content_cache.entries) == ["a"]
+    content_cache.close()
+
+
 @pytest.mark.asyncio
 async def test_content_file_useruploaded_found(monkeypatch, auth_client, mock_blob_container_client):
 
     class MockBlobClient:
-        async def download_blob(self):
+        async def download_blob(self, **kwargs):
             raise ResourceNotFoundError(MockAiohttpClientResponse404("userdoc.pdf", b""))
 
     monkeypatch.setattr(
@@ -110,7 +411,7 @@ async def test_content_file_useruploaded_found(monkeypatch, auth_client, mock_bl
 
     downloaded_files = []
 
-    async def mock_download_file(self):
+    async def mock_download_file(self, **kwargs):
         downloaded_files.append(self.path_name)
         return MockBlob()
 
@@ -125,14 +426,14 @@ async def test_content_file_useruploaded_found(monkeypatch, auth_client, mock_bl
 async def test_content_file_useruploaded_notfound(monkeypatch, auth_client, mock_blob_container_client):
 
     class MockBlobClient:
-        async def download_blob(self):
+        async def download_blob(self, **kwargs):
             raise ResourceNotFoundError(MockAiohttpClientResponse404("userdoc.pdf", b""))
 
     monkeypatch.setattr(
         azure.storage.blob.aio.ContainerClient, "get_blob_client", lambda *args, **kwargs: MockBlobClient()
     )
 
-    async def mock_download_file(self):
+    async def mock_download_file(self, **kwargs):
         raise ResourceNotFoundError(MockAiohttpClientResponse404("userdoc.pdf", b""))
 
     monkeypatch.setattr(azure.storage.filedatalake.aio.DataLakeFileClient, "download_file", mock_download_file)
@@ -0,0 +1,63 @@
+import asyncio
+
+import pytest
+
+from core.deadline import DeadlineExceededError, DeadlinePolicy, RequestDeadline
+
+
+@pytest.mark.asyncio
+async def test_run_times_out_at_deadline():
+    deadline = RequestDeadline(0.05)
+
+    async def search():
+        await asyncio.sleep(10)
+
+    with pytest.raises(DeadlineExceededError) as exc_info:
+        await deadline.run("search", search())
+    assert exc_info.value.step == "search"
+
+    # Once the deadline has passed, later steps fail right away without being started
+    task = asyncio.create_task(search())
+    with pytest.raises(DeadlineExceededError):
+        await deadline.run("embedding", task)
+    await asyncio.sleep(0)
+    assert task.cancelled()
+
+
+@pytest.mark.asyncio
+async def test_without_deadline_nothing_is_skipped():
+    deadline = RequestDeadline(degrade_below={"query_rewrite": 15})
+
+    async def answer():
+        return "Paris"
+
+    assert await deadline.run("answer", answer()) == "Paris"
+    assert not deadline.degrade("query_rewrite")
+    assert deadline.degradations == []
+
+
+@pytest.mark.asyncio
+async def test_queueing_does_not_count():
+    deadline = RequestDeadline(0.2)
+    await asyncio.sleep(0.1)
+    deadline.start()
+    async with deadline.paused():
+        await asyncio.sleep(0.1)
+    assert deadline.remaining() > 0.15
+
+
+def test_degrade_records_skipped_steps():
+    deadline = RequestDeadline(10, degrade_below={"query_rewrite": 15, "semantic_ranker": 5})
+    assert deadline.degrade("query_rewrite")
+    assert not deadline.degrade("semantic_ranker")
+    assert not deadline.degrade("vector_search")
+    assert [degradation["step"] for degradation in deadline.degradations] == ["query_rewrite"]
+    assert 9000 < deadline.degradations[0]["remaining_ms"] <= 10000
+
+
+def test_policy_route_seconds():
+    policy = DeadlinePolicy(30, route_seconds={"/chat/stream": 60}, degrade_below={"query_rewrite": 15})
+    assert policy.start("/chat").seconds == 30
+    assert policy.start("/chat/stream").seconds == 60
+    assert policy.start("/ask").degrade_below == {"query_rewrite": 15}
+    assert DeadlinePolicy().start("/chat").remaining() == float("inf")
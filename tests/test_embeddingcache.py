@@ -0,0 +1,82 @@
+from array import array
+from types import SimpleNamespace
+
+import pytest
+
+from approaches.retrievethenread import RetrieveThenReadApproach
+from core.embeddingcache import QueryEmbeddingCache, SQLiteEmbeddingStore
+
+from .mocks import MOCK_EMBEDDING_DIMENSIONS, MOCK_EMBEDDING_MODEL_NAME
+
+
+@pytest.mark.asyncio
+async def test_query_embedding_cache_memory():
+    cache = QueryEmbeddingCache(maxsize=10)
+    assert await cache.get("text-embedding-3-small", 256, "What is the deductible?") is None
+
+    await cache.set("text-embedding-3-small", 256, "What is the deductible?", [0.1, 0.2, 0.3])
+    # Whitespace differences share the entry, vectors come back as float32 values
+    assert (
+        await cache.get("text-embedding-3-small", 256, "  What is the\tdeductible? ")
+        == array("f", [0.1, 0.2, 0.3]).tolist()
+    )
+    # Model and dimensions are part of the key
+    assert await cache.get("text-embedding-3-small", 512, "What is the deductible?") is None
+    assert await cache.get("text-embedding-3-large", 256, "What is the deductible?") is None
+    assert cache.stats() == {"hits": 1, "shared_hits": 0, "misses": 3, "hit_ratio": 0.25, "size": 1}
+
+
+@pytest.mark.asyncio
+async def test_query_embedding_cache_shared_store(tmp_path):
+    path = str(tmp_path / "embeddings.db")
+    worker1 = QueryEmbeddingCache(maxsize=10, shared_store=SQLiteEmbeddingStore(path))
+    worker2 = QueryEmbeddingCache(maxsize=10, shared_store=SQLiteEmbeddingStore(path))
+
+    await worker1.set("text-embedding-ada-002", None, "deductible", [0.5, -0.25])
+    assert await worker2.get("text-embedding-ada-002", None, "deductible") == [0.5, -0.25]
+    # The shared hit is promoted to the in-process tier
+    assert await worker2.get("text-embedding-ada-002", None, "deductible") == [0.5, -0.25]
+    assert worker2.stats() == {"hits": 1, "shared_hits": 1, "misses": 0, "hit_ratio": 1.0, "size": 1}
+    worker1.close()
+    worker2.close()
+
+
+@pytest.mark.asyncio
+async def test_sqlite_embedding_store_prunes_oldest(tmp_path):
+    store = SQLiteEmbeddingStore(str(tmp_path / "embeddings.db"), max_entries=2, prune_every=3)
+    for key in ["a", "b", "c"]:
+        await store.set(key, array("f", [1.0]).tobytes())
+    assert await store.get("a") is None
+    assert await store.get("c") is not None
+    store.close()
+
+
+@pytest.mark.asyncio
+async def test_compute_text_embedding_uses_cache():
+    embedded_texts = []
+
+    async def create_embedding(*args, **kwargs):
+        embedded_texts.append(kwargs["input"])
+        return SimpleNamespace(data=[SimpleNamespace(embedding=[0.1] * MOCK_EMBEDDING_DIMENSIONS)])
+
+    approach = RetrieveThenReadApproach(
+        search_client=None,
+        auth_helper=None,
+        openai_client=SimpleNamespace(embeddings=SimpleNamespace(create=create_embedding)),
+        chatgpt_model="gpt-35-turbo",
+        chatgpt_deployment="chat",
+        embedding_deployment="embeddings",
+        embedding_model=MOCK_EMBEDDING_MODEL_NAME,
+        embedding_dimensions=MOCK_EMBEDDING_DIMENSIONS,
+        sourcepage_field="",
+        content_field="",
+        query_language="en-US",
+        query_speller="lexicon",
+        embedding_cache=QueryEmbeddingCache(maxsize=10),
+    )
+
+    first = await approach.compute_text_embedding("What is the deductible?")
+    second = await approach.compute_text_embedding("What is the deductible?")
+    assert embedded_texts == ["What is the deductible?"]
+    assert second.vector == pytest.approx(first.vector)
+    assert second.fields == "embedding"
@@ -0,0 +1,112 @@
+import asyncio
+
+import pytest
+import quart
+
+import app
+from config import CONFIG_BEHIND_PROXY
+from core.admission import AdmissionRejectedError
+from core.fairshare import FairShareScheduler
+
+
+@pytest.mark.asyncio
+async def test_waiting_requests_are_interleaved_by_identity():
+    scheduler = FairShareScheduler(max_concurrency=1)
+    order = []
+
+    async def request(identity: str, weight: float = 1.0):
+        async with scheduler.slot(identity, weight):
+            order.append(identity)
+            await asyncio.sleep(0)
+
+    await scheduler.acquire("power-user")
+    tasks = [asyncio.create_task(request("power-user")) for _ in range(3)]
+    await asyncio.sleep(0)
+    for _ in range(2):
+        tasks += [asyncio.create_task(request("user")), asyncio.create_task(request("executive", weight=4))]
+    await asyncio.sleep(0)
+    assert scheduler.stats() == {
+        "in_flight": 1,
+        "queued": 7,
+        "identities": 3,
+        "identity_max_in_flight": 1,
+        "identity_max_queued": 3,
+        "rejected": 0,
+    }
+
+    scheduler.release("power-user")
+    await asyncio.gather(*tasks)
+    # The power user's requests queued first, but the others had not used their share yet,
+    # and the executive's weight lets both of their requests in before the others
+    assert order == ["user", "executive", "executive", "power-user", "user", "power-user", "power-user"]
+    assert scheduler.stats()["in_flight"] == 0
+    assert scheduler.stats()["identities"] == 0
+
+
+@pytest.mark.asyncio
+async def test_request_waiting_too_long_is_rejected():
+    scheduler = FairShareScheduler(max_concurrency=1, max_wait=0.01)
+    async with scheduler.slot("user"):
+        with pytest.raises(AdmissionRejectedError) as exc_info:
+            await scheduler.acquire("other-user")
+        assert exc_info.value.status_code == 503
+    assert scheduler.stats() == {
+        "in_flight": 0,
+        "queued": 0,
+        "identities": 0,
+        "identity_max_in_flight": 0,
+        "identity_max_queued": 0,
+        "rejected": 1,
+    }
+    # The rejected request no longer holds a place in line
+    async with scheduler.slot("other-user"):
+        assert scheduler.stats()["in_flight"] == 1
+
+
+@pytest.mark.asyncio
+async def test_schedule_releases_slot_when_stream_is_closed():
+    scheduler = FairShareScheduler(max_concurrency=1)
+
+    async def events():
+        for i in range(3):
+            yield {"delta": {"content": str(i)}}
+
+    stream = scheduler.schedule(events(), "user")
+    assert await stream.__anext__() == {"delta": {"content": "0"}}
+    assert scheduler.stats()["in_flight"] == 1
+    await stream.aclose()
+    assert scheduler.stats()["in_flight"] == 0
+
+
+def test_get_weight():
+    scheduler = FairShareScheduler(group_weights={"executives": 4, "staff": 2}, route_weights={"/upload": 0.25})
+    assert scheduler.get_weight({"groups": ["staff", "executives"]}, "/chat/stream") == 4
+    assert scheduler.get_weight({"groups": ["staff"]}, "/upload") == 0.5
+    assert scheduler.get_weight({}, "/chat") == 1
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("weight", [0, -1])
+async def test_weights_must_be_positive(weight):
+    with pytest.raises(ValueError):
+        FairShareScheduler(group_weights={"executives": weight})
+    with pytest.raises(ValueError):
+        FairShareScheduler(route_weights={"/upload": weight})
+    with pytest.raises(ValueError):
+        await FairShareScheduler().acquire("user", weight)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("behind_proxy, identity", [(True, "203.0.113.7"), (False, "198.51.100.1")])
+async def test_get_fair_share_identity_ignores_forged_addresses(behind_proxy, identity):
+    quart_app = app.create_app()
+    quart_app.config[CONFIG_BEHIND_PROXY] = behind_proxy
+    # The client sent its own X-Forwarded-For, and the front end appended the address it connected from
+    async with quart_app.test_request_context(
+        "/chat",
+        method="POST",
+        headers={"X-Forwarded-For": "10.0.0.1, 203.0.113.7:50432"},
+    ):
+        quart.request.remote_addr = "198.51.100.1"
+        assert app.get_fair_share_identity({}) == identity
+        assert app.get_fair_share_identity({"oid": "OID_X"}) == "OID_X"
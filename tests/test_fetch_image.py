@@ -1,4 +1,8 @@
+import asyncio
+import base64
+import io
 import os
+from urllib.parse import parse_qs, urlparse
 
 import aiohttp
 import pytest
@@ -8,10 +12,19 @@ from azure.core.pipeline.transport import (
     AsyncHttpTransport,
     HttpRequest,
 )
+from azure.storage.blob import UserDelegationKey
 from azure.storage.blob.aio import BlobServiceClient
+from PIL import Image
 
 from approaches.approach import Document
-from core.imageshelper import fetch_image
+from core.imageshelper import (
+    ImageCache,
+    ImageDelivery,
+    fetch_image,
+    fetch_images,
+    redact_image_url,
+    redact_image_urls,
+)
 
 from .mocks import MockAzureCredential
 
@@ -99,3 +112,277 @@ async def test_content_file(monkeypatch, mock_env, mock_acs_search):
     test_document.sourcepage = ""
     image_url = await fetch_image(blob_container_client, test_document)
     assert image_url is None
+
+
+@pytest.mark.asyncio
+async def test_fetch_images_cached_by_etag(monkeypatch, mock_env):
+    class MockAiohttpClientResponse(aiohttp.ClientResponse):
+        def __init__(self, url, status, body_bytes, headers=None):
+            self._body = body_bytes
+            self._headers = headers
+            self._cache = {}
+            self.status = status
+            self.reason = "OK" if status == 200 else "Not Modified"
+            self._url = url
+
+    requests: list[HttpRequest] = []
+    etags = {"page1.png": '"0x1"', "page2.png": '"0x1"'}
+    in_flight = 0
+    max_in_flight = 0
+
+    class MockTransport(AsyncHttpTransport):
+        async def send(self, request: HttpRequest, **kwargs) -> AioHttpTransportResponse:
+            nonlocal in_flight, max_in_flight
+            requests.append(request)
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+            await asyncio.sleep(0.01)
+            in_flight -= 1
+            etag = etags[request.url.split("/")[-1]]
+            if request.headers.get("If-None-Match") == etag:
+                return AioHttpTransportResponse(request, MockAiohttpClientResponse(request.url, 304, b"", {}))
+            return AioHttpTransportResponse(
+                request,
+                MockAiohttpClientResponse(
+                    request.url,
+                    200,
+                    b"test content",
+                    {
+                        "Content-Type": "application/octet-stream",
+                        "Content-Range": "bytes 0-11/12",
+                        "Content-Length": "12",
+                        "ETag": etag,
+                    },
+                ),
+            )
+
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *args):
+            pass
+
+        async def open(self):
+            pass
+
+        async def close(self):
+            pass
+
+    blob_client = BlobServiceClient(
+        f"https://{os.environ['AZURE_STORAGE_ACCOUNT']}.blob.core.windows.net",
+        credential=MockAzureCredential(),
+        transport=MockTransport(),
+        retry_total=0,
+    )
+    blob_container_client = blob_client.get_container_client(os.environ["AZURE_STORAGE_CONTAINER"])
+    results = [
+        Document(
+            id=str(page),
+            content="test content",
+            embedding=None,
+            image_embedding=None,
+            category=None,
+            oids=[],
+            groups=[],
+            captions=[],
+            sourcepage=f"page{page}.pdf#page={page}",
+            sourcefile=f"page{page}.pdf",
+        )
+        for page in (1, 2, 1)
+    ]
+    image_cache = ImageCache(max_bytes=1024, revalidate_after=60)
+
+    images = await fetch_images(blob_container_client, results[:2], image_cache, max_concurrency=2)
+    assert [image["url"] for image in images] == ["data:image/png;base64,dGVzdCBjb250ZW50"] * 2
+    assert len(requests) == 2
+    assert max_in_flight == 2
+
+    # Hot pages are served from memory without contacting storage
+    images = await fetch_images(blob_container_client, results, image_cache, max_concurrency=2)
+    assert len(images) == 3
+    assert len(requests) == 2
+    assert image_cache.stats() == {"hits": 3, "misses": 2, "hit_ratio": 0.6, "bytes": 76, "images": 2}
+
+    # Once stale, unchanged pages are revalidated by ETag and changed ones are downloaded again
+    image_cache.revalidate_after = 0
+    etags["page2.png"] = '"0x2"'
+    images = await fetch_images(blob_container_client, results[:2], image_cache, max_concurrency=1)
+    assert len(images) == 2
+    assert [request.headers.get("If-None-Match") for request in requests[2:]] == ['"0x1"', '"0x1"']
+    assert image_cache.lookup("page2.png").etag == '"0x2"'
+    assert max_in_flight == 2
+
+
+def test_image_cache_evicts_least_recently_used():
+    image_cache = ImageCache(max_bytes=10)
+    image_cache.set("page1.png", '"0x1"', "aaaa")
+    image_cache.set("page2.png", '"0x1"', "bbbb")
+    image_cache.lookup("page1.png")
+    image_cache.set("page3.png", '"0x1"', "cccc")
+    assert list(image_cache.entries) == ["page1.png", "page3.png"]
+    assert image_cache.total_bytes == 8
+    # Images larger than the whole cache are never stored
+    image_cache.set("page4.png", '"0x1"', "d" * 11)
+    assert image_cache.lookup("page4.png") is None
+
+
+@pytest.mark.asyncio
+async def test_fetch_image_downscaled(monkeypatch, mock_env):
+    page = Image.new("RGB", (1200, 1600), "white")
+    page_png = io.BytesIO()
+    page.save(page_png, format="PNG")
+    page_bytes = page_png.getvalue()
+
+    class MockAiohttpClientResponse(aiohttp.ClientResponse):
+        def __init__(self, url, body_bytes, headers=None):
+            self._body = body_bytes
+            self._headers = headers
+            self._cache = {}
+            self.status = 200
+            self.reason = "OK"
+            self._url = url
+
+    class MockTransport(AsyncHttpTransport):
+        async def send(self, request: HttpRequest, **kwargs) -> AioHttpTransportResponse:
+            return AioHttpTransportResponse(
+                request,
+                MockAiohttpClientResponse(
+                    request.url,
+                    page_bytes,
+                    {
+                        "Content-Type": "application/octet-stream",
+                        "Content-Range": f"bytes 0-{len(page_bytes) - 1}/{len(page_bytes)}",
+                        "Content-Length": str(len(page_bytes)),
+                    },
+                ),
+            )
+
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *args):
+            pass
+
+        async def open(self):
+            pass
+
+        async def close(self):
+            pass
+
+    blob_client = BlobServiceClient(
+        f"https://{os.environ['AZURE_STORAGE_ACCOUNT']}.blob.core.windows.net",
+        credential=MockAzureCredential(),
+        transport=MockTransport(),
+        retry_total=0,
+    )
+    blob_container_client = blob_client.get_container_client(os.environ["AZURE_STORAGE_CONTAINER"])
+    delivery = ImageDelivery(mode="downscale", detail="low", max_pixels=300 * 400)
+    test_document = Document(
+        id="test",
+        content="test content",
+        embedding=None,
+        image_embedding=None,
+        category=None,
+        oids=[],
+        groups=[],
+        captions=[],
+        sourcefile="test.pdf",
+        sourcepage="test.pdf#page=2",
+    )
+
+    image_url = await fetch_image(blob_container_client, test_document, delivery=delivery)
+    assert image_url is not None
+    assert image_url["detail"] == "low"
+    assert image_url["url"].startswith("data:image/jpeg;base64,")
+    with Image.open(io.BytesIO(base64.b64decode(image_url["url"].split(",", 1)[1]))) as image:
+        assert image.size == (300, 400)
+    stats = delivery.stats()
+    assert stats["images"] == 1
+    assert stats["stored_bytes"] == len(page_bytes)
+    assert stats["delivered_bytes"] == len(image_url["url"])
+
+
+@pytest.mark.asyncio
+async def test_fetch_image_sas_url(monkeypatch, mock_env):
+    class MockBlobServiceClient:
+        def __init__(self):
+            self.key_requests = 0
+
+        async def get_user_delegation_key(self, key_start_time, key_expiry_time):
+            self.key_requests += 1
+            await asyncio.sleep(0)
+            key = UserDelegationKey()
+            key.signed_oid = "oid"
+            key.signed_tid = "tid"
+            key.signed_start = key_start_time.strftime("%Y-%m-%dT%H:%M:%SZ")
+            key.signed_expiry = key_expiry_time.strftime("%Y-%m-%dT%H:%M:%SZ")
+            key.signed_service = "b"
+            key.signed_version = "2023-11-03"
+            key.value = base64.b64encode(b"secret").decode()
+            return key
+
+    blob_service_client = MockBlobServiceClient()
+    blob_container_client = BlobServiceClient(
+        f"https://{os.environ['AZURE_STORAGE_ACCOUNT']}.blob.core.windows.net", credential=MockAzureCredential()
+    ).get_container_client(os.environ["AZURE_STORAGE_CONTAINER"])
+    delivery = ImageDelivery(mode="sas", detail="high", blob_service_client=blob_service_client)  # type: ignore[arg-type]
+    test_document = Document(
+        id="test",
+        content="test content",
+        embedding=None,
+        image_embedding=None,
+        category=None,
+        oids=[],
+        groups=[],
+        captions=[],
+        sourcefile="test.pdf",
+        sourcepage="test.pdf#page=2",
+    )
+
+    # Concurrent fetches share a single request for the user delegation key
+    image_urls = await asyncio.gather(
+        *(fetch_image(blob_container_client, test_document, delivery=delivery) for _ in range(3))
+    )
+    for image_url in image_urls:
+        assert image_url is not None
+        assert image_url["detail"] == "high"
+        url = urlparse(image_url["url"])
+        assert url.path == f"/{os.environ['AZURE_STORAGE_CONTAINER']}/test.png"
+        query = parse_qs(url.query)
+        assert query["sp"] == ["r"]
+        assert "sig" in query
+    # The user delegation key is reused across images
+    assert await fetch_image(blob_container_client, test_document, delivery=delivery) is not None
+    assert blob_service_client.key_requests == 1
+    await blob_container_client.close()
+
+    # The client only sees the path of the image, not the URL with the SAS token
+    image_url = image_urls[0]
+    assert image_url is not None
+    redacted_url = redact_image_url(image_url)
+    assert redacted_url == {"url": f"/{os.environ['AZURE_STORAGE_CONTAINER']}/test.png", "detail": "high"}
+    messages = [
+        {"role": "system", "content": "You are a helpful assistant."},
+        {
+            "role": "user",
+            "content": [{"type": "text", "text": "What is on page 2?"}, {"type": "image_url", "image_url": image_url}],
+        },
+    ]
+    redacted_messages = redact_image_urls(messages)
+    assert redacted_messages[0] == messages[0]
+    assert redacted_messages[1]["content"][1]["image_url"] == redacted_url
+    assert messages[1]["content"][1]["image_url"] == image_url
+
+
+def test_redact_image_urls_keeps_data_uris():
+    image_url = {"url": "data:image/png;base64,iVBORw0KGgo=", "detail": "auto"}
+    assert redact_image_url(image_url) == image_url
+
+
+def test_image_delivery_rejects_unknown_modes():
+    with pytest.raises(ValueError):
+        ImageDelivery(mode="inline")
+    with pytest.raises(ValueError):
+        ImageDelivery(detail="medium")
+    with pytest.raises(ValueError):
+        ImageDelivery(mode="sas")
@@ -0,0 +1,55 @@
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from approaches.retrievethenreadvision import RetrieveThenReadVisionApproach
+from core.httpclients import HTTPClientRegistry
+
+from .mocks import MOCK_EMBEDDING_DIMENSIONS, MOCK_EMBEDDING_MODEL_NAME
+
+
+@pytest.mark.asyncio
+async def test_compute_image_embedding_reuses_pooled_connection():
+    async def vectorize_text(request: web.Request):
+        assert request.headers["Authorization"] == "Bearer vision-token"
+        return web.json_response({"vector": [0.1, 0.2]})
+
+    vision_app = web.Application()
+    vision_app.router.add_post("/computervision/retrieval:vectorizeText", vectorize_text)
+    http_clients = HTTPClientRegistry(limit=10, limit_per_host=2)
+
+    async def vision_token_provider():
+        return "vision-token"
+
+    async with TestServer(vision_app) as server:
+        approach = RetrieveThenReadVisionApproach(
+            search_client=None,
+            blob_container_client=None,
+            openai_client=None,
+            auth_helper=None,
+            gpt4v_deployment="gpt-4v",
+            gpt4v_model="gpt-4",
+            embedding_deployment="embeddings",
+            embedding_model=MOCK_EMBEDDING_MODEL_NAME,
+            embedding_dimensions=MOCK_EMBEDDING_DIMENSIONS,
+            sourcepage_field="",
+            content_field="",
+            query_language="en-US",
+            query_speller="lexicon",
+            vision_endpoint=str(server.make_url("/")),
+            vision_token_provider=vision_token_provider,
+            http_session=http_clients.session("vision"),
+        )
+        for _ in range(2):
+            vector_query = await approach.compute_image_embedding("interest rates")
+            assert vector_query.vector == [0.1, 0.2]
+            assert vector_query.fields == "imageEmbedding"
+
+        stats = http_clients.stats()
+        assert stats["requests"] == 2
+        assert stats["requests_in_flight"] == 0
+        assert stats["connections_created"] == 1
+        assert stats["connections_reused"] == 1
+        assert stats["connection_reuse_ratio"] == 0.5
+        await http_clients.close()
+    assert http_clients.sessions == {}
@@ -0,0 +1,65 @@
+import openai_messages_token_helper
+import pytest
+
+from core import messagebuilder
+from core.messagebuilder import TokenCountCache, build_messages
+
+TOOLS = [
+    {
+        "type": "function",
+        "function": {
+            "name": "search_sources",
+            "description": "Retrieve sources from the Azure AI Search index",
+            "parameters": {
+                "type": "object",
+                "properties": {"search_query": {"type": "string", "description": "Query string"}},
+                "required": ["search_query"],
+            },
+        },
+    }
+]
+FEW_SHOTS = [
+    {"role": "user", "content": "How did crypto do last year?"},
+    {"role": "assistant", "content": "Summarize Cryptocurrency Market Dynamics from last year"},
+]
+PAST_MESSAGES = [
+    {"role": "user", "content": "What is included in my Northwind Health Plus plan?"},
+    {"role": "assistant", "content": "Your plan includes coverage for emergency services [Benefit_Options-2.pdf]."},
+    {"role": "user", "content": "Zażółć gęślą jaźń, czy okulary są refundowane?"},
+    {"role": "assistant", "content": "Tak, w ramach planu Plus [Benefit_Options-3.pdf]."},
+]
+
+
+@pytest.fixture
+def token_count_cache(monkeypatch):
+    cache = TokenCountCache()
+    monkeypatch.setattr(messagebuilder, "token_count_cache", cache)
+    return cache
+
+
+@pytest.mark.parametrize("max_tokens", [60, 120, 4000])
+@pytest.mark.parametrize("tools,few_shots", [(None, []), (TOOLS, FEW_SHOTS)])
+def test_build_messages_matches_token_helper(token_count_cache, max_tokens, tools, few_shots):
+    kwargs = dict(
+        tools=tools,
+        few_shots=few_shots,
+        past_messages=PAST_MESSAGES,
+        new_user_content="Generate search query for: What about dental?",
+        max_tokens=max_tokens,
+    )
+    expected = openai_messages_token_helper.build_messages("gpt-35-turbo", "You are a helpful assistant.", **kwargs)
+    assert build_messages("gpt-35-turbo", "You are a helpful assistant.", **kwargs) == expected
+    # The second turn is assembled from cached counts only
+    misses = token_count_cache.stats()["misses"]
+    assert build_messages("gpt-35-turbo", "You are a helpful assistant.", **kwargs) == expected
+    assert token_count_cache.stats()["misses"] == misses
+
+
+def test_token_count_cache_key(token_count_cache):
+    message = {"role": "user", "content": "What is the deductible?"}
+    count = token_count_cache.count_message("gpt-35-turbo", message)
+    assert count == openai_messages_token_helper.count_tokens_for_message("gpt-35-turbo", message)
+    assert token_count_cache.count_message("gpt-35-turbo", dict(message)) == count
+    token_count_cache.count_message("gpt-4", message)
+    token_count_cache.count_message("gpt-35-turbo", {"role": "assistant", "content": "What is the deductible?"})
+    assert token_count_cache.stats() == {"hits": 1, "misses": 3, "size": 3}
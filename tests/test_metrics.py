@@ -0,0 +1,26 @@
+from core import metrics
+
+
+class MockMeter:
+    def __init__(self):
+        self.gauges = {}
+
+    def create_observable_gauge(self, name, callbacks):
+        self.gauges[name] = callbacks
+
+
+def test_register_stats_gauges_once_per_name(monkeypatch):
+    meter = MockMeter()
+    monkeypatch.setattr(metrics, "meter", meter)
+    monkeypatch.setattr(metrics, "_stats_sources", {})
+    monkeypatch.setattr(metrics, "_registered_gauges", set())
+
+    metrics.register_stats_gauges("test", lambda: {"hits": 1, "misses": 2})
+    # Re-running setup registers a new stats function under the same prefix
+    metrics.register_stats_gauges("test", lambda: {"hits": 10})
+
+    assert list(meter.gauges) == ["test.hits", "test.misses"]
+    assert all(len(callbacks) == 1 for callbacks in meter.gauges.values())
+    [observation] = meter.gauges["test.hits"][0](None)
+    assert observation.value == 10
+    assert meter.gauges["test.misses"][0](None) == []
@@ -0,0 +1,190 @@
+import httpx
+import pytest
+from openai import AsyncAzureOpenAI, DefaultAsyncHttpxClient, RateLimitError
+
+from core.openaibackends import OpenAIBackend, OpenAIBackendPool
+
+EMBEDDING_RESPONSE = {
+    "object": "list",
+    "data": [{"object": "embedding", "embedding": [0.1, 0.2], "index": 0}],
+    "model": "text-embedding-ada-002",
+    "usage": {"prompt_tokens": 3, "total_tokens": 3},
+}
+
+
+def create_pool(handler, *backends: OpenAIBackend) -> tuple[OpenAIBackendPool, AsyncAzureOpenAI]:
+    pool = OpenAIBackendPool(list(backends), transport=httpx.MockTransport(handler))
+    client = AsyncAzureOpenAI(
+        api_version="2024-06-01",
+        azure_endpoint=pool.endpoint,
+        api_key="primary-key",
+        max_retries=0,
+        http_client=DefaultAsyncHttpxClient(transport=pool),
+    )
+    return pool, client
+
+
+@pytest.mark.asyncio
+async def test_throttled_backend_is_ejected():
+    requests = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        if request.url.host == "ptu.openai.azure.com":
+            return httpx.Response(429, headers={"retry-after-ms": "30000"}, json={"error": {"code": "429"}})
+        return httpx.Response(200, headers={"x-ratelimit-remaining-tokens": "9000"}, json=EMBEDDING_RESPONSE)
+
+    pool, client = create_pool(
+        handler,
+        OpenAIBackend("https://ptu.openai.azure.com", priority=0),
+        OpenAIBackend(
+            "https://paygo.openai.azure.com/",
+            priority=1,
+            deployments={"embedding": "embedding-paygo"},
+            api_key="paygo-key",
+        ),
+    )
+    for _ in range(2):
+        embedding = await client.embeddings.create(model="embedding", input="dental")
+        assert embedding.data[0].embedding == [0.1, 0.2]
+
+    # The second call skips the ejected backend instead of being throttled again
+    assert [request.url.host for request in requests] == [
+        "ptu.openai.azure.com",
+        "paygo.openai.azure.com",
+        "paygo.openai.azure.com",
+    ]
+    assert requests[1].url.path == "/openai/deployments/embedding-paygo/embeddings"
+    assert requests[1].url.params["api-version"] == "2024-06-01"
+    assert requests[1].headers["api-key"] == "paygo-key"
+    stats = pool.stats()
+    assert stats["ptu.requests"] == 1
+    assert stats["ptu.throttled"] == 1
+    assert stats["ptu.ejected"] == 1
+    assert stats["paygo.requests"] == 2
+    assert stats["paygo.ejected"] == 0
+    assert stats["paygo.headroom"] == 1.0
+
+
+@pytest.mark.asyncio
+async def test_throttled_everywhere_returns_429():
+    def handler(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(429, headers={"retry-after": "5"}, json={"error": {"code": "429"}})
+
+    pool, client = create_pool(
+        handler, OpenAIBackend("https://a.openai.azure.com"), OpenAIBackend("https://b.openai.azure.com")
+    )
+    with pytest.raises(RateLimitError):
+        await client.embeddings.create(model="embedding", input="dental")
+    assert pool.stats()["a.throttled"] == 1
+    assert pool.stats()["b.throttled"] == 1
+
+
+@pytest.mark.asyncio
+async def test_failed_backend_moves_to_next():
+    requests = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request.url.host)
+        if request.url.host == "down.openai.azure.com":
+            raise httpx.ConnectError("Connection refused", request=request)
+        if request.url.host == "broken.openai.azure.com":
+            return httpx.Response(503, json={"error": {"code": "503"}})
+        return httpx.Response(200, json=EMBEDDING_RESPONSE)
+
+    pool, client = create_pool(
+        handler,
+        OpenAIBackend("https://down.openai.azure.com", priority=0),
+        OpenAIBackend("https://broken.openai.azure.com", priority=1),
+        OpenAIBackend("https://ok.openai.azure.com", priority=2),
+    )
+    embedding = await client.embeddings.create(model="embedding", input="dental")
+    assert embedding.data[0].embedding == [0.1, 0.2]
+    assert requests == ["down.openai.azure.com", "broken.openai.azure.com", "ok.openai.azure.com"]
+    stats = pool.stats()
+    assert stats["down.errors"] == 1
+    assert stats["down.ejected"] == 1
+    assert stats["broken.errors"] == 1
+    assert stats["broken.ejected"] == 0
+
+
+@pytest.mark.asyncio
+async def test_streamed_response_stays_in_flight_until_closed():
+    class StreamingTransport(httpx.AsyncBaseTransport):
+        # Unlike httpx.MockTransport, returns the response before its body was read
+        async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+            return httpx.Response(200, stream=httpx.ByteStream(b"data: [DONE]\n\n"))
+
+    pool = OpenAIBackendPool([OpenAIBackend("https://a.openai.azure.com")], transport=StreamingTransport())
+    async with httpx.AsyncClient(transport=pool) as client:
+        async with client.stream("POST", "https://a.openai.azure.com/openai/deployments/chat/chat/completions") as r:
+            # The headers arrived, but the backend is still busy sending the body
+            assert pool.stats()["a.in_flight"] == 1
+            assert [line async for line in r.aiter_lines()] == ["data: [DONE]", ""]
+        assert pool.stats()["a.in_flight"] == 0
+
+
+@pytest.mark.asyncio
+async def test_api_key_is_only_sent_to_its_endpoint():
+    requests = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        if request.url.host == "primary.openai.azure.com":
+            return httpx.Response(429, headers={"retry-after": "5"}, json={"error": {"code": "429"}})
+        return httpx.Response(200, json=EMBEDDING_RESPONSE)
+
+    _, client = create_pool(
+        handler,
+        OpenAIBackend("https://primary.openai.azure.com", priority=0),
+        OpenAIBackend("https://secondary.openai.azure.com", priority=1),
+    )
+    await client.embeddings.create(model="embedding", input="dental")
+    assert requests[0].headers["api-key"] == "primary-key"
+    # The secondary endpoint has no key of its own, so it doesn't get the key of the primary one
+    assert "api-key" not in requests[1].headers
+
+
+def test_choose_spreads_calls_before_latency_is_known():
+    a = OpenAIBackend("https://a.openai.azure.com")
+    b = OpenAIBackend("https://b.openai.azure.com")
+    pool = OpenAIBackendPool([a, b])
+    assert pool.choose(100, []) is a
+    a.in_flight = 1
+    assert pool.choose(100, []) is b
+    # A backend without samples is compared to the others at their average latency
+    a.record_latency(0.1)
+    b.in_flight = 0
+    assert pool.choose(100, []) is b
+
+
+def test_choose_prefers_priority_then_score():
+    ptu = OpenAIBackend("https://ptu.openai.azure.com", priority=0)
+    fast = OpenAIBackend("https://fast.openai.azure.com", priority=1)
+    slow = OpenAIBackend("https://slow.openai.azure.com", priority=1, weight=2)
+    pool = OpenAIBackendPool([ptu, fast, slow])
+    fast.record_latency(0.2)
+    slow.record_latency(0.6)
+    assert pool.choose(100, []) is ptu
+
+    # The token quota of the PTU deployment is used up, so its calls overflow to the next priority
+    ptu.update_rate_limits(httpx.Headers({"x-ratelimit-remaining-requests": "0"}), now=100)
+    assert pool.choose(100, []) is fast
+    fast.in_flight = 2
+    assert pool.choose(100, []) is slow
+    # Headroom that was reported too long ago no longer counts
+    assert pool.choose(200, []) is ptu
+
+
+def test_pool_config():
+    pool = OpenAIBackendPool.from_config(
+        [{"endpoint": "https://ptu.openai.azure.com/"}, {"endpoint": "https://proxy.example.com/aoai", "name": "proxy"}]
+    )
+    assert pool.endpoint == "https://ptu.openai.azure.com"
+    assert [backend.name for backend in pool.backends] == ["ptu", "proxy"]
+    with pytest.raises(ValueError):
+        OpenAIBackendPool.from_config(
+            [{"endpoint": "https://a.openai.azure.com"}, {"endpoint": "https://a.openai.azure.com"}]
+        )
+    with pytest.raises(ValueError):
+        OpenAIBackend("https://a.openai.azure.com", weight=0)
@@ -0,0 +1,20 @@
+from openai.types import CompletionUsage
+
+from core.promptusage import PromptUsageStats
+
+
+def test_prompt_usage_stats():
+    stats = PromptUsageStats()
+    assert stats.record(None) is None
+    # Older API versions do not report the cached tokens
+    assert stats.record(CompletionUsage(prompt_tokens=1500, completion_tokens=20, total_tokens=1520)) is None
+    usage = CompletionUsage.model_validate(
+        {
+            "prompt_tokens": 1500,
+            "completion_tokens": 20,
+            "total_tokens": 1520,
+            "prompt_tokens_details": {"cached_tokens": 1280},
+        }
+    )
+    assert stats.record(usage) == 1280
+    assert stats.stats() == {"completions": 2, "prompt_tokens": 3000, "cached_tokens": 1280, "cached_ratio": 0.427}
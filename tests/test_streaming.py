@@ -0,0 +1,142 @@
+import asyncio
+
+import pytest
+
+from approaches.approach import Document, ThoughtStep
+from core import streaming
+
+
+@pytest.mark.parametrize("use_orjson", [True, False])
+def test_dumps_ndjson_line_backends_match(monkeypatch, use_orjson):
+    if not use_orjson:
+        monkeypatch.setattr(streaming, "orjson", None)
+    elif streaming.orjson is None:
+        pytest.skip("orjson is not installed")
+    event = {
+        "delta": {"role": "assistant"},
+        "context": {
+            "data_points": {"text": ["Benefit_Options-2.pdf: Zażółć gęślą jaźń"]},
+            "thoughts": [ThoughtStep("Search results", [{"id": "1", "score": 0.5}], {"top": 3, "filter": None})],
+        },
+    }
+    assert (
+        streaming.dumps_ndjson_line(event)
+        == (
+            '{"delta":{"role":"assistant"},"context":{"data_points":{"text":["Benefit_Options-2.pdf: Zażółć gęślą jaźń"]},'
+            '"thoughts":[{"title":"Search results","description":[{"id":"1","score":0.5}],"props":{"top":3,"filter":null}}]}}\n'
+        ).encode()
+    )
+
+
+@pytest.mark.parametrize("use_orjson", [True, False])
+def test_dumps_ndjson_line_serializes_documents(monkeypatch, use_orjson):
+    if not use_orjson:
+        monkeypatch.setattr(streaming, "orjson", None)
+    elif streaming.orjson is None:
+        pytest.skip("orjson is not installed")
+    document = Document(
+        id="file-Benefit_Options_pdf-42",
+        content="There is a whistleblower policy.",
+        embedding=[0.1, 0.2, 0.3, 0.4],
+        image_embedding=None,
+        category=None,
+        sourcepage="Benefit_Options-2.pdf",
+        sourcefile="Benefit_Options.pdf",
+        oids=None,
+        groups=None,
+        captions=[],
+        score=0.03,
+        reranker_score=2.5,
+    )
+    step = ThoughtStep("Search results", [document])
+    line = streaming.dumps_ndjson_line({"context": {"thoughts": [step]}})
+    assert line == streaming.dumps_ndjson_line(
+        {"context": {"thoughts": [ThoughtStep("Search results", [document.serialize_for_results()])]}}
+    )
+
+
+async def collect(events):
+    return [event async for event in events]
+
+
+async def make_stream(events, delay=0):
+    for event in events:
+        if delay:
+            await asyncio.sleep(delay)
+        yield event
+
+
+def delta(content):
+    return {"delta": {"content": content, "role": "assistant"}}
+
+
+@pytest.mark.asyncio
+async def test_coalesce_deltas_merges_until_max_bytes():
+    events = [{"delta": {"role": "assistant"}, "context": {}}] + [
+        delta(word) for word in ["Hi", " the", "re", " you", "!"]
+    ]
+    events.append({"delta": {"role": "assistant"}, "context": {"followup_questions": ["Why?"]}})
+    result = await collect(streaming.coalesce_deltas(make_stream(events), max_bytes=6, max_delay=10))
+    assert result == [
+        events[0],
+        delta("Hi"),
+        delta(" there"),
+        delta(" you!"),
+        events[-1],
+    ]
+
+
+@pytest.mark.asyncio
+async def test_coalesce_deltas_flushes_after_max_delay():
+    events = [delta("a"), delta("b"), delta("c"), delta("d")]
+    result = await collect(streaming.coalesce_deltas(make_stream(events, delay=0.05), max_bytes=1000, max_delay=0.01))
+    assert result == events
+
+
+@pytest.mark.asyncio
+async def test_coalesce_deltas_skips_empty_content():
+    events = [delta(""), delta("a"), delta(""), delta("b"), delta("c")]
+    result = await collect(streaming.coalesce_deltas(make_stream(events), max_bytes=1000, max_delay=10))
+    assert result == [delta("a"), delta("bc")]
+
+
+@pytest.mark.asyncio
+async def test_start_stream_raises_early_errors_only():
+    async def rejected():
+        raise KeyError("rejected")
+        yield  # pragma: no cover
+
+    async def failing():
+        raise ValueError("failed")
+        yield  # pragma: no cover
+
+    with pytest.raises(KeyError):
+        await streaming.start_stream(rejected(), raise_early=(KeyError,))
+    stream = await streaming.start_stream(failing(), raise_early=(KeyError,))
+    with pytest.raises(ValueError):
+        await collect(stream)
+    stream = await streaming.start_stream(make_stream([delta("a"), delta("b")]), raise_early=(KeyError,))
+    assert await collect(stream) == [delta("a"), delta("b")]
+
+
+@pytest.mark.asyncio
+async def test_closing_stream_closes_source():
+    source_closed = asyncio.Event()
+
+    async def source():
+        try:
+            yield delta("a")
+            yield delta("b")
+            await asyncio.sleep(10)
+            yield delta("c")  # pragma: no cover
+        finally:
+            source_closed.set()
+
+    stream = streaming.coalesce_deltas(
+        await streaming.start_stream(source(), raise_early=(KeyError,)), max_bytes=1000, max_delay=0.01
+    )
+    assert await stream.__anext__() == delta("a")
+    # The second delta is flushed while the next read is still waiting on the source
+    assert await stream.__anext__() == delta("b")
+    await stream.aclose()
+    assert source_closed.is_set()
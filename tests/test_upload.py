@@ -13,6 +13,7 @@ from openai.types.create_embedding_response import (
 )
 from quart.datastructures import FileStorage
 
+from core.fairshare import FairShareScheduler
 from prepdocslib.embeddings import AzureOpenAIEmbeddingService
 
 from .mocks import MockClient, MockEmbeddingsClient
@@ -89,6 +90,15 @@ async def test_upload_file(auth_client, monkeypatch, mock_data_lake_service_clie
     monkeypatch.setattr(SearchClient, "upload_documents", mock_upload_documents)
     monkeypatch.setattr(AzureOpenAIEmbeddingService, "create_client", mock_create_client)
 
+    slots = []
+    original_slot = FairShareScheduler.slot
+
+    def mock_slot(self, identity, weight=1.0):
+        slots.append((identity, weight))
+        return original_slot(self, identity, weight)
+
+    monkeypatch.setattr(FairShareScheduler, "slot", mock_slot)
+
     response = await auth_client.post(
         "/upload",
         headers={"Authorization": "Bearer test"},
@@ -105,6 +115,8 @@ async def test_upload_file(auth_client, monkeypatch, mock_data_lake_service_clie
     assert documents_uploaded[0]["category"] is None
     assert documents_uploaded[0]["oids"] == ["OID_X"]
     assert directory_created[0] == (not directory_exists)
+    # Ingestion waits for a fair-share slot with the lower weight of the /upload route
+    assert slots == [("OID_X", 0.25)]
 
 
 @pytest.mark.asyncio